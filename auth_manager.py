@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+""" Process-wide management of authenticated Drive and Box clients
+
+Each service is authenticated once per process. Its access token is then
+refreshed by a background thread shortly before it expires, so workers never
+have to stop for a 401 and a refresh. Refreshed Box tokens are written back to
+the config file by a background writer, which replaces the file atomically.
+Processes sharing the config file (e.g. shard workers) refresh under a
+FileLock, so only one of them uses each single-use Box refresh token.
+
+"""
+
+# Imports
+import atexit
+import configparser
+import logging
+import os
+import threading
+import time
+
+REFRESH_MARGIN = 5 * 60  # Refresh access tokens this many seconds before they expire
+RETRY_DELAY = 30  # Seconds to wait before retrying a failed refresh
+LOCK_POLL = 0.1  # Seconds between attempts to take a FileLock
+LOCK_STALE = 60  # Seconds after which a FileLock left behind by a dead process is broken
+
+
+class ConfigWriter(object):
+    """ Write updates to a config file on a background thread
+
+    Updates to the same section are merged, and only the latest values are
+    written. Each write goes to a temporary file which then replaces the config
+    file, so a crash mid-write never leaves a truncated config behind.
+
+    Args:
+        path (str): Path of the config file
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._writing = False
+        self._thread = threading.Thread(target=self._run, name='config-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.flush)
+
+    def submit(self, section, values):
+        """ Queue values to be written to a section of the config file
+
+        Args:
+            section (str): Section to update
+            values (dict): Keys and values to set in the section
+        """
+        with self._lock:
+            self._pending.setdefault(section, {}).update(values)
+            self._wake.notify_all()
+
+    def flush(self):
+        """ Block until every queued update has been written """
+        with self._lock:
+            while self._pending or self._writing:
+                self._wake.wait()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._pending:
+                    self._wake.wait()
+                pending, self._pending = self._pending, {}
+                self._writing = True
+            try:
+                self._write(pending)
+            except (IOError, OSError) as err:
+                logging.getLogger('auth').error('Failed to write %s: %s', self._path, err)
+            with self._lock:
+                self._writing = False
+                self._wake.notify_all()
+
+    def _write(self, updates):
+        cfg = configparser.ConfigParser()
+        cfg.read(self._path)
+        for section, values in updates.items():
+            if section not in cfg:
+                cfg[section] = {}
+            for key, value in values.items():
+                cfg[section][key] = str(value)
+
+        temp_file = self._path + '.tmp'
+        with open(temp_file, 'w') as config_file:
+            cfg.write(config_file)
+        os.replace(temp_file, self._path)
+
+
+class FileLock(object):
+    """ Lock shared between processes, held by creating a lock file
+
+    Used as a context manager. A lock file older than LOCK_STALE seconds is
+    assumed to be left over from a process which died holding it, and removed.
+
+    Args:
+        path (str): Path of the lock file
+    """
+
+    def __init__(self, path):
+        self._path = path
+
+    def __enter__(self):
+        while True:
+            try:
+                os.close(os.open(self._path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return self
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(self._path) > LOCK_STALE:
+                        os.remove(self._path)
+                        continue
+                except OSError:  # Released in the meantime
+                    continue
+                time.sleep(LOCK_POLL)
+
+    def __exit__(self, *exc_info):
+        try:
+            os.remove(self._path)
+        except OSError:
+            pass
+
+
+class TokenRefresher(object):
+    """ Refresh an access token on a background thread shortly before it expires
+
+    Args:
+        name (str): Name of the service, for logging
+        expires_at (callable): Returns the epoch time at which the current token expires, or None if unknown
+        refresh (callable): Refreshes the token
+        margin (float, optional): Seconds before expiry at which to refresh
+    """
+
+    def __init__(self, name, expires_at, refresh, margin=REFRESH_MARGIN):
+        self._name = name
+        self._expires_at = expires_at
+        self._refresh = refresh
+        self._margin = margin
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='refresh-' + name, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop refreshing the token """
+        self._stop_event.set()
+
+    def _run(self):
+        logger = logging.getLogger('auth')
+        while not self._stop_event.is_set():
+            expires_at = self._expires_at()
+            delay = RETRY_DELAY if expires_at is None else expires_at - self._margin - time.time()
+            if delay > 0 and self._stop_event.wait(delay):
+                return
+            if expires_at is None:
+                continue
+            try:
+                logger.debug('Refreshing the %s access token', self._name)
+                self._refresh()
+            except Exception as err:  # Keep the thread alive; requests will still refresh on a 401
+                logger.warning('Failed to refresh the %s access token: %s', self._name, err)
+                if self._stop_event.wait(RETRY_DELAY):
+                    return
+
+
+class AuthManager(object):
+    """ Registry of authenticated clients, one per service and endpoint """
+
+    def __init__(self):
+        self._clients = {}
+        self._refreshers = {}
+        # Re-entrant, as a factory registers its refresher while the client is being created
+        self._lock = threading.RLock()
+
+    def get(self, key, factory, reset=False):
+        """ Get the client for a key, creating it on first use
+
+        Args:
+            key (tuple): Identifies the service and endpoint (e.g. ('box', None))
+            factory (callable): Creates and authenticates the client
+            reset (bool, optional): Whether to replace any existing client
+
+        Returns:
+            The client
+        """
+        with self._lock:
+            if key not in self._clients or reset:
+                if key in self._refreshers:
+                    self._refreshers.pop(key).stop()
+                self._clients[key] = factory()
+            return self._clients[key]
+
+    def keep_fresh(self, key, expires_at, refresh, margin=REFRESH_MARGIN):
+        """ Refresh the token of a client in the background before it expires
+
+        Args:
+            key (tuple): Key the client was registered under
+            expires_at (callable): Returns the epoch time at which the current token expires
+            refresh (callable): Refreshes the token
+            margin (float, optional): Seconds before expiry at which to refresh
+        """
+        with self._lock:
+            if key in self._refreshers:
+                self._refreshers[key].stop()
+            self._refreshers[key] = TokenRefresher(str(key[0]), expires_at, refresh, margin)
+
+
+clients = AuthManager()
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+""" Benchmark the Drive/Box construction and matching code on synthetic trees
+
+Runs the real Drive and Box construction and migrate_metadata against
+synthetic trees of increasing size, reporting the time and peak memory of
+each phase. Results are saved under a label (the git revision by default) so
+that runs of different versions can be compared.
+
+With --matchlevel, the Box is indexed by looser match keys, and --variants
+names a share of the Box files in upper case, so that matching them goes
+through the normalized-key fallback.
+
+Usage:
+    python3 benchmark.py --sizes 10000,100000 --baseline <label>
+    python3 benchmark.py --sizes 10000,100000 --matchlevel case --variants 0.1
+
+"""
+
+# Imports
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import logging
+import os
+import subprocess
+import time
+import tracemalloc
+
+import box_interface
+import drive_interface
+import match_keys
+import migration
+import synthetic
+
+PATH_ROOT = 'D:'
+DEFAULT_SIZES = '10000,100000,1000000'
+DEFAULT_RESULTS_FILE = 'benchmark_results.json'
+PHASES = ['drive_build', 'box_build', 'match', 'write']
+
+
+def build_arg_parser():
+    """ Build and return an args parser
+
+    Returns:
+        argparse: Args parser
+    """
+    parser = argparse.ArgumentParser(description='Benchmark the Drive Migration Tool on synthetic trees.')
+    parser.add_argument('--sizes', type=str, default=DEFAULT_SIZES,
+                        help='Comma separated tree sizes (total files and folders) to benchmark')
+    parser.add_argument('--depth', type=int, default=8,
+                        help='Maximum folder depth of the synthetic trees')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed for the synthetic trees')
+    parser.add_argument('--label', type=str, default=None,
+                        help='Label to save the results under (defaults to the git revision)')
+    parser.add_argument('--results', type=str, default=DEFAULT_RESULTS_FILE, metavar='FILENAME',
+                        help='JSON file the results are saved to')
+    parser.add_argument('--baseline', type=str, default=None, metavar='LABEL',
+                        help='Label of earlier results to compare against')
+    parser.add_argument('--skipmemory', action='store_true',
+                        help='Skip the (slower) traced run which measures peak memory')
+    parser.add_argument('--matchlevel', type=str, default=match_keys.EXACT, choices=match_keys.LEVELS,
+                        help='Loosest match key the Box is indexed by')
+    parser.add_argument('--variants', type=float, default=0.0, metavar='RATIO',
+                        help='Share of files named in upper case in Box')
+    return parser
+
+
+def run_phases(tree, trace_memory=False, match_level=match_keys.EXACT):
+    """ Build the Drive and Box from a tree, then match and write the metadata
+
+    Args:
+        tree (SyntheticTree): The tree to run against
+        trace_memory (bool, optional): Whether to measure the peak memory of each phase
+        match_level (str, optional): Loosest match key the Box is indexed by
+
+    Returns:
+        dict: Phase name to a dict of 'seconds' and (if traced) 'peak_bytes'
+    """
+    logger = logging.getLogger('benchmark')
+    results = {}
+    objects = {}
+
+    def measure(phase, func):
+        gc.collect()
+        if trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        objects[phase] = func()
+        results[phase] = {'seconds': round(time.perf_counter() - start, 3)}
+        if trace_memory:
+            results[phase]['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+    measure('drive_build', lambda: drive_interface.Drive(path_prefix=PATH_ROOT,
+                                                         service=synthetic.SyntheticDriveService(tree),
+                                                         logger=logger))
+    measure('box_build', lambda: box_interface.Box(path_prefix=PATH_ROOT,
+                                                   client=synthetic.SyntheticBoxClient(tree),
+                                                   match_level=match_level,
+                                                   logger=logger))
+    drive, box = objects['drive_build'], objects['box_build']
+    measure('match', lambda: migration.migrate_metadata(box=box, drive=drive, test_only=True))
+    measure('write', lambda: migration.migrate_metadata(box=box, drive=drive, test_only=False))
+
+    if not trace_memory:
+        results['drive_build']['files'] = len(drive.files)
+        results['drive_build']['folders'] = len(drive.folders)
+        results['box_build']['files'] = len(box.files)
+        results['box_build']['folders'] = len(box.folders)
+    return results
+
+
+def run_benchmark(sizes, depth=8, seed=0, trace_memory=True, match_level=match_keys.EXACT, variant_ratio=0.0):
+    """ Run every phase at each of the given sizes
+
+    Args:
+        sizes ([int]): Tree sizes to benchmark
+        depth (int, optional): Maximum folder depth of the trees
+        seed (int, optional): Random seed for the trees
+        trace_memory (bool, optional): Whether to also measure peak memory
+        match_level (str, optional): Loosest match key the Box is indexed by
+        variant_ratio (float, optional): Share of files named in upper case in Box
+
+    Returns:
+        dict: Size (as a string) to the results of each phase
+    """
+    all_results = {}
+    for size in sizes:
+        print('Generating a tree of {0} items...'.format(size))
+        tree = synthetic.SyntheticTree(size, max_depth=depth, seed=seed, variant_ratio=variant_ratio)
+
+        print('Timing {0} items...'.format(size))
+        results = run_phases(tree, match_level=match_level)
+        if trace_memory:
+            print('Measuring memory for {0} items...'.format(size))
+            for phase, traced in run_phases(tree, trace_memory=True, match_level=match_level).items():
+                results[phase]['peak_bytes'] = traced['peak_bytes']
+
+        for phase in PHASES:
+            print('\t{0:<12} {1:>10.3f}s {2:>12}'.format(phase, results[phase]['seconds'],
+                                                        _format_bytes(results[phase].get('peak_bytes'))))
+        all_results[str(size)] = results
+    return all_results
+
+
+def compare(results, baseline):
+    """ Print the change in time and memory of each phase against a baseline
+
+    Args:
+        results (dict): Results of this run
+        baseline (dict): Results of an earlier run
+    """
+    print('Change against baseline:')
+    for size, phases in results.items():
+        if size not in baseline:
+            continue
+        print('  {0} items:'.format(size))
+        for phase in PHASES:
+            current, previous = phases.get(phase, {}), baseline[size].get(phase, {})
+            changes = []
+            for measure in ('seconds', 'peak_bytes'):
+                if current.get(measure) and previous.get(measure):
+                    changes.append('{0} {1:+.1f}%'.format(
+                        measure, 100.0 * (current[measure] - previous[measure]) / previous[measure]))
+            print('\t{0:<12} {1}'.format(phase, ', '.join(changes) if changes else 'n/a'))
+
+
+def _format_bytes(size):
+    if size is None:
+        return ''
+    return '{0:.1f}MB'.format(size / (1024.0 * 1024.0))
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return time.strftime("%Y%m%d-%H%M%S")
+
+
+if __name__ == '__main__':
+    args = build_arg_parser().parse_args()
+    logging.getLogger('benchmark').setLevel(logging.WARNING)
+
+    label = args.label or _git_revision()
+    results = run_benchmark(sizes=[int(size) for size in args.sizes.split(',')],
+                            depth=args.depth,
+                            seed=args.seed,
+                            trace_memory=not args.skipmemory,
+                            match_level=args.matchlevel,
+                            variant_ratio=args.variants)
+
+    saved = {}
+    if os.path.exists(args.results):
+        with open(args.results, 'r', encoding='utf-8') as results_file:
+            saved = json.load(results_file)
+    if args.baseline:
+        if args.baseline in saved:
+            compare(results, saved[args.baseline]['results'])
+        else:
+            print('No saved results with label {0}'.format(args.baseline))
+
+    saved[label] = {'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+                    'depth': args.depth,
+                    'seed': args.seed,
+                    'match_level': args.matchlevel,
+                    'variants': args.variants,
+                    'results': results}
+    with open(args.results, 'w', encoding='utf-8') as results_file:
+        json.dump(saved, results_file, indent=2, sort_keys=True)
+    print('Saved results as {0} in {1}'.format(label, args.results))
@@ -2,79 +2,309 @@
 
 from __future__ import print_function, unicode_literals
 
-import bottle
 import configparser
-import webbrowser
+import functools
+import os
+import time
 
-from boxsdk import Client, OAuth2, exception
 from threading import Thread, Event
-from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
+
+import auth_manager
+import match_keys
+import resilience
+
+# boxsdk, bottle and webbrowser are slow to import, so they are only loaded once
+# Box is actually used
 
 CONFIG_FILE = 'box_app.cfg'
 REQUEST_COUNT = 200
+ACCESS_TOKEN_LIFETIME = 60 * 60  # Box access tokens last an hour
+
+# Ways of mapping the Box: listing each folder, or paging through search results for every file
+WALK = 'walk'
+SEARCH = 'search'
+AUTO = 'auto'
+STRATEGIES = [WALK, SEARCH, AUTO]
+SEARCH_LIMIT = 200  # Most results Box returns per search request
+SEARCH_MAX_OFFSET = 10000  # Highest offset Box accepts when paging through search results
+SEARCH_REQUEST_COST = 4  # A search request takes about as long as this many folder listings
+PROBE_FOLDERS = 10  # Folders listed to estimate the shape of the Box, if it isn't known
+
+
+def _make_stoppable_server(host, port):
+    """ Create a bottle server adapter which can be shut down once the OAuth2 redirect arrives
+
+    Args:
+        host (str): Host to listen on
+        port (int): Port to listen on
+
+    Returns:
+        StoppableWSGIServer: The server adapter
+    """
+    import bottle
+    from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, make_server
 
+    class StoppableWSGIServer(bottle.ServerAdapter):
+        def __init__(self, *args, **kwargs):
+            super(StoppableWSGIServer, self).__init__(*args, **kwargs)
+            self._server = None
 
-class StoppableWSGIServer(bottle.ServerAdapter):
-    def __init__(self, *args, **kwargs):
-        super(StoppableWSGIServer, self).__init__(*args, **kwargs)
-        self._server = None
+        def run(self, app):
+            server_cls = self.options.get('server_class', WSGIServer)
+            handler_cls = self.options.get('handler_class', WSGIRequestHandler)
+            self._server = make_server(self.host, self.port, app, server_cls, handler_cls)
+            self._server.serve_forever()
 
-    def run(self, app):
-        server_cls = self.options.get('server_class', WSGIServer)
-        handler_cls = self.options.get('handler_class', WSGIRequestHandler)
-        self._server = make_server(self.host, self.port, app, server_cls, handler_cls)
-        self._server.serve_forever()
+        def stop(self):
+            self._server.shutdown()
 
-    def stop(self):
-        self._server.shutdown()
+    return StoppableWSGIServer(host=host, port=port)
 
 
-def print_credentials(force_reset=False, logger=None):
-    user_email = _authenticate(force_reset, logger).user(user_id='me').get().login
+def print_credentials(force_reset=False, logger=None, api_url=None, network_layer=None):
+    user_email = get_client(force_reset, logger, api_url, network_layer).user(user_id='me').get().login
     if logger:
-        logger.info('Logged into Box with username: {0}'.format(user_email))
+        logger.info('Logged into Box with username: %s', user_email)
+
 
+def check_metadata_exists(metadata_name, api_url=None, network_layer=None):
+    from boxsdk import exception
+    from boxsdk.config import API
 
-def check_metadata_exists(metadata_name):
     try:
-        url = 'https://api.box.com/2.0/metadata_templates/enterprise/{0}/schema'.format(metadata_name)
-        _authenticate(force_reset=False, logger=None).make_request('GET', url)
+        client = get_client(force_reset=False, logger=None, api_url=api_url, network_layer=network_layer)
+        url = '{0}/metadata_templates/enterprise/{1}/schema'.format(API.BASE_API_URL, metadata_name)
+        client.make_request('GET', url)
         return True
     except exception.BoxAPIException:
         return False
 
 
-def _authenticate(force_reset=False, logger=None):
+def recording_network(cassette):
+    """ Build a network layer which records every exchange with Box to a cassette
+
+    Args:
+        cassette (Cassette): Cassette to record to
+
+    Returns:
+        RecordingNetwork: The network layer
+    """
+    from boxsdk.network.default_network import DefaultNetwork
+    from cassette import RecordingNetwork
+
+    return RecordingNetwork(DefaultNetwork(), cassette)
+
+
+def flush_tokens():
+    """ Block until any refreshed tokens have been saved to the config file (e.g. before starting workers) """
+    _TokenStore.flush()
+
+
+def extension_query(names):
+    """ Build a Box search query matching file names with any of the extensions of some names
+
+    Box search needs a query, so this is used to find every file which could match a Drive file.
+
+    Args:
+        names (iter(str)): File names (e.g. those in Drive)
+
+    Returns:
+        str: The query, or None if none of the names have an extension
+    """
+    extensions = sorted({os.path.splitext(name)[1][1:].lower() for name in names} - {''})
+    return ' OR '.join(extensions) or None
+
+
+def unsearchable_names(names):
+    """ List the names which no query from extension_query can find, as they have no extension
+
+    Args:
+        names (iter(str)): File names (e.g. those in Drive)
+
+    Returns:
+        [str]: The names without an extension
+    """
+    return [name for name in names if not os.path.splitext(name)[1][1:]]
+
+
+def get_client(force_reset=False, logger=None, api_url=None, network_layer=None):
+    """ Get the authenticated Box client, logging in only the first time it is needed
+
+    The client is shared by everything in the process which talks to the same endpoint
+    through the same network layer, and its access token is refreshed in the background
+    shortly before it expires.
+
+    Args:
+        force_reset (bool, optional): Whether to force a reset of the account credentials
+        logger (logger, optional): Logging file
+        api_url (str, optional): URL of a Box API stand-in to use instead of api.box.com
+        network_layer (Network, optional): Network layer to send requests through
+
+    Returns:
+        client: Authenticated Box client
+    """
+    return auth_manager.clients.get(('box', api_url, id(network_layer)),
+                                    lambda: _authenticate(force_reset, logger, api_url, network_layer),
+                                    reset=force_reset)
+
+
+def as_user(client, login):
+    """ Get a client acting as another user of the enterprise, through the As-User header
+
+    The client must belong to an admin of the enterprise, or a co-admin allowed to manage users. The
+    new client shares the admin client's session and network layer.
+
+    Args:
+        client (client): The admin's authenticated Box client
+        login (str): Login (email address) of the user to act as
+
+    Returns:
+        client: Box client acting as the user
+
+    Raises:
+        LookupError: If no user of the enterprise has the login
+    """
+    for user in client.users(filter_term=login):
+        if user.login.lower() == login.lower():
+            return client.as_user(user)
+    raise LookupError('No Box user has the login <{0}>'.format(login))
+
+
+class _TokenStore(object):
+    """ Keeps track of when the Box tokens were issued and saves refreshed tokens to the config file
+
+    Passed to OAuth2 as its store_tokens callback, so it is called (possibly from a worker thread)
+    every time the tokens are refreshed. Saving happens on a background thread.
+
+    Args:
+        issued_at (float, optional): Epoch time at which the current access token was issued
+
+    Attributes:
+        issued_at (float): Epoch time at which the current access token was issued
+    """
+
+    _writer = None
+
+    def __init__(self, issued_at=0.0):
+        self.issued_at = issued_at
+
+    def __call__(self, access_token, refresh_token):
+        self.issued_at = time.time()
+        if _TokenStore._writer is None:
+            _TokenStore._writer = auth_manager.ConfigWriter(CONFIG_FILE)
+        _TokenStore._writer.submit('app_info', {'access_token': access_token,
+                                                'refresh_token': refresh_token,
+                                                'token_time': self.issued_at})
+
+    def expires_at(self):
+        return self.issued_at + ACCESS_TOKEN_LIFETIME
+
+    @staticmethod
+    def flush():
+        """ Block until the saved tokens have been written to the config file """
+        if _TokenStore._writer is not None:
+            _TokenStore._writer.flush()
+
+
+def _make_shared_oauth(token_store, **kwargs):
+    """ Create an OAuth2 which shares its tokens with other processes through the config file
+
+    A Box refresh token can only be used once, so when several processes use the same credentials the
+    first to refresh would leave the others unable to. Refreshes are made under a lock on the config file,
+    and a process which finds newer tokens there than its own takes those rather than refreshing.
+
+    Args:
+        token_store (_TokenStore): Saves the tokens whenever they are refreshed
+        **kwargs: Arguments to OAuth2
+
+    Returns:
+        OAuth2: The OAuth2 object
+    """
+    from boxsdk import OAuth2
+
+    class SharedOAuth2(OAuth2):
+        def _get_tokens(self):
+            cfg = configparser.ConfigParser()
+            cfg.read(CONFIG_FILE)
+            if 'app_info' in cfg and float(cfg['app_info'].get('token_time', 0)) > token_store.issued_at:
+                token_store.issued_at = float(cfg['app_info']['token_time'])
+                return cfg['app_info']['access_token'], cfg['app_info']['refresh_token']
+            return super(SharedOAuth2, self)._get_tokens()
+
+        def refresh(self, access_token_to_refresh):
+            with auth_manager.FileLock(CONFIG_FILE + '.lock'):
+                tokens = super(SharedOAuth2, self).refresh(access_token_to_refresh)
+                # Written before the lock is released, so the next process to refresh finds them
+                token_store.flush()
+                return tokens
+
+    return SharedOAuth2(store_tokens=token_store, **kwargs)
+
+
+def _keep_fresh(oauth, token_store, api_url, network_layer):
+    auth_manager.clients.keep_fresh(('box', api_url, id(network_layer)),
+                                    expires_at=token_store.expires_at,
+                                    refresh=lambda: oauth.refresh(oauth.access_token))
+
+
+def _authenticate(force_reset=False, logger=None, api_url=None, network_layer=None):
+    from boxsdk import Client, OAuth2, exception
+    from boxsdk.config import API
+
+    if api_url or getattr(network_layer, 'replaying', False):
+        # A local stand-in or a replayed cassette accepts any token, so skip the OAuth2 flow entirely
+        if api_url:
+            if logger:
+                logger.info('Using the Box API at %s', api_url)
+            api_url = api_url.rstrip('/')
+            API.BASE_API_URL = api_url + '/2.0'
+            API.OAUTH2_API_URL = api_url + '/oauth2'
+        return Client(OAuth2(client_id='stub',
+                             client_secret='stub',
+                             access_token='stub-access-token',
+                             refresh_token='stub-refresh-token'),
+                      network_layer=network_layer)
+
     # Config setup
     cfg = configparser.ConfigParser()
     cfg.read(CONFIG_FILE)
 
-    # Verify if there is a valid token already
+    # Reuse the existing token if there is one
     if 'app_info' in cfg and not force_reset:
         if logger:
             logger.info('Using existing credentials')
-        client = Client(OAuth2(
+        token_store = _TokenStore(float(cfg['app_info'].get('token_time', 0)))
+        oauth = _make_shared_oauth(
+            token_store,
             client_id=cfg['client_info']['client_id'],
             client_secret=cfg['client_info']['client_secret'],
             access_token=cfg['app_info']['access_token'],
-            refresh_token=cfg['app_info']['refresh_token']))
-
-        try:
-            # Make a request to check it's authenticated
-            if logger:
-                logger.info('Testing existing connection')
-            client.user(user_id='me').get()
-        except exception.BoxOAuthException:
-            if logger:
-                logger.info('Resetting connection to Box')
-            return _reset_authentication(cfg=cfg, logger=logger)
-
+            refresh_token=cfg['app_info']['refresh_token'])
+        client = Client(oauth, network_layer=network_layer)
+
+        # A token issued recently is trusted as is. Otherwise refresh it, which both checks the
+        # credentials and starts the run with a full hour on the token.
+        if time.time() >= token_store.expires_at() - auth_manager.REFRESH_MARGIN:
+            try:
+                if logger:
+                    logger.info('Refreshing the existing token')
+                oauth.refresh(oauth.access_token)
+            except exception.BoxOAuthException:
+                if logger:
+                    logger.info('Resetting connection to Box')
+                return _reset_authentication(cfg=cfg, logger=logger, network_layer=network_layer)
+
+        _keep_fresh(oauth, token_store, api_url, network_layer)
         return client
 
-    return _reset_authentication(cfg=cfg, logger=logger)
+    return _reset_authentication(cfg=cfg, logger=logger, network_layer=network_layer)
 
 
-def _reset_authentication(cfg, logger=None):
+def _reset_authentication(cfg, logger=None, network_layer=None):
+    import bottle
+    import webbrowser
+    from boxsdk import Client, exception
+
     if logger:
         logger.info('Fetching new credentials')
     auth_code = {}
@@ -88,11 +318,14 @@ def _reset_authentication(cfg, logger=None):
         auth_code['state'] = bottle.request.query.state
         auth_code_is_available.set()
 
-    local_server = StoppableWSGIServer(host='localhost', port=8080)
+    local_server = _make_stoppable_server(host='localhost', port=8080)
     server_thread = Thread(target=lambda: local_oauth_redirect.run(server=local_server), daemon=True)
     server_thread.start()
 
-    oauth = OAuth2(
+    # Saves the new tokens once they are issued, and again whenever they are refreshed
+    token_store = _TokenStore()
+    oauth = _make_shared_oauth(
+        token_store,
         client_id=cfg['client_info']['client_id'],
         client_secret=cfg['client_info']['client_secret'],
     )
@@ -102,33 +335,27 @@ def _reset_authentication(cfg, logger=None):
     auth_code_is_available.wait()
     local_server.stop()
     assert auth_code['state'] == csrf_token
-    access_token, refresh_token = oauth.authenticate(auth_code['auth_code'])
+    oauth.authenticate(auth_code['auth_code'])
 
-    client = Client(oauth)
+    client = Client(oauth, network_layer=network_layer)
 
     try:
         # Make a request to check it's authenticated
         client.user(user_id='me').get()
     except exception.BoxOAuthException as err:
         if logger:
-            logger.error("Failed to authenticate to Box: {0}".format(err))
-
-    if 'app_info' not in cfg:
-        cfg['app_info'] = {}
-
-    cfg['app_info']['access_token'] = access_token
-    cfg['app_info']['refresh_token'] = refresh_token
-    with open(CONFIG_FILE, 'w') as configfile:
-        cfg.write(configfile)
+            logger.error("Failed to authenticate to Box: %s", err)
 
+    _keep_fresh(oauth, token_store, None, network_layer)
     return client
 
 
-def _retrieve_all_items(parent_folder):
+def _retrieve_all_items(parent_folder, progress=None):
     """ Retrieve from the client all child items of a folder
 
     Args:
         parent_folder (item): the parent for which to get all children
+        progress (ProgressReporter, optional): Reporter counting the requests made
 
     Returns:
         [item]: all items in Box which are children of parent_folder
@@ -138,7 +365,11 @@ def _retrieve_all_items(parent_folder):
     offset = 0
     all_items = None
     while True:
-        new_items = parent_folder.get_items(limit=REQUEST_COUNT, offset=offset)
+        new_items = resilience.guard.call('box:folder-items', functools.partial(parent_folder.get_items,
+                                                                                limit=REQUEST_COUNT,
+                                                                                offset=offset))
+        if progress:
+            progress.requests += 1
         if all_items is None:
             all_items = new_items
         elif new_items:
@@ -157,25 +388,63 @@ class Box(object):
         root_directory (str, optional): The path within Box to treat as the root
         reset_cred (bool, optional): Whether to force a reset of the account credentials
         logger (logger, optional): Logging file
+        progress (ProgressReporter, optional): Reporter tracking folders crawled and metadata written
+        client (client, optional): An already authenticated client to use instead of logging in
+        api_url (str, optional): URL of a Box API stand-in to use instead of api.box.com
+        network_layer (Network, optional): Network layer to send requests through (e.g. to record or replay them)
+        guide_paths (set(str), optional): Paths of the folders in Drive. If given, only Box folders at one of
+            these paths (or whose key at the match level is one of theirs) are crawled, as no file in any other
+            folder can be matched
+        strategy (str, optional): How to map the Box: WALK lists every folder, SEARCH pages through Box search
+            results for every file under the root, and AUTO picks whichever needs fewer requests
+        search_query (str, optional): Query for the SEARCH strategy (see extension_query). Box search only
+            returns files matching a query, and only once Box has indexed them.
+        expected_counts ((int, int), optional): Expected number of folders and files (e.g. from Drive), used
+            by AUTO. If not given, a few folders are listed to estimate them
+        shard (Shard, optional): Only map the items directly under the root which are in this shard, and
+            everything below them (see shards.py)
+        match_level (str, optional): The loosest level of match_keys at which files are looked up by path
 
     Attributes:
         client (client): Client through which Box's API is interfaced
         files ([BoxObject]): All files in the Box
         folders([BoxObject]): All folders in the Box
+        pruned_folders ([BoxObject]): Folders which weren't crawled as they aren't in guide_paths
+        search_query (str): The query the Box was mapped through, or None if its folders were walked. Files
+            which don't match it (e.g. with an extension no Drive file has) may not be in files.
         path_prefix (str): The prefix added to each path
     """
 
-    def __init__(self, path_prefix, root_directory=None, reset_cred=False, logger=None):
+    def __init__(self, path_prefix, root_directory=None, reset_cred=False, logger=None, progress=None,
+                 client=None, api_url=None, network_layer=None, guide_paths=None, strategy=WALK, search_query=None,
+                 expected_counts=None, shard=None, match_level=match_keys.EXACT):
         self.client = None
         self.files = []
         self.folders = []
+        self.pruned_folders = []
+        self.search_query = None
         self.path_prefix = path_prefix
         self.root_directory = root_directory
-
-        if logger:
-            logger.info('Connecting to Box.com')
-
-        self.client = _authenticate(reset_cred, logger)
+        self._progress = progress
+        self._guide_paths = guide_paths
+        self._guide_keys = None
+        if guide_paths is not None and match_level != match_keys.EXACT:
+            # Each level's key follows from the last, so paths with equal keys at any level share the loosest
+            self._guide_keys = {match_keys.match_keys(path, match_level)[-1][1] for path in guide_paths}
+        self._search_query = search_query
+        self._shard = shard
+        self._files_by_id = None
+        self._files_by_path = None
+        self._files_by_key = None
+        self._ambiguous_keys = None
+        self._match_level = match_level
+
+        if client:
+            self.client = client
+        else:
+            if logger:
+                logger.info('Connecting to Box.com')
+            self.client = get_client(reset_cred, logger, api_url, network_layer)
 
         if logger:
             logger.info('Connection successful. Mapping Box.')
@@ -185,22 +454,36 @@ class Box(object):
         # Setup the root
         root_folder = self._get_root_folder(root_directory)
         if logger:
-            logger.debug('root folder has id: {0}'.format(str(root_folder.object_id)))
+            logger.debug('root folder has id: %s', root_folder.object_id)
         root_object = BoxObject(identifier=root_folder.object_id, name=self.path_prefix)
         self.files = []
         self.folders = [root_object]
 
-        self._build_child_items(root_object)
+        strategy = self._choose_strategy(strategy, expected_counts, root_object, logger)
+        if strategy == SEARCH:
+            if not search_query:
+                raise ValueError('Mapping Box through search needs a search query')
+            if logger:
+                logger.info('Mapping Box through search for <%s>', search_query)
+            if self._progress:
+                self._progress.begin_phase('box-search')
+            self.search_query = search_query
+            self._search_child_items(root_object)
+        else:
+            if self._progress:
+                self._progress.begin_phase('box-crawl')
+            self._build_child_items(root_object)
 
         if logger:
-            logger.debug('Mapped {0} files and {1} folders'.format(str(len(self.files)), str(len(self.folders))))
+            logger.debug('Mapped %s files and %s folders', len(self.files), len(self.folders))
+            if self._guide_paths is not None:
+                logger.info('Skipped %s Box folders which aren\'t in Drive', len(self.pruned_folders))
             for folder in self.folders:
                 if folder.path is None:
-                    logger.debug("Found an orphaned folder with name {0} and id {1}".format(folder.name,
-                                                                                            str(folder.id)))
+                    logger.debug("Found an orphaned folder with name %s and id %s", folder.name, folder.id)
             for file in self.files:
                 if file.path is None:
-                    logger.debug("Found an orphaned file with name {0} and id {1}".format(file.name, str(file.id)))
+                    logger.debug("Found an orphaned file with name %s and id %s", file.name, file.id)
 
         if logger:
             logger.info('Mapping complete.')
@@ -230,15 +513,220 @@ class Box(object):
         return current_folder
 
     def _build_child_items(self, parent_folder):
-        children = _retrieve_all_items(self.client.folder(folder_id=parent_folder.id))
+        children = _retrieve_all_items(self.client.folder(folder_id=parent_folder.id), self._progress)
+        if self._progress:
+            self._progress.items += 1
         for child in children:
             if child.type == 'folder':
                 child_folder = BoxObject(identifier=child.object_id, name=child.name, parent=parent_folder)
+                if not self._in_shard(child_folder, is_folder=True):
+                    continue
+                if self._guide_paths is not None and not self._guided(child_folder):
+                    self.pruned_folders.append(child_folder)
+                    continue
                 self.folders.append(child_folder)
                 self._build_child_items(child_folder)
             else:
                 child_file = BoxObject(identifier=child.object_id, name=child.name, parent=parent_folder)
-                self.files.append(child_file)
+                if self._in_shard(child_file, is_folder=False):
+                    self.files.append(child_file)
+
+    def _guided(self, folder):
+        """ Check whether a folder is in Drive, at its exact path or (with a match level) by its key
+
+        Args:
+            folder (BoxObject): The folder
+
+        Returns:
+            bool: Whether the folder should be crawled
+        """
+        if folder.path in self._guide_paths:
+            return True
+        if self._guide_keys is None:
+            return False
+        return match_keys.match_keys(folder.path, self._match_level)[-1][1] in self._guide_keys
+
+    def _in_shard(self, item, is_folder):
+        """ Check whether an item belongs to the shard being mapped
+
+        Args:
+            item (BoxObject): The item
+            is_folder (bool): Whether the item is a folder
+
+        Returns:
+            bool: True if there's no shard, the item isn't directly under the root, or the shard includes it
+        """
+        if self._shard is None or item.parent.parent is not None:
+            return True
+        return self._shard.includes(item.name, is_folder)
+
+    def _choose_strategy(self, strategy, expected_counts, root_object, logger=None):
+        """ Pick between walking the folders and searching, if left to AUTO
+
+        Walking takes a request per folder, while searching takes a (slower) request per SEARCH_LIMIT
+        files, so search wins when folders hold few files on average.
+
+        Args:
+            strategy (str): WALK, SEARCH or AUTO
+            expected_counts ((int, int)): Expected number of folders and files, or None to estimate them
+            root_object (BoxObject): The root folder
+            logger (logger, optional): Logging file
+
+        Returns:
+            str: WALK or SEARCH
+        """
+        if strategy != AUTO:
+            return strategy
+        if not self._search_query:
+            return WALK
+
+        if expected_counts:
+            folder_count, file_count = expected_counts
+        else:
+            folder_count, file_count = self._probe(root_object)
+        files_per_folder = float(file_count) / max(folder_count, 1)
+        strategy = SEARCH if files_per_folder < float(SEARCH_LIMIT) / SEARCH_REQUEST_COST else WALK
+        if logger:
+            logger.info('Box folders hold %.1f files on average, so mapping it by %s', files_per_folder,
+                        'searching' if strategy == SEARCH else 'walking the folders')
+        return strategy
+
+    def _probe(self, root_object):
+        """ List the first few folders breadth first, to estimate the number of files per folder
+
+        Args:
+            root_object (BoxObject): The root folder
+
+        Returns:
+            (int, int): Number of folders listed and files found in them
+        """
+        queue = [root_object.id]
+        folder_count = file_count = 0
+        while queue and folder_count < PROBE_FOLDERS:
+            children = _retrieve_all_items(self.client.folder(folder_id=queue.pop(0)), self._progress)
+            folder_count += 1
+            for child in children:
+                if child.type == 'folder':
+                    queue.append(child.object_id)
+                else:
+                    file_count += 1
+        return folder_count, file_count
+
+    def _search_child_items(self, root_object):
+        """ Find every file under the root through Box search, rebuilding its folders from the path_collection
+
+        Only folders holding at least one file found by the search are created. guide_paths isn't used, as
+        search costs the same however many folders there are.
+
+        Box won't page through search results past SEARCH_MAX_OFFSET, so a folder with more files under it than
+        that is split: its own items are listed, and each of its subfolders is searched in turn.
+
+        Args:
+            root_object (BoxObject): The root folder
+        """
+        folders_by_id = {root_object.id: root_object}
+        unsearched = [root_object]
+        while unsearched:
+            folder = unsearched.pop()
+            if not self._search_folder(folder, folders_by_id, root_object.id):
+                unsearched.extend(self._list_folder(folder, folders_by_id))
+
+    def _search_folder(self, folder, folders_by_id, root_id):
+        """ Page through the search results for every file under a folder
+
+        Args:
+            folder (BoxObject): The folder
+            folders_by_id (dict): Folders created so far, by ID
+            root_id (str): ID of the root folder
+
+        Returns:
+            bool: Whether the files were found, or False if there are too many to page through
+        """
+        from boxsdk.config import API
+
+        url = '{0}/search'.format(API.BASE_API_URL)
+        offset = 0
+        while True:
+            response = resilience.guard.call('box:search', functools.partial(
+                self.client.make_request, 'GET', url, params={'query': self.search_query,
+                                                              'type': 'file',
+                                                              'content_types': 'name',
+                                                              'ancestor_folder_ids': folder.id,
+                                                              'limit': SEARCH_LIMIT,
+                                                              'offset': offset,
+                                                              'fields': 'id,name,path_collection'})).json()
+            if self._progress:
+                self._progress.requests += 1
+            if response.get('total_count', 0) > SEARCH_MAX_OFFSET:
+                return False
+
+            entries = response.get('entries', [])
+            if self._progress:
+                self._progress.items += len(entries)
+            for entry in entries:
+                parent = self._folder_from_path(entry['path_collection']['entries'], folders_by_id, root_id)
+                if parent:
+                    box_file = BoxObject(identifier=entry['id'], name=entry['name'], parent=parent)
+                    if self._in_shard(box_file, is_folder=False):
+                        self.files.append(box_file)
+
+            offset += len(entries)
+            if not entries or offset >= response.get('total_count', 0):
+                return True
+
+    def _list_folder(self, folder, folders_by_id):
+        """ List the items directly in a folder with too many files under it to search
+
+        Args:
+            folder (BoxObject): The folder
+            folders_by_id (dict): Folders created so far, by ID
+
+        Returns:
+            [BoxObject]: The folder's subfolders, to be searched
+        """
+        children = _retrieve_all_items(self.client.folder(folder_id=folder.id), self._progress)
+        subfolders = []
+        for child in children:
+            if child.type == 'folder':
+                child_folder = BoxObject(identifier=child.object_id, name=child.name, parent=folder)
+                if self._in_shard(child_folder, is_folder=True):
+                    folders_by_id[child.object_id] = child_folder
+                    self.folders.append(child_folder)
+                    subfolders.append(child_folder)
+            else:
+                child_file = BoxObject(identifier=child.object_id, name=child.name, parent=folder)
+                if self._in_shard(child_file, is_folder=False):
+                    self.files.append(child_file)
+                    if self._progress:
+                        self._progress.items += 1
+        return subfolders
+
+    def _folder_from_path(self, path_entries, folders_by_id, root_id):
+        """ Get the folder at the end of a path_collection, creating any folders not seen before
+
+        Args:
+            path_entries ([dict]): Folders from the top of Box down to the item's parent
+            folders_by_id (dict): Folders created so far, by ID
+            root_id (str): ID of the root folder
+
+        Returns:
+            BoxObject: The parent folder, or None if it isn't under the root
+        """
+        ids = [entry['id'] for entry in path_entries]
+        if root_id not in ids:
+            return None
+
+        parent = folders_by_id[root_id]
+        for entry in path_entries[ids.index(root_id) + 1:]:
+            folder = folders_by_id.get(entry['id'])
+            if folder is None:
+                folder = BoxObject(identifier=entry['id'], name=entry['name'], parent=parent)
+                if not self._in_shard(folder, is_folder=True):
+                    return None
+                folders_by_id[entry['id']] = folder
+                self.folders.append(folder)
+            parent = folder
+        return parent
 
     def apply_metadata(self, box_file, drive_file):
         """ Apply the metadata from a Drive file to a matched Box file, based on
@@ -247,23 +735,48 @@ class Box(object):
             box_file (BoxObject): File to which to apply the metadata
             drive_file (Drive.File): File from which to get the metadata
         """
+        from boxsdk import exception
 
         metadata = self.client.file(box_file.id).metadata('enterprise', 'legacyData')
+        if self._progress:
+            self._progress.requests += 1
         try:
-            if metadata.get() is None:
-                metadata.create({'owner': drive_file.owner.name,
-                                 'legacyCreatedDate': drive_file.created_time,
-                                 'legacyLastModifyingUser': drive_file.last_modified_by.name,
-                                 'legacyLastModifiedDate': drive_file.last_modified_time})
+            if resilience.guard.call('box:metadata', metadata.get) is None:
+                if self._progress:
+                    self._progress.requests += 1
+                metadata.create(metadata_values(drive_file))
                 return True
         except exception.BoxAPIException:
-            metadata.create({'owner': drive_file.owner.name,
-                             'legacyCreatedDate': drive_file.created_time,
-                             'legacyLastModifyingUser': drive_file.last_modified_by.name,
-                             'legacyLastModifiedDate': drive_file.last_modified_time})
+            if self._progress:
+                self._progress.requests += 1
+            metadata.create(metadata_values(drive_file))
             return True
         return False
 
+    def update_metadata(self, box_file, drive_file):
+        """ Overwrite the metadata of a Box file with the current values from its Drive file
+
+        Args:
+            box_file (BoxObject): File to which to apply the metadata
+            drive_file (Drive.File): File from which to get the metadata
+        """
+        from boxsdk import exception
+
+        metadata = self.client.file(box_file.id).metadata('enterprise', 'legacyData')
+        update = metadata.start_update()
+        for key, value in metadata_values(drive_file).items():
+            # 'add' replaces the value of a key which already exists
+            update.add('/' + key, value)
+        if self._progress:
+            self._progress.requests += 1
+        try:
+            metadata.update(update)
+        except exception.BoxAPIException:
+            # The metadata has been removed since it was written
+            if self._progress:
+                self._progress.requests += 1
+            metadata.create(metadata_values(drive_file))
+
     def check_metadata(self, box_file, metadata_name):
         """ Check if a file has metadata of the specified type
 
@@ -271,13 +784,28 @@ class Box(object):
             box_file (BoxObject): File to check
             metadata_name (str): Metadata type to check for
         """
+        from boxsdk import exception
 
         try:
-            self.client.file(box_file.id).metadata('enterprise', metadata_name).get()
+            metadata = self.client.file(box_file.id).metadata('enterprise', metadata_name)
+            resilience.guard.call('box:metadata', metadata.get)
             return True
         except exception.BoxAPIException:
             return False
 
+    def get_file_via_id(self, identifier):
+        """ Get a file via its Box ID
+
+        Args:
+            identifier (str): Box ID of the file
+
+        Returns:
+            BoxObject: The file, or None if it isn't in the Box
+        """
+        if self._files_by_id is None:
+            self.index_files()
+        return self._files_by_id.get(identifier)
+
     def get_file_via_path(self, path, logger=None):
         """ Get a file via its path
 
@@ -288,14 +816,61 @@ class Box(object):
         Returns:
             File: File at the specified path
         """
-        for file in self.files:
-            if file.path == path:
-                return file
+        if self._files_by_path is None:
+            self.index_files()
+        file = self._files_by_path.get(path)
+        if file:
+            return file
 
         if logger:
-            logger.error("Could not find file at <{0}> in Box.".format(path))
+            logger.error("Could not find file at <%s> in Box.", path)
         return None
 
+    def index_files(self):
+        """ Build the lookups of files by ID, by path and by the key of their path at each match level, rather
+        than on first use
+
+        Where several files share a path, the first one mapped is found by it. Where several share a key,
+        none is found by it; the key is recorded as ambiguous, along with the paths of the files holding it.
+        """
+        self._files_by_id = {file.id: file for file in self.files}
+        self._files_by_path = {}
+        self._files_by_key = {level: {} for level in match_keys.LEVELS}
+        self._ambiguous_keys = {level: {} for level in match_keys.LEVELS}
+        for file in self.files:
+            if file.path:
+                self._files_by_path.setdefault(file.path, file)
+                for level, key in match_keys.match_keys(file.path, self._match_level):
+                    holder = self._files_by_key[level].setdefault(key, file)
+                    if holder is not file:
+                        self._ambiguous_keys[level].setdefault(key, [holder.path]).append(file.path)
+
+    def match_file(self, path, mime_type=None):
+        """ Get the file at a path, falling back on looser match keys (up to the Box's match level) if no
+        file is at exactly that path
+
+        The lookup stops at the first level whose key is held by more than one file, rather than guess
+        between them or carry on to a looser level.
+
+        Args:
+            path (str): Path to the Drive file
+            mime_type (str, optional): MIME type of the Drive file (see match_keys.match_keys)
+
+        Returns:
+            (BoxObject, str, [str]): The file and the level it matched at, or None and the level at which the
+                key is ambiguous with the paths of the files holding it, or (None, None, None) if none matched
+        """
+        file = self.get_file_via_path(path)
+        if file:
+            return file, match_keys.EXACT, None
+        for level, key in match_keys.match_keys(path, self._match_level, mime_type=mime_type):
+            if key in self._ambiguous_keys[level]:
+                return None, level, self._ambiguous_keys[level][key]
+            file = self._files_by_key[level].get(key)
+            if file:
+                return file, level, None
+        return None, None, None
+
     def print_box(self, output_file=None):
         """ Print the Box, starting from a specified path
 
@@ -326,6 +901,21 @@ class Box(object):
                 self._print_folder(folder=subfolder, prefix=prefix, output_file=output_file)
 
 
+def metadata_values(drive_file):
+    """ Get the legacyData metadata values for a Drive file
+
+    Args:
+        drive_file (Drive.File): File from which to get the metadata
+
+    Returns:
+        dict: Metadata values, by template key
+    """
+    return {'owner': drive_file.owner.name,
+            'legacyCreatedDate': drive_file.created_time,
+            'legacyLastModifyingUser': drive_file.last_modified_by.name,
+            'legacyLastModifiedDate': drive_file.last_modified_time}
+
+
 class BoxObject(object):
     """ File representation class
 
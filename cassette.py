@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+""" Record and replay Drive and Box API traffic
+
+A Cassette holds the requests made during a run along with their responses
+and latencies, stored as gzipped JSON lines. While recording, the Drive
+service's http object and the Box client's network layer are wrapped so that
+every exchange is captured. While replaying, they are replaced by transports
+which serve the recorded responses back, with the original latencies or with
+time scaled, so a customer's workload can be re-run locally.
+
+OAuth token exchanges are never recorded. Names and email addresses can be
+pseudonymised with:
+
+    python3 cassette.py redact recorded.cassette redacted.cassette --salt SECRET
+
+"""
+
+# Imports
+from __future__ import print_function
+
+import argparse
+import collections
+import gzip
+import hashlib
+import hmac
+import json
+import re
+import threading
+import time
+
+from urllib.parse import urlencode, urlsplit, parse_qsl
+
+import httplib2
+
+CASSETTE_VERSION = 1
+# Requests to these URLs carry tokens or secrets and are never recorded
+UNRECORDED_URLS = re.compile(r'oauth2|/token|accounts\.google\.com')
+# Keys whose values are replaced when redacting a cassette
+REDACTED_NAME_KEYS = {'name', 'title'}
+REDACTED_PERSON_KEYS = {'displayName', 'owner', 'legacyLastModifyingUser'}
+REDACTED_EMAIL_KEYS = {'emailAddress', 'login'}
+
+
+def _request_key(service, method, url):
+    """ Build the key under which an exchange is recorded
+
+    The scheme and host are dropped and the query is sorted, so replays match
+    regardless of the endpoint or the order in which parameters were added.
+
+    Args:
+        service (str): 'drive' or 'box'
+        method (str): HTTP method
+        url (str): Full request URL
+
+    Returns:
+        str: The key
+    """
+    parts = urlsplit(url)
+    query = sorted(parse_qsl(parts.query, keep_blank_values=True))
+    return '{0} {1} {2}?{3}'.format(service, method.upper(), parts.path, urlencode(query))
+
+
+class Cassette(object):
+    """ A set of recorded API exchanges
+
+    Args:
+        path (str, optional): File the cassette is saved to or loaded from
+
+    Attributes:
+        interactions ([dict]): Recorded exchanges, in the order they were made
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.interactions = []
+        self._queues = None
+        self._lock = threading.Lock()
+
+    def record(self, service, method, url, status, headers, content, latency):
+        """ Add an exchange to the cassette
+
+        Args:
+            service (str): 'drive' or 'box'
+            method (str): HTTP method
+            url (str): Full request URL
+            status (int): Response status code
+            headers (dict): Response headers
+            content (bytes): Response body
+            latency (float): Seconds taken for the response
+        """
+        if UNRECORDED_URLS.search(url):
+            return
+        interaction = {'key': _request_key(service, method, url),
+                       'status': status,
+                       'headers': {name.lower(): value for name, value in headers.items()
+                                   if name.lower() in ('content-type', 'retry-after')},
+                       'body': content.decode('utf-8', 'replace') if content else '',
+                       'latency': round(latency, 4)}
+        with self._lock:
+            self.interactions.append(interaction)
+
+    def play(self, service, method, url):
+        """ Take the next recorded response for a request
+
+        Repeated requests (e.g. retries after a 429) are answered in the order they were recorded.
+
+        Args:
+            service (str): 'drive' or 'box'
+            method (str): HTTP method
+            url (str): Full request URL
+
+        Returns:
+            dict: The recorded exchange, or None if there is none left for this request
+        """
+        with self._lock:
+            if self._queues is None:
+                self._queues = collections.defaultdict(collections.deque)
+                for interaction in self.interactions:
+                    self._queues[interaction['key']].append(interaction)
+            queue = self._queues.get(_request_key(service, method, url))
+            return queue.popleft() if queue else None
+
+    def save(self, path=None):
+        """ Write the cassette as gzipped JSON lines
+
+        Args:
+            path (str, optional): File to write to, if not the cassette's own path
+        """
+        with gzip.open(path or self.path, 'wt', encoding='utf-8') as cassette_file:
+            cassette_file.write(json.dumps({'version': CASSETTE_VERSION}) + '\n')
+            for interaction in self.interactions:
+                cassette_file.write(json.dumps(interaction, separators=(',', ':')) + '\n')
+
+    @classmethod
+    def load(cls, path):
+        """ Read a cassette written by save()
+
+        Args:
+            path (str): File to read
+
+        Returns:
+            Cassette: The loaded cassette
+        """
+        cassette = cls(path)
+        with gzip.open(path, 'rt', encoding='utf-8') as cassette_file:
+            header = json.loads(cassette_file.readline())
+            if header.get('version') != CASSETTE_VERSION:
+                raise ValueError('Unsupported cassette version <{0}>'.format(header.get('version')))
+            for line in cassette_file:
+                cassette.interactions.append(json.loads(line))
+        return cassette
+
+
+class RecordingHttp(httplib2.Http):
+    """ httplib2 transport for the Drive service which records every exchange
+
+    Args:
+        cassette (Cassette): Cassette to record to
+
+    Attributes:
+        recording (bool): Marks the transport as recording, so nothing is served from local caches
+    """
+
+    recording = True
+
+    def __init__(self, cassette, *args, **kwargs):
+        super(RecordingHttp, self).__init__(*args, **kwargs)
+        self._cassette = cassette
+
+    def request(self, uri, method='GET', *args, **kwargs):
+        start = time.time()
+        response, content = super(RecordingHttp, self).request(uri, method, *args, **kwargs)
+        self._cassette.record('drive', method, uri, response.status, response, content, time.time() - start)
+        return response, content
+
+
+class ReplayHttp(object):
+    """ httplib2-compatible transport for the Drive service which serves a cassette
+
+    Args:
+        cassette (Cassette): Cassette to replay
+        speed (float, optional): Factor applied to the recorded latencies (0 for no delay)
+
+    Attributes:
+        replaying (bool): Marks the transport as offline, so no credentials are needed
+    """
+
+    replaying = True
+
+    def __init__(self, cassette, speed=1.0):
+        self._cassette = cassette
+        self._speed = speed
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        interaction = self._cassette.play('drive', method, uri)
+        if interaction is None:
+            raise KeyError('No recorded response for {0} {1}'.format(method, uri))
+        if self._speed:
+            time.sleep(interaction['latency'] * self._speed)
+        response = httplib2.Response(dict(interaction['headers'], status=str(interaction['status'])))
+        return response, interaction['body'].encode('utf-8')
+
+
+class RecordingNetwork(object):
+    """ Box network layer which records every exchange made through another network layer
+
+    Args:
+        network (Network): The network layer making the real requests
+        cassette (Cassette): Cassette to record to
+    """
+
+    def __init__(self, network, cassette):
+        self._network = network
+        self._cassette = cassette
+
+    def request(self, method, url, access_token, **kwargs):
+        start = time.time()
+        response = self._network.request(method, url, access_token, **kwargs)
+        full_url = url
+        if kwargs.get('params'):
+            full_url = '{0}?{1}'.format(url, urlencode(kwargs['params']))
+        self._cassette.record('box', method, full_url, response.status_code, response.headers,
+                              response.content, time.time() - start)
+        return response
+
+    def retry_after(self, delay, request_method, *args, **kwargs):
+        return self._network.retry_after(delay, request_method, *args, **kwargs)
+
+
+class _ReplayResponse(object):
+    """ Box network response served from a cassette """
+
+    def __init__(self, interaction, access_token):
+        self._interaction = interaction
+        self._access_token = access_token
+
+    def json(self):
+        return json.loads(self._interaction['body'])
+
+    @property
+    def content(self):
+        return self._interaction['body'].encode('utf-8')
+
+    @property
+    def status_code(self):
+        return self._interaction['status']
+
+    @property
+    def ok(self):
+        return self._interaction['status'] < 400
+
+    @property
+    def headers(self):
+        return self._interaction['headers']
+
+    @property
+    def response_as_stream(self):
+        return None
+
+    @property
+    def access_token_used(self):
+        return self._access_token
+
+
+class ReplayNetwork(object):
+    """ Box network layer which serves a cassette
+
+    Args:
+        cassette (Cassette): Cassette to replay
+        speed (float, optional): Factor applied to recorded latencies and Retry-After delays (0 for no delay)
+
+    Attributes:
+        replaying (bool): Marks the network layer as offline, so no credentials are needed
+    """
+
+    replaying = True
+
+    def __init__(self, cassette, speed=1.0):
+        self._cassette = cassette
+        self._speed = speed
+
+    def request(self, method, url, access_token, **kwargs):
+        full_url = url
+        if kwargs.get('params'):
+            full_url = '{0}?{1}'.format(url, urlencode(kwargs['params']))
+        interaction = self._cassette.play('box', method, full_url)
+        if interaction is None:
+            raise KeyError('No recorded response for {0} {1}'.format(method, full_url))
+        if self._speed:
+            time.sleep(interaction['latency'] * self._speed)
+        return _ReplayResponse(interaction, access_token)
+
+    def retry_after(self, delay, request_method, *args, **kwargs):
+        time.sleep(delay * self._speed)
+        return request_method(*args, **kwargs)
+
+
+class Redactor(object):
+    """ Replace names and email addresses with stable pseudonyms
+
+    Pseudonyms are keyed on a secret salt, so the same name always maps to the
+    same pseudonym within a cassette. Extensions, '/' or '002f' separators and
+    Box's ' - Modify' suffix are kept, so Drive and Box paths still match in the
+    same way after redaction.
+
+    Args:
+        salt (str): Secret used to derive the pseudonyms
+    """
+
+    _NAME_PARTS = re.compile(r'(/|002f)')
+
+    def __init__(self, salt):
+        self._salt = salt.encode('utf-8')
+
+    def _pseudonym(self, value):
+        digest = hmac.new(self._salt, value.encode('utf-8'), hashlib.sha256).hexdigest()[:12]
+        # Letters only, so a pseudonym can never contain '002f' or look like an extension
+        return ''.join(chr(ord('a') + int(char, 16)) for char in digest)
+
+    def name(self, name):
+        """ Redact a file or folder name
+
+        Args:
+            name (str): The original name
+
+        Returns:
+            str: The redacted name
+        """
+        suffix = ''
+        if name.endswith(' - Modify'):
+            name, suffix = name[:-len(' - Modify')], ' - Modify'
+        parts = []
+        for part in self._NAME_PARTS.split(name):
+            if part in ('/', '002f', ''):
+                parts.append(part)
+                continue
+            stripped = part.rstrip()
+            stem, dot, extension = stripped.rpartition('.')
+            if dot and stem and extension.isalnum() and len(extension) <= 5:
+                parts.append(self._pseudonym(stem) + '.' + extension)
+            else:
+                parts.append(self._pseudonym(stripped))
+            parts.append(part[len(stripped):])
+        return ''.join(parts) + suffix
+
+    def redact(self, value, key=None):
+        """ Recursively redact a decoded JSON value
+
+        Args:
+            value: The value to redact
+            key (str, optional): The key under which the value was found
+
+        Returns:
+            The redacted value
+        """
+        if isinstance(value, dict):
+            return {item_key: self.redact(item, item_key) for item_key, item in value.items()}
+        if isinstance(value, list):
+            return [self.redact(item, key) for item in value]
+        if isinstance(value, str):
+            if key in REDACTED_NAME_KEYS:
+                return self.name(value)
+            if key in REDACTED_PERSON_KEYS:
+                return 'Person ' + self._pseudonym(value)
+            if key in REDACTED_EMAIL_KEYS:
+                return self._pseudonym(value.lower()) + '@redacted.invalid'
+        return value
+
+    def redact_cassette(self, cassette):
+        """ Redact the JSON bodies of every exchange in a cassette
+
+        Args:
+            cassette (Cassette): Cassette to redact in place
+        """
+        for interaction in cassette.interactions:
+            try:
+                body = json.loads(interaction['body'])
+            except ValueError:
+                continue
+            interaction['body'] = json.dumps(self.redact(body), separators=(',', ':'))
+
+
+def build_arg_parser():
+    """ Build and return an args parser
+
+    Returns:
+        argparse: Args parser
+    """
+    parser = argparse.ArgumentParser(description='Inspect and redact recorded API cassettes.')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    redact_parser = subparsers.add_parser('redact', help='Pseudonymise names and email addresses')
+    redact_parser.add_argument('source', help='Cassette to redact')
+    redact_parser.add_argument('destination', help='File to write the redacted cassette to')
+    redact_parser.add_argument('--salt', required=True, help='Secret used to derive the pseudonyms')
+
+    summary_parser = subparsers.add_parser('summary', help='Summarise the requests in a cassette')
+    summary_parser.add_argument('source', help='Cassette to summarise')
+    return parser
+
+
+if __name__ == '__main__':
+    args = build_arg_parser().parse_args()
+    source_cassette = Cassette.load(args.source)
+    if args.command == 'redact':
+        Redactor(args.salt).redact_cassette(source_cassette)
+        source_cassette.save(args.destination)
+        print('Redacted {0} exchanges to {1}'.format(len(source_cassette.interactions), args.destination))
+    else:
+        counts = collections.Counter()
+        latency = collections.Counter()
+        for recorded in source_cassette.interactions:
+            service, method, path = recorded['key'].split(' ', 2)
+            # Group by endpoint, dropping IDs from the path
+            endpoint = '{0} {1} {2}'.format(service, method, re.sub(r'/(?!v\d+/|2\.0/)[^/?]*\d[^/?]*', '/{id}', path.split('?')[0]))
+            counts[endpoint] += 1
+            latency[endpoint] += recorded['latency']
+        for endpoint, count in counts.most_common():
+            print('{0:>8} {1:>8.3f}s avg  {2}'.format(count, latency[endpoint] / count, endpoint))
@@ -0,0 +1,369 @@
+# -*- coding: utf-8 -*-
+""" Long-running service which keeps the Drive and Box trees warm in memory
+
+Mapping Drive and Box takes most of a run, so a daemon maps them once, keeps
+them (and their lookups by path and ID) in memory, and answers questions about
+them over localhost HTTP or a Unix socket. The trees are rebuilt in the
+background every so often, and requests carry on against the old trees until
+the new ones are ready.
+
+Endpoints (every response is JSON):
+
+    GET  /status                    When the trees were built, their sizes and whether a rebuild is running
+    GET  /tree?path=D:/Folder       Paths of the Drive and Box files and folders under a path
+    GET  /match?path=D:/Folder/a    The Box match of a Drive file, and the metadata it would be given
+    POST /apply                     Match and write the metadata of the Drive files under {"path": ...}
+                                    ({"test": true} to only match them), one request at a time
+    POST /check                     Which Box files under {"path": ...} have {"metadata": ...}
+    POST /refresh                   Rebuild the trees now, in the background
+
+Usage:
+    python3 drive-to-box-migration-tool.py -u --daemon
+    curl 'http://localhost:8766/match?path=D:/Finance/Budget.xlsx'
+    curl -X POST -d '{"path": "D:/Finance"}' http://localhost:8766/apply
+
+"""
+
+# Imports
+from __future__ import print_function
+
+import json
+import os
+import socketserver
+import threading
+import time
+from collections import namedtuple
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import box_interface
+import migration
+
+DEFAULT_PORT = 8766
+DEFAULT_REFRESH = 1800  # Seconds between rebuilds of the trees (0 to only rebuild on request)
+
+# One build of the trees; requests hold on to the build they started with
+Trees = namedtuple('Trees', ['drive', 'box', 'built_at', 'generation'])
+
+
+class WarmTrees(object):
+    """ The Drive and Box trees, rebuilt on a background thread
+
+    Args:
+        build (callable): Maps Drive and Box, returning (Drive, Box)
+        refresh_interval (float, optional): Seconds between rebuilds (0 to only rebuild on request)
+        logger (logger, optional): Logging file
+
+    Attributes:
+        current (Trees): The latest build, or None before the first one
+        refreshing (bool): Whether a rebuild is running
+        last_error (Exception): Why the latest rebuild failed, or None if it didn't
+    """
+
+    def __init__(self, build, refresh_interval=DEFAULT_REFRESH, logger=None):
+        self.current = None
+        self.refreshing = False
+        self.last_error = None
+        self._build = build
+        self._refresh_interval = refresh_interval
+        self._logger = logger
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def start(self):
+        """ Build the trees, then keep rebuilding them in the background """
+        self._rebuild()
+        if self.last_error:
+            raise self.last_error
+        self._thread = threading.Thread(target=self._run, name='tree-refresh', daemon=True)
+        self._thread.start()
+
+    def refresh(self):
+        """ Start a rebuild now, unless one is running """
+        self._wake.set()
+
+    def stop(self):
+        """ Stop rebuilding, waiting for a running rebuild to finish """
+        self._stopped = True
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped:
+            self._wake.wait(self._refresh_interval or None)
+            self._wake.clear()
+            if not self._stopped:
+                self._rebuild()
+
+    def _rebuild(self):
+        self.refreshing = True
+        started = time.time()
+        try:
+            drive, box = self._build()
+            box.index_files()
+        except Exception as err:  # The old trees are kept
+            self.last_error = err
+            if self._logger:
+                self._logger.error('Failed to rebuild the trees: %s', err, exc_info=True)
+        else:
+            generation = self.current.generation + 1 if self.current else 1
+            # Swapped in whole, so a request sees either the old trees or the new ones
+            self.current = Trees(drive=drive, box=box, built_at=time.time(), generation=generation)
+            self.last_error = None
+            if self._logger:
+                self._logger.info('Built the trees (generation %s) in %.1fs', generation, time.time() - started)
+        finally:
+            self.refreshing = False
+
+
+class MigrationDaemon(object):
+    """ Answers the daemon's requests from the warm trees
+
+    Args:
+        warm_trees (WarmTrees): The trees
+        test_only (bool, optional): Whether to refuse to write metadata
+        logger (logger, optional): Logging file
+        memory_budget (int, optional): Approximate bytes of memory matching may use (see migrate_metadata)
+        temp_dir (str, optional): Directory for the on-disk runs when matching within a memory budget
+        make_writer (callable, optional): Builds a WriteBehindQueue for a Box, through which to write the
+            metadata
+    """
+
+    def __init__(self, warm_trees, test_only=True, logger=None, memory_budget=None, temp_dir=None,
+                 make_writer=None):
+        self._warm_trees = warm_trees
+        self._test_only = test_only
+        self._logger = logger
+        self._memory_budget = memory_budget
+        self._temp_dir = temp_dir
+        self._make_writer = make_writer
+        # Held through each apply, so two can't write to the same Box file at once
+        self._apply_lock = threading.Lock()
+
+    def status(self):
+        """ Describe the trees
+
+        Returns:
+            dict: Build time, generation and sizes of the trees, and whether a rebuild is running
+        """
+        trees = self._warm_trees.current
+        return {'built_at': trees.built_at,
+                'generation': trees.generation,
+                'drive_files': len(trees.drive.files),
+                'drive_folders': len(trees.drive.folders),
+                'box_files': len(trees.box.files),
+                'box_folders': len(trees.box.folders),
+                'refreshing': self._warm_trees.refreshing,
+                'last_error': str(self._warm_trees.last_error) if self._warm_trees.last_error else None,
+                'test_only': self._test_only}
+
+    def tree(self, path=None):
+        """ List the Drive and Box items under a path
+
+        Args:
+            path (str, optional): The path (e.g. "D:/Folder"), or None for everything
+
+        Returns:
+            dict: Sorted paths of the folders and files under the path, in Drive and in Box
+        """
+        trees = self._warm_trees.current
+
+        def paths(items):
+            return sorted(item.path for item in items if item.path and migration.under(item.path, path))
+
+        return {'drive': {'folders': paths(trees.drive.folders), 'files': paths(trees.drive.files)},
+                'box': {'folders': paths(trees.box.folders), 'files': paths(trees.box.files)},
+                'generation': trees.generation}
+
+    def match(self, path):
+        """ Find the Box match of a Drive file
+
+        Args:
+            path (str): Path to the file
+
+        Returns:
+            dict: Whether the file is in Drive and Box, its IDs, the Box path and match level it was found at
+                (or the paths of the Box files its key is ambiguous between), and the metadata it would be given
+        """
+        trees = self._warm_trees.current
+        drive_file = trees.drive.get_file_via_path(path)
+        box_file, level, candidates = trees.box.match_file(path, mime_type=drive_file.mime_type if drive_file else None)
+        return {'path': path,
+                'drive_id': drive_file.id if drive_file else None,
+                'box_id': box_file.id if box_file else None,
+                'box_path': box_file.path if box_file else None,
+                'level': level,
+                'ambiguous': candidates,
+                'matched': bool(drive_file and box_file),
+                'metadata': box_interface.metadata_values(drive_file) if drive_file else None,
+                'generation': trees.generation}
+
+    def apply(self, path=None, test_only=False):
+        """ Match the Drive files under a path, and write their metadata to Box
+
+        The files are matched by migration.migrate_metadata, as in a run of the tool. Applies are made one at a
+        time, while other requests carry on.
+
+        Args:
+            path (str, optional): The path, or None for everything
+            test_only (bool, optional): Whether to only match the files (always so if the daemon is test only)
+
+        Returns:
+            dict: The paths in each section of the report (see migration.print_report)
+        """
+        trees = self._warm_trees.current
+        test_only = test_only or self._test_only
+        with self._apply_lock:
+            writer = self._make_writer(trees.box) if self._make_writer and not test_only else None
+            try:
+                report = migration.migrate_metadata(box=trees.box,
+                                                    drive=trees.drive,
+                                                    logger=self._logger,
+                                                    test_only=test_only,
+                                                    memory_budget=self._memory_budget,
+                                                    temp_dir=self._temp_dir,
+                                                    writer=writer,
+                                                    subtree=path)
+            finally:
+                if writer:
+                    writer.close()
+        # The report's lists may be kept on disk (with a memory budget), so they're copied out as plain lists
+        report = {section: list(paths) for section, paths in report.items()}
+        report['test_only'] = test_only
+        report['generation'] = trees.generation
+        if self._logger:
+            self._logger.info('%s metadata under %s: %s matched, %s already had it, %s missed from Drive',
+                              'Matched' if test_only else 'Applied', path or 'the root', len(report['matched']),
+                              len(report['existing_metadata']), len(report['drive_missed']))
+        return report
+
+    def check(self, metadata_name, path=None):
+        """ Check which Box files under a path have metadata of a type
+
+        Args:
+            metadata_name (str): The metadata type
+            path (str, optional): The path, or None for everything
+
+        Returns:
+            dict: Sorted paths of the files with and without the metadata
+        """
+        trees = self._warm_trees.current
+        hits = []
+        misses = []
+        for box_file in trees.box.files:
+            if box_file.path and migration.under(box_file.path, path):
+                (hits if trees.box.check_metadata(box_file, metadata_name) else misses).append(box_file.path)
+        return {'found': sorted(hits), 'missing': sorted(misses), 'generation': trees.generation}
+
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    """ Route requests to the daemon """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        logger = self.server.logger
+        if logger:
+            logger.debug('%s %s', self.command, format % args)
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def _dispatch(self, method):
+        daemon = self.server.migration_daemon
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        body = {}
+        if method == 'POST':
+            length = int(self.headers.get('Content-Length') or 0)
+            try:
+                body = json.loads(self.rfile.read(length).decode('utf-8') or '{}') if length else {}
+            except ValueError:
+                self._send(400, {'error': 'The body isn\'t JSON'})
+                return
+
+        try:
+            if (method, url.path) == ('GET', '/status'):
+                self._send(200, daemon.status())
+            elif (method, url.path) == ('GET', '/tree'):
+                self._send(200, daemon.tree(params.get('path')))
+            elif (method, url.path) == ('GET', '/match'):
+                if 'path' not in params:
+                    self._send(400, {'error': 'A path is needed'})
+                else:
+                    self._send(200, daemon.match(params['path']))
+            elif (method, url.path) == ('POST', '/apply'):
+                self._send(200, daemon.apply(body.get('path'), test_only=bool(body.get('test'))))
+            elif (method, url.path) == ('POST', '/check'):
+                if 'metadata' not in body:
+                    self._send(400, {'error': 'A metadata type is needed'})
+                else:
+                    self._send(200, daemon.check(body['metadata'], body.get('path')))
+            elif (method, url.path) == ('POST', '/refresh'):
+                self.server.warm_trees.refresh()
+                self._send(202, {'refreshing': True})
+            else:
+                self._send(404, {'error': 'Unknown endpoint'})
+        except Exception as err:  # Reported to the caller, and the daemon carries on
+            if self.server.logger:
+                self.server.logger.error('Failed to answer %s %s: %s', method, self.path, err, exc_info=True)
+            self._send(500, {'error': str(err)})
+
+    def _send(self, status, payload):
+        content = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ HTTP server listening on a Unix socket """
+
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super(ThreadingUnixHTTPServer, self).get_request()
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return request, ('local', 0)
+
+
+def make_server(warm_trees, test_only=True, logger=None, host='localhost', port=DEFAULT_PORT, socket_path=None,
+                memory_budget=None, temp_dir=None, make_writer=None):
+    """ Create (but don't start) the daemon's server
+
+    Args:
+        warm_trees (WarmTrees): The trees, already started
+        test_only (bool, optional): Whether to refuse to write metadata
+        logger (logger, optional): Logging file
+        host (str, optional): Interface to listen on
+        port (int, optional): Port to listen on (0 picks a free port)
+        socket_path (str, optional): Listen on a Unix socket at this path instead of a port
+        memory_budget (int, optional): Approximate bytes of memory matching may use (see migrate_metadata)
+        temp_dir (str, optional): Directory for the on-disk runs when matching within a memory budget
+        make_writer (callable, optional): Builds a WriteBehindQueue for a Box, through which to write the
+            metadata
+
+    Returns:
+        socketserver.BaseServer: The server; call serve_forever() to start it
+    """
+    if socket_path:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, DaemonRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), DaemonRequestHandler)
+        server.daemon_threads = True
+    server.warm_trees = warm_trees
+    server.migration_daemon = MigrationDaemon(warm_trees, test_only=test_only, logger=logger,
+                                              memory_budget=memory_budget, temp_dir=temp_dir,
+                                              make_writer=make_writer)
+    server.logger = logger
+    return server
@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+""" Migrating many users of a domain in one run
+
+With domain-wide delegation, a Google service account can act as any user of
+the domain (see drive_interface.get_delegated_service), and a Box admin can
+act as any user of the enterprise through the As-User header (see
+box_interface.as_user). A UserScheduler runs the map-match-write pipeline of
+several users at once, each on a thread of its own with its own Drive service
+and Box client.
+
+Every user's requests to a service draw on one shared RateBudget, so the run
+as a whole stays within the service's quota however many users are running.
+Drive requests are metered by a budgeted_http transport, and Box requests by a
+BudgetedNetwork layer under the admin client, which every As-User client
+shares.
+
+Users file format (one email address per line; blank lines and lines
+starting with # are ignored):
+    alice@example.com
+    bob@example.com
+
+"""
+
+# Imports
+import concurrent.futures
+import threading
+import time
+
+DEFAULT_CONCURRENCY = 4  # Users migrated at once
+DEFAULT_DRIVE_RATE = 100  # Drive requests per second across every user (0 for no limit)
+DEFAULT_BOX_RATE = 15  # Box requests per second across every user (0 for no limit)
+BURST_SECONDS = 1  # A budget can save up this many seconds' worth of requests
+
+
+def read_users(path):
+    """ Read the email addresses of the users to migrate
+
+    Args:
+        path (str): Path to the users file
+
+    Returns:
+        [str]: The email addresses, in the order of the file, without duplicates
+
+    Raises:
+        ValueError: If the file lists no users
+    """
+    users = []
+    with open(path, 'r', encoding='utf-8') as users_file:
+        for line in users_file:
+            line = line.strip()
+            if line and not line.startswith('#') and line not in users:
+                users.append(line)
+    if not users:
+        raise ValueError('The users file <{0}> lists no users'.format(path))
+    return users
+
+
+class RateBudget(object):
+    """ A token bucket of requests per second, shared by every thread making requests to a service
+
+    Args:
+        rate (float): Requests per second (0 for no limit)
+        burst (float, optional): Most requests which can be made at once after a quiet spell. Defaults to
+            BURST_SECONDS worth of requests.
+
+    Attributes:
+        rate (float): Requests per second
+        requests (int): Requests made through the budget
+        waited (float): Total seconds requests were held back for
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.requests = 0
+        self.waited = 0.0
+        self._burst = burst if burst is not None else max(rate * BURST_SECONDS, 1)
+        self._tokens = self._burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Block until a request may be made """
+        with self._lock:
+            self.requests += 1
+            if not self.rate:
+                return
+            now = time.monotonic()
+            self._tokens = min(self._tokens + (now - self._updated) * self.rate, self._burst)
+            self._updated = now
+            # Take the token now, even if it is owed, so waiting threads queue up behind each other
+            self._tokens -= 1
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+            self.waited += delay
+        if delay:
+            time.sleep(delay)
+
+
+def budgeted_http(budget):
+    """ Build an httplib2 transport for the Drive service which draws on a rate budget for every request
+
+    httplib2 is only imported here, so it isn't loaded unless users are being migrated.
+
+    Args:
+        budget (RateBudget): The Drive budget
+
+    Returns:
+        httplib2.Http: The transport
+    """
+    import httplib2
+
+    class BudgetedHttp(httplib2.Http):
+        def request(self, uri, method='GET', *args, **kwargs):
+            budget.acquire()
+            return super(BudgetedHttp, self).request(uri, method, *args, **kwargs)
+
+    return BudgetedHttp()
+
+
+class BudgetedNetwork(object):
+    """ Box network layer which draws on a rate budget for every request made through another network layer
+
+    Args:
+        network (Network): The network layer making the real requests
+        budget (RateBudget): The Box budget
+    """
+
+    def __init__(self, network, budget):
+        self._network = network
+        self._budget = budget
+
+    def request(self, method, url, access_token, **kwargs):
+        self._budget.acquire()
+        return self._network.request(method, url, access_token, **kwargs)
+
+    def retry_after(self, delay, request_method, *args, **kwargs):
+        return self._network.retry_after(delay, request_method, *args, **kwargs)
+
+
+def budgeted_network(budget):
+    """ Build a network layer which meters every exchange with Box
+
+    Args:
+        budget (RateBudget): The Box budget
+
+    Returns:
+        BudgetedNetwork: The network layer
+    """
+    from boxsdk.network.default_network import DefaultNetwork
+
+    return BudgetedNetwork(DefaultNetwork(), budget)
+
+
+class UserScheduler(object):
+    """ Run a pipeline for each of several users, a few users at a time
+
+    A user whose pipeline raises is recorded as failed; the other users carry on.
+
+    Args:
+        run_user (callable): Called with a user's email address to run their pipeline. Its return value is
+            kept as the user's result.
+        concurrency (int, optional): Most users run at once
+        logger (logger, optional): Logging file
+
+    Attributes:
+        results (dict): Email address to the result of each user whose pipeline finished
+        failures (dict): Email address to the exception of each user whose pipeline failed
+    """
+
+    def __init__(self, run_user, concurrency=DEFAULT_CONCURRENCY, logger=None):
+        self.results = {}
+        self.failures = {}
+        self._run_user = run_user
+        self._concurrency = max(concurrency, 1)
+        self._logger = logger
+
+    def run(self, users):
+        """ Run the pipeline of every user, returning once they have all finished
+
+        Args:
+            users ([str]): Email addresses of the users
+
+        Returns:
+            bool: Whether every user's pipeline finished
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(self._concurrency, len(users)),
+                                                   thread_name_prefix='user') as pool:
+            futures = {pool.submit(self._run_user, user): user for user in users}
+            for future in concurrent.futures.as_completed(futures):
+                user = futures[future]
+                try:
+                    self.results[user] = future.result()
+                except Exception as err:  # Recorded, so the other users carry on
+                    self.failures[user] = err
+                    if self._logger:
+                        self._logger.error('Failed to migrate <%s>: %s', user, err, exc_info=True)
+                else:
+                    if self._logger:
+                        self._logger.info('Finished <%s> (%s of %s users done)', user,
+                                          len(self.results) + len(self.failures), len(users))
+        return not self.failures
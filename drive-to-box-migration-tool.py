@@ -12,12 +12,29 @@ from __future__ import print_function
 
 import os
 import argparse
+import atexit
+import concurrent.futures
 import logging
+import random
+import subprocess
+import sys
+import threading
 import time
 import drive_interface
 import box_interface
-
-from oauth2client import tools
+import daemon_server
+import delegation
+import drive_filter
+import ledger
+import log_setup
+import manifest
+import match_keys
+import migration
+import progress
+import resilience
+import sampling
+import shards
+import write_behind
 
 
 # Global variables
@@ -31,20 +48,39 @@ def build_arg_parser():
         argparse: Args parser
     """
     # Primary parser
-    parser = argparse.ArgumentParser(
-        description='Google Drive Migration Tool.', parents=[tools.argparser])
+    parser = argparse.ArgumentParser(description='Google Drive Migration Tool.')
 
-    # Hide all of the Google API options
-    for action in parser._actions:
-        if action.dest != 'help':
-            action.help = argparse.SUPPRESS
+    # Hidden Google API options, mirroring oauth2client.tools.argparser without importing it
+    parser.add_argument('--auth_host_name', default='localhost', help=argparse.SUPPRESS)
+    parser.add_argument('--noauth_local_webserver', action='store_true', default=False, help=argparse.SUPPRESS)
+    parser.add_argument('--auth_host_port', default=[8080, 8090], type=int, nargs='*', help=argparse.SUPPRESS)
+    parser.add_argument('--logging_level', default='ERROR',
+                        choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], help=argparse.SUPPRESS)
 
     parser.add_argument('-r', '--rootdrive', type=str, default=None, metavar='PATHTOROOT',
                         help='Path to folder within Drive to start in (e.g. "folder/subfolder")')
     parser.add_argument('-R', '--rootbox', type=str, default=None, metavar='PATHTOROOT',
                         help='Path to folder within Box to start in (e.g. "folder/subfolder")')
+    parser.add_argument('--manifest', type=str, default=None, metavar='FILENAME',
+                        help='Config file of (Drive root, Box root) pairs to migrate in one run, listing Drive once')
+    parser.add_argument('--shareddrives', action='store_true',
+                        help='Also migrate every shared drive, each to the Box folder of the same name')
+    parser.add_argument('--shareddrivesbox', type=str, default=None, metavar='PATHTOROOT',
+                        help='Path to the Box folder holding the folder of each shared drive (defaults to the root)')
+    parser.add_argument('--listingthreads', type=int, default=drive_interface.LISTING_THREADS, metavar='COUNT',
+                        help='Shared drives listed at once')
+    parser.add_argument('--sharedwithme', type=str, default=None, metavar='FOLDERNAME',
+                        help='Put items shared with you from outside your Drive in a folder of this name at the root')
     parser.add_argument('-l', '--loglevel', type=str, default=logging.INFO,
                         help='Logging level for output')
+    parser.add_argument('--logsample', type=int, default=1, metavar='N',
+                        help='Only log one in every N per-item debug messages of each kind')
+    parser.add_argument('--lograte', type=float, default=0, metavar='PERSECOND',
+                        help='Maximum per-item debug messages of each kind logged per second (0 for no limit)')
+    parser.add_argument('--logmaxbytes', type=int, default=log_setup.DEFAULT_MAX_BYTES, metavar='BYTES',
+                        help='Size at which the log file is rotated and compressed (0 to never rotate)')
+    parser.add_argument('--logbackups', type=int, default=log_setup.DEFAULT_BACKUP_COUNT, metavar='COUNT',
+                        help='Number of compressed log files to keep')
 
     # Function group
     group = parser.add_mutually_exclusive_group(required=True)
@@ -63,6 +99,17 @@ def build_arg_parser():
     group.add_argument('-k', '--checkmetadata', type=str, default=None, metavar='METADATANAME',
                        help='Check which files within a Box directory have metadata of the specified type')
 
+    # Checking a sample of the files for metadata
+    parser.add_argument('--sample', type=int, default=0, metavar='SIZE',
+                        help='Check a random sample of this many files per folder and file type with -k, estimating '
+                             'the coverage of the rest (0 to check every file)')
+    parser.add_argument('--escalate', type=float, default=sampling.ESCALATE_MISS_RATE, metavar='RATE',
+                        help='Check every file of a folder and file type whose sampled miss rate is above this')
+    parser.add_argument('--stratumdepth', type=int, default=sampling.STRATUM_DEPTH, metavar='LEVELS',
+                        help='Folder levels below the root which the sample is split by')
+    parser.add_argument('--sampleseed', type=int, default=None, metavar='SEED',
+                        help='Random seed for the sample, to repeat an earlier check')
+
     # Verbose printing
     parser.add_argument('-v', '--verbose', action='store_true',
                         help='Verbose printing of the drive tree')
@@ -73,166 +120,455 @@ def build_arg_parser():
                         help='Save any printed information to a file.')
     parser.add_argument('-c', '--credentials', action='store_true',
                         help='Force a reset of the drive/box web credentials')
+    parser.add_argument('--guidedcrawl', action='store_true',
+                        help='Only crawl Box folders which also exist in Drive. Must be used with the update option')
+    parser.add_argument('--ledger', type=str, default=None, metavar='FILENAME',
+                        help='Ledger of files migrated by earlier runs; unchanged files are skipped and new ones recorded')
+    parser.add_argument('--memorybudget', type=int, default=0, metavar='MB',
+                        help='Match paths through sorted files on disk, using about this much memory (0 to match in memory)')
+    parser.add_argument('--tempdir', type=str, default=None, metavar='DIRECTORY',
+                        help='Directory for the sorted files used with --memorybudget')
+    parser.add_argument('--matchlevel', type=str, default=match_keys.EXACT, choices=match_keys.LEVELS,
+                        help='Match Drive files missing from Box at their exact path by looser keys of their names, '
+                             'up to this level (ignoring Unicode form, then case, then spacing and export suffixes)')
+    parser.add_argument('--writebehind', type=int, default=0, metavar='COUNT',
+                        help='Write metadata in the background, this many writes at a time, while matching carries '
+                             'on (0 to write each file as it is matched)')
+    parser.add_argument('--writebatch', type=int, default=write_behind.BATCH_SIZE, metavar='SIZE',
+                        help='Most metadata writes sent in one batch with --writebehind')
+    parser.add_argument('--writerate', type=float, default=0, metavar='PERSECOND',
+                        help='Metadata writes per second with --writebehind (0 for no limit; --users runs are '
+                             'already held to --boxrate)')
+    parser.add_argument('--boxstrategy', type=str, default=box_interface.WALK, choices=box_interface.STRATEGIES,
+                        help='Map Box by walking every folder, by searching for every file, or pick automatically')
+    parser.add_argument('--boxsearchquery', type=str, default=None, metavar='QUERY',
+                        help='Box search query used to find files (defaults to the file extensions found in Drive)')
+
+    # Splitting the migration between worker processes
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--coordinator', type=str, default=None, metavar='QUEUEFILE',
+                       help='Split the migration into shards by top level folder, queued in this file for workers')
+    group.add_argument('--worker', type=str, default=None, metavar='QUEUEFILE',
+                       help='Migrate shards from the queue file of a coordinator')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, metavar='COUNT',
+                        help='Worker processes started by the coordinator (0 to only use workers started separately)')
+
+    # Migrating many users through domain-wide delegation
+    parser.add_argument('--users', type=str, default=None, metavar='FILENAME',
+                        help='File of user email addresses to migrate in one run, acting as each user in Drive and Box')
+    parser.add_argument('--serviceaccount', type=str, default=None, metavar='KEYFILE',
+                        help='Key file of a service account with domain-wide delegation, for --users')
+    parser.add_argument('--concurrentusers', type=int, default=delegation.DEFAULT_CONCURRENCY, metavar='COUNT',
+                        help='Users migrated at once')
+    parser.add_argument('--driverate', type=float, default=delegation.DEFAULT_DRIVE_RATE, metavar='PERSECOND',
+                        help='Drive requests per second across every user (0 for no limit)')
+    parser.add_argument('--boxrate', type=float, default=delegation.DEFAULT_BOX_RATE, metavar='PERSECOND',
+                        help='Box requests per second across every user (0 for no limit)')
+    parser.add_argument('--reportdir', type=str, default=None, metavar='DIRECTORY',
+                        help='Write the report of each user to a file named after them in this directory')
+
+    # Long-running service
+    parser.add_argument('--daemon', action='store_true',
+                        help='Map Drive and Box once and keep them in memory, answering requests about them until '
+                             'interrupted. Must be used with the update option')
+    parser.add_argument('--daemonport', type=int, default=daemon_server.DEFAULT_PORT, metavar='PORT',
+                        help='Localhost port the daemon listens on')
+    parser.add_argument('--daemonsocket', type=str, default=None, metavar='PATH',
+                        help='Listen on a Unix socket at this path instead of a port')
+    parser.add_argument('--refresh', type=float, default=daemon_server.DEFAULT_REFRESH, metavar='SECONDS',
+                        help='Seconds between the daemon\'s rebuilds of Drive and Box (0 to only rebuild on request)')
+
+    # Slow and failing endpoints
+    parser.add_argument('--hedge', type=float, default=resilience.HEDGE_PERCENTILE, metavar='PERCENTILE',
+                        help='Send a duplicate of a read request which is slower than this percentile of recent '
+                             'requests, using whichever answers first (0 to never hedge)')
+    parser.add_argument('--breakerfailures', type=int, default=resilience.FAILURE_THRESHOLD, metavar='COUNT',
+                        help='Failed requests in a row after which an endpoint\'s requests are held back '
+                             '(0 to never hold them back)')
+    parser.add_argument('--breakerreset', type=float, default=resilience.RESET_TIMEOUT, metavar='SECONDS',
+                        help='Seconds to hold back the requests to a failing endpoint before trying it again')
+
+    # Alternative API endpoints
+    parser.add_argument('--driveapi', type=str, default=None, metavar='URL',
+                        help='Use a Drive API stand-in at this URL instead of Google (e.g. stub_server.py)')
+    parser.add_argument('--boxapi', type=str, default=None, metavar='URL',
+                        help='Use a Box API stand-in at this URL instead of api.box.com (e.g. stub_server.py)')
+
+    # Recording and replaying API traffic
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--record', type=str, default=None, metavar='CASSETTE',
+                       help='Record every Drive and Box request and response to a cassette file')
+    group.add_argument('--replay', type=str, default=None, metavar='CASSETTE',
+                       help='Serve Drive and Box responses from a recorded cassette instead of the APIs')
+    parser.add_argument('--replayspeed', type=float, default=1.0, metavar='FACTOR',
+                        help='Factor applied to recorded latencies when replaying (0 for no delay)')
+
+    # Filtering the Drive files to migrate
+    parser.add_argument('--filterfile', type=str, default=None, metavar='FILENAME',
+                        help='Config file with a [filter] section of the filter options below')
+    parser.add_argument('--mimetypes', type=str, default=None, metavar='TYPES',
+                        help='Comma separated MIME types to include (e.g. "application/pdf,image/*")')
+    parser.add_argument('--excludemimetypes', type=str, default=None, metavar='TYPES',
+                        help='Comma separated MIME types to skip (e.g. "application/vnd.google-apps.form,video/*")')
+    parser.add_argument('--modifiedafter', type=str, default=None, metavar='TIME',
+                        help='Only include files last modified after this date or timestamp (UTC)')
+    parser.add_argument('--modifiedbefore', type=str, default=None, metavar='TIME',
+                        help='Only include files last modified before this date or timestamp (UTC)')
+    parser.add_argument('--createdafter', type=str, default=None, metavar='TIME',
+                        help='Only include files created after this date or timestamp (UTC)')
+    parser.add_argument('--createdbefore', type=str, default=None, metavar='TIME',
+                        help='Only include files created before this date or timestamp (UTC)')
+    parser.add_argument('--owners', type=str, default=None, metavar='EMAILS',
+                        help='Comma separated email addresses; only include files owned by one of them')
+    parser.add_argument('--names', type=str, default=None, metavar='GLOBS',
+                        help='Comma separated name patterns; only include files matching one of them')
+    parser.add_argument('--excludenames', type=str, default=None, metavar='GLOBS',
+                        help='Comma separated name patterns; skip files matching any of them')
+
+    # Progress reporting
+    parser.add_argument('--progress', type=float, default=progress.DEFAULT_INTERVAL, metavar='SECONDS',
+                        help='Seconds between progress reports while mapping and migrating (0 to disable)')
+    parser.add_argument('--statusfile', type=str, default=None, metavar='FILENAME',
+                        help='Keep a JSON status file with the current progress, for detecting stalled runs')
     return parser
 
 
-def migrate_metadata(box, drive, print_details=False, print_file=None, logger=None, test_only=True):
-    """ Move the metadata from Drive to Box
+def worker_command(args):
+    """ Build the command line of a worker process for the coordinator's queue
 
     Args:
-        box (Box): The box object for metadata to be migrated to
-        drive (Drive): The drive object for metadata to be migrated from
-        print_details (bool, optional): Whether to print details of matched, missed, and duplicate files
-        print_file (file, optional): The file to which any logging should be printed
-        logger (logger, optional): Logging file
-        test_only (bool, optional): Whether to update the metadata in Box
-    """
-
-    if logger:
-        logger.debug('Matching files between Drive:/{0} and Box:/{1}'.format(drive.root, box.path))
-
-    matched_files = []
-    existing_metadata_files = []
-    box_missed_files = []
-    drive_missed_files = []
-    duplicate_files = []
-
-    for box_file in box.files:
-        if box_file.path:
-            box_missed_files.append(box_file.path)
-
-    for drive_file in drive.files:
-        if drive_file.path:
-            box_file = box.get_file_via_path(drive_file.path, logger=None)
-            if box_file:
-                if not test_only:
-                    if box.apply_metadata(box_file, drive_file):
-                        matched_files.append(drive_file.path)
-                        if logger:
-                            logger.debug('Wrote metadata at {0}'.format(drive_file.path))
-                    else:
-                        existing_metadata_files.append(drive_file.path)
-                        if logger:
-                            logger.debug('Metadata already exists at {0}'.format(drive_file.path))
-                else:
-                    matched_files.append(drive_file.path)
-                    if logger:
-                        logger.debug('Matched metadata at {0}'.format(drive_file.path))
-                try:
-                    box_missed_files.remove(box_file.path)
-                except ValueError:
-                    # Add to the duplicates list if we've already matched a file at this path
-                    duplicate_files.append(box_file.path)
-                    if logger:
-                        logger.debug('Found a duplicate at {0}'.format(drive_file.path))
+        args (argparse.Namespace): The coordinator's arguments
 
-            else:
-                drive_missed_files.append(drive_file.path)
-                if logger:
-                    logger.debug('Failed to match file at {0}'.format(drive_file.path))
-
-    if print_details:
-        if test_only:
-            print_list(list_to_print=matched_files,
-                       header_message='Matched paths for {0} Files:'.format(str(len(matched_files))),
-                       print_file=print_file)
-
-        else:
-            print_list(list_to_print=existing_metadata_files,
-                       header_message='Found existing metadata for {0} matched Files:'.format(str(len(existing_metadata_files))),
-                       print_file=print_file)
+    Returns:
+        [str]: The command line
+    """
+    loglevel = logging.getLevelName(args.loglevel) if isinstance(args.loglevel, int) else args.loglevel
+    command = [sys.executable, os.path.abspath(__file__), '-u' if args.update else '-t',
+               '--worker', args.coordinator,
+               '--loglevel', loglevel,
+               '--logsample', str(args.logsample),
+               '--lograte', str(args.lograte),
+               '--logmaxbytes', str(args.logmaxbytes),
+               '--logbackups', str(args.logbackups),
+               '--memorybudget', str(args.memorybudget),
+               '--boxstrategy', args.boxstrategy,
+               '--matchlevel', args.matchlevel,
+               '--writebehind', str(args.writebehind),
+               '--writebatch', str(args.writebatch),
+               '--writerate', str(args.writerate),
+               '--progress', str(args.progress),
+               '--hedge', str(args.hedge),
+               '--breakerfailures', str(args.breakerfailures),
+               '--breakerreset', str(args.breakerreset)]
+    for flag, value in (('--ledger', args.ledger),
+                        ('--tempdir', args.tempdir),
+                        ('--boxsearchquery', args.boxsearchquery),
+                        ('--boxapi', args.boxapi)):
+        if value:
+            command.extend([flag, value])
+    if args.guidedcrawl:
+        command.append('--guidedcrawl')
+    return command
+
+
+def map_box(args, src_drive, root_box, box_connection, progress_reporter=None, shard=None, logger=logging):
+    """ Map the destination Box for a mapped Drive
 
-            print_list(list_to_print=matched_files,
-                       header_message='Added metadata for {0} matched Files:'.format(str(len(matched_files))),
-                       print_file=print_file)
+    Args:
+        args (argparse.Namespace): Parsed arguments
+        src_drive (Drive): The source Drive
+        root_box (str): Path to the folder within Box to start in
+        box_connection (dict): Where to send Box API requests, or the client to send them through
+        progress_reporter (ProgressReporter, optional): Reporter tracking the mapping
+        shard (Shard, optional): Only map this shard of the Box
+        logger (logger, optional): Logging file
 
-        print_list(list_to_print=drive_missed_files,
-                   header_message='Failed to Match {0} File paths from Drive:'.format(str(len(drive_missed_files))),
-                   print_file=print_file)
+    Returns:
+        Box: The destination Box
+    """
+    logger.info("Mapping Box at path: %s", root_box if root_box else 'root')
+    strategy = args.boxstrategy
+    search_query = args.boxsearchquery
+    if not search_query and strategy != box_interface.WALK:
+        names = [drive_file.name for drive_file in src_drive.files]
+        search_query = box_interface.extension_query(names)
+        unsearchable = len(box_interface.unsearchable_names(names))
+        if unsearchable and strategy == box_interface.AUTO:
+            # Searching would silently miss these files, so don't choose it
+            logger.warning('Mapping Box by walking the folders, as %s files in Drive have no extension for a '
+                           'search to find', unsearchable)
+            strategy = box_interface.WALK
+        elif unsearchable:
+            logger.warning('%s files in Drive have no extension, so searching Box won\'t find them', unsearchable)
+    return box_interface.Box(path_prefix=src_drive.path_prefix,
+                             root_directory=root_box,
+                             reset_cred=args.credentials,
+                             logger=logger,
+                             progress=progress_reporter,
+                             guide_paths=src_drive.folder_paths() if args.guidedcrawl else None,
+                             strategy=strategy,
+                             search_query=search_query,
+                             expected_counts=(len(src_drive.folders), len(src_drive.files)),
+                             shard=shard,
+                             match_level=args.matchlevel,
+                             **box_connection)
+
+
+def make_writer(args, dest_box, logger=logging):
+    """ Build the write-behind queue through which to write metadata to a Box, if asked for
 
-        print_list(list_to_print=box_missed_files,
-                   header_message='Failed to Match {0} File pathss from Box:'.format(str(len(box_missed_files))),
-                   print_file=print_file)
+    Args:
+        args (argparse.Namespace): Parsed arguments
+        dest_box (Box): The destination Box
+        logger (logger, optional): Logging file
 
-        print_list(list_to_print=duplicate_files,
-                   header_message='Found {0} Duplicate Files:'.format(str(len(duplicate_files))),
-                   print_file=print_file)
+    Returns:
+        WriteBehindQueue: The queue, or None if metadata is written as each file is matched
+    """
+    if not args.writebehind or args.testmigrate:
+        return None
+    return write_behind.WriteBehindQueue(dest_box,
+                                         writers=args.writebehind,
+                                         batch_size=args.writebatch,
+                                         budget=delegation.RateBudget(args.writerate) if args.writerate else None,
+                                         logger=logger)
 
 
-def check_metadata(box, metadata_name, print_file=None, logger=None):
-    """ Check for metadata of the specified type on files in Box
+def migrate(args, src_drive, dest_box, output_file=None, progress_reporter=None, migration_ledger=None,
+            print_details=None, logger=logging):
+    """ Migrate the metadata from a mapped Drive to a mapped Box
 
     Args:
-        box (Box): The list to be printed
-        metadata_name (str): The name of the metadata to search for
-        print_file (file, optional): The file to which any logging should be printed
+        args (argparse.Namespace): Parsed arguments
+        src_drive (Drive): The source Drive
+        dest_box (Box): The destination Box
+        output_file (file, optional): File to which to print the report
+        progress_reporter (ProgressReporter, optional): Reporter tracking the migration
+        migration_ledger (Ledger, optional): Ledger of files migrated by earlier runs
+        print_details (bool, optional): Whether to print the report (defaults to the printall option)
         logger (logger, optional): Logging file
-    """
 
-    hits = []
-    misses = []
-    for file in box.files:
-        if box.check_metadata(file, metadata_name):
-            hits.append(file.path)
-            if logger:
-                logger.debug('Found metadata for {0}'.format(file.path))
-        else:
-            misses.append(file.path)
-            if logger:
-                logger.debug('Failed to find metadata for {0}'.format(file.path))
+    Returns:
+        dict: The paths in each section of the report
+    """
+    logger.info("Updating...")
+    writer = make_writer(args, dest_box, logger)
+    try:
+        return migration.migrate_metadata(box=dest_box,
+                                          drive=src_drive,
+                                          print_details=args.printall if print_details is None else print_details,
+                                          print_file=output_file,
+                                          test_only=args.testmigrate,
+                                          progress_reporter=progress_reporter,
+                                          ledger=migration_ledger,
+                                          memory_budget=args.memorybudget * 1024 * 1024,
+                                          temp_dir=args.tempdir,
+                                          writer=writer)
+    finally:
+        if writer:
+            # Writes already accepted are sent (and recorded in the ledger) even if the migration was stopped
+            writer.close()
+
+
+def map_and_migrate(args, src_drive, root_box, box_connection, output_file=None, progress_reporter=None,
+                    migration_ledger=None, shard=None):
+    """ Map the destination Box and migrate the metadata to it from a mapped Drive
 
-    print_list(list_to_print=hits,
-               header_message='Found metadata for {0} File Paths:'.format(str(len(hits))),
-               print_file=print_file)
+    Args:
+        args (argparse.Namespace): Parsed arguments
+        src_drive (Drive): The source Drive
+        root_box (str): Path to the folder within Box to start in
+        box_connection (dict): Where to send Box API requests
+        output_file (file, optional): File to which to print the report
+        progress_reporter (ProgressReporter, optional): Reporter tracking the mapping and migration
+        migration_ledger (Ledger, optional): Ledger of files migrated by earlier runs
+        shard (Shard, optional): Only map and migrate this shard of the Box
 
-    print_list(list_to_print=misses,
-               header_message='Failed to find metadata for {0} File Paths:'.format(str(len(misses))),
-               print_file=print_file)
+    Returns:
+        dict: The paths in each section of the report
+    """
+    dest_box = map_box(args, src_drive, root_box, box_connection, progress_reporter=progress_reporter, shard=shard)
+    return migrate(args, src_drive, dest_box,
+                   output_file=output_file,
+                   progress_reporter=progress_reporter,
+                   migration_ledger=migration_ledger)
 
 
-def print_list(list_to_print, header_message=None, footer_message=None, prefix='\t', print_file=None):
-    """ Sort and print out a list of strings, along with optional header and footer messages
+def migrate_pairs(args, root_pairs, src_drives, box_connection, output_file=None, progress_reporter=None):
+    """ Map the Box root of each pair together, then migrate each pair in turn, with a report for each
 
     Args:
-        list_to_print ([String]): The list to be printed
-        prefix (String, optional): The prefix to put in front of each item in the list. Default is a tab
-        print_file (file, optional): The file to which any logging should be printed
-        header_message (String, optional): A message to be displayed before the list is printed
-        footer_message (String, optional): A message to be displayed after the list is printed
+        args (argparse.Namespace): Parsed arguments
+        root_pairs ([RootPair]): The (Drive root, Box root) pairs
+        src_drives ([Drive]): The source Drive of each pair. Each is dropped once its pair is migrated.
+        box_connection (dict): Where to send Box API requests
+        output_file (file, optional): File to which to print the reports of pairs without a report file
+        progress_reporter (ProgressReporter, optional): Reporter tracking the mapping and migration
     """
-
-    list_to_print.sort()
-    if header_message:
-        print(header_message, file=print_file)
-    for list_item in list_to_print:
-        if list_item:
-            print((prefix + list_item), file=print_file)
-    if footer_message:
-        print(footer_message, file=print_file)
+    # Log in to Box once, then crawl the Box roots together through the one client
+    box_client = {'client': box_interface.get_client(args.credentials, logging, **box_connection)}
+    crawl_progress = None
+    if progress_reporter:
+        # One phase for every crawl, so they don't reset each other's counts
+        progress_reporter.begin_phase('box-crawl')
+        crawl_progress = progress.SharedPhase(progress_reporter)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(root_pairs), manifest.CRAWL_THREADS),
+                                               thread_name_prefix='box-crawl') as crawl_pool:
+        dest_boxes = list(crawl_pool.map(
+            lambda pair, src_drive: map_box(args, src_drive, pair.root_box, box_client, crawl_progress),
+            root_pairs, src_drives))
+
+    migration_ledger = None
+    if args.ledger:
+        migration_ledger = ledger.Ledger(args.ledger)
+        logging.info('Using the ledger %s of %s migrated files', args.ledger, len(migration_ledger))
+    try:
+        for index, pair in enumerate(root_pairs):
+            logging.info('Migrating <%s>: Drive at path: %s to Box at path: %s', pair.name,
+                         pair.root_drive if pair.root_drive else 'root', pair.root_box if pair.root_box else 'root')
+            pair_file = output_file
+            if pair.report_file:
+                pair_file = open(pair.report_file, 'w', encoding='utf-8')
+            elif args.printall:
+                print('Report for <{0}>:'.format(pair.name), file=output_file)
+            try:
+                report = migrate(args, src_drives[index], dest_boxes[index],
+                                 output_file=pair_file,
+                                 progress_reporter=progress_reporter,
+                                 migration_ledger=migration_ledger,
+                                 print_details=args.printall or bool(pair.report_file))
+            finally:
+                if pair.report_file:
+                    pair_file.close()
+            logging.info('Finished <%s>: %s matched, %s missed from Drive, %s missed from Box', pair.name,
+                         len(report['matched']) + len(report['existing_metadata']),
+                         len(report['drive_missed']), len(report['box_missed']))
+            # Free each pair's trees once it is done with
+            src_drives[index] = dest_boxes[index] = None
+    finally:
+        if migration_ledger is not None:
+            migration_ledger.close()
 
 
 if __name__ == '__main__':
     # Args parsing
-    args = build_arg_parser().parse_args()
+    parser = build_arg_parser()
+    args = parser.parse_args()
 
     # Setup logger
     timestr = time.strftime("%Y%m%d-%H%M%S")
     if not os.path.exists('logs'):
         os.makedirs('logs')
-    logging.basicConfig(handlers=[logging.FileHandler('logs/'+timestr+'.log', 'w', 'utf-8')], level=logging.DEBUG)
+    if args.worker:
+        # Workers started together would otherwise share a log file
+        timestr = timestr + '-' + str(os.getpid())
+    log_listener = log_setup.setup_logging('logs/' + timestr + '.log',
+                                           console_level=args.loglevel,
+                                           sample_every=args.logsample,
+                                           max_per_second=args.lograte,
+                                           max_bytes=args.logmaxbytes,
+                                           backup_count=args.logbackups)
+    atexit.register(log_listener.stop)
     # Suppress all the google error messages
     logging.getLogger('googleapiclient').setLevel(logging.CRITICAL)
     logging.getLogger('oauth2client.transport').setLevel(logging.CRITICAL)
     logging.getLogger('oauth2client.client').setLevel(logging.CRITICAL)
-    handler = logging.StreamHandler()
-    handler.setLevel(args.loglevel)
-    logging.getLogger().addHandler(handler)
 
     # Log args
     logging.info('Starting Google Drive Migration Tool')
     log_arg = logging.getLogger('args')
     log_arg.debug(args)
 
+    try:
+        file_filter = drive_filter.DriveFilter.from_args(args)
+    except (ValueError, FileNotFoundError) as err:
+        parser.error('invalid filter: {0}'.format(err))
+    if file_filter:
+        logging.info('Filtering Drive files with %s', file_filter)
+    if args.boxstrategy == box_interface.SEARCH and not args.boxsearchquery and not (args.update or args.testmigrate):
+        parser.error('--boxstrategy search needs a --boxsearchquery unless used with the update option')
+    if (args.coordinator or args.worker) and not (args.update or args.testmigrate):
+        parser.error('--coordinator and --worker must be used with the update option')
+    if (args.coordinator or args.worker) and (args.record or args.replay):
+        parser.error('--coordinator and --worker can\'t be used with --record or --replay')
+
+    if args.memorybudget and args.matchlevel != match_keys.EXACT:
+        parser.error('--matchlevel can\'t be used with --memorybudget')
+    if args.writebehind < 0 or args.writebatch < 1:
+        parser.error('--writebehind must be 0 or more, and --writebatch 1 or more')
+    if args.sample and not args.checkmetadata:
+        parser.error('--sample must be used with -k')
+    if not 0 <= args.hedge < 100:
+        parser.error('--hedge must be a percentile from 0 to 100')
+
+    root_pairs = None
+    if args.manifest:
+        if not (args.update or args.testmigrate):
+            parser.error('--manifest must be used with the update option')
+        if args.rootdrive or args.rootbox or args.coordinator or args.worker:
+            parser.error('--manifest can\'t be used with --rootdrive, --rootbox, --coordinator or --worker')
+        try:
+            root_pairs = manifest.read_manifest(args.manifest, PATH_ROOT)
+        except (ValueError, FileNotFoundError) as err:
+            parser.error('invalid manifest: {0}'.format(err))
+
+    if args.shareddrives and not (args.update or args.testmigrate):
+        parser.error('--shareddrives must be used with the update option')
+    if (args.shareddrives or args.sharedwithme) and (args.coordinator or args.worker):
+        parser.error('--shareddrives and --sharedwithme can\'t be used with --coordinator or --worker')
+
+    user_emails = None
+    if args.users:
+        if not (args.update or args.testmigrate):
+            parser.error('--users must be used with the update option')
+        if not args.serviceaccount:
+            parser.error('--users needs a --serviceaccount key file')
+        if root_pairs or args.shareddrives or args.coordinator or args.worker or args.record or args.replay:
+            parser.error('--users can\'t be used with --manifest, --shareddrives, --coordinator, --worker, '
+                         '--record or --replay')
+        try:
+            user_emails = delegation.read_users(args.users)
+        except (ValueError, IOError) as err:
+            parser.error('invalid users file: {0}'.format(err))
+
+    if args.daemon:
+        if not (args.update or args.testmigrate):
+            parser.error('--daemon must be used with the update option')
+        if (root_pairs or args.shareddrives or args.users or args.coordinator or args.worker or args.record or
+                args.ledger):
+            parser.error('--daemon can\'t be used with --manifest, --shareddrives, --users, --coordinator, '
+                         '--worker, --record or --ledger')
+
+    progress_reporter = None
+    if (args.update or args.testmigrate) and (args.progress > 0 or args.statusfile) and not user_emails:
+        progress_reporter = progress.ProgressReporter(
+            interval=args.progress if args.progress > 0 else progress.DEFAULT_INTERVAL,
+            status_file=args.statusfile,
+            logger=logging if args.progress > 0 else None)
+        progress_reporter.start()
+
+    # Where to send API requests: Google/Box, a local stand-in, or a recorded cassette
+    drive_connection = {'api_url': args.driveapi}
+    box_connection = {'api_url': args.boxapi}
+    api_cassette = None
+    if args.record:
+        import cassette
+        api_cassette = cassette.Cassette(args.record)
+        drive_connection['http'] = cassette.RecordingHttp(api_cassette)
+        box_connection['network_layer'] = box_interface.recording_network(api_cassette)
+    elif args.replay:
+        import cassette
+        logging.info('Replaying API responses from %s', args.replay)
+        api_cassette = cassette.Cassette.load(args.replay)
+        drive_connection['http'] = cassette.ReplayHttp(api_cassette, speed=args.replayspeed)
+        box_connection['network_layer'] = cassette.ReplayNetwork(api_cassette, speed=args.replayspeed)
+
+    # Duplicate requests would be recorded, or break the order of a replay
+    resilience.guard.configure(hedge_percentile=0 if api_cassette else args.hedge,
+                               failure_threshold=args.breakerfailures,
+                               reset_timeout=args.breakerreset,
+                               logger=logging)
+
     output_file = None
     if args.printtofile:
         output_file = open(args.printtofile, 'w', encoding='utf-8')
@@ -240,84 +576,357 @@ if __name__ == '__main__':
     if args.setup:
         # Setup the connections
         logging.info("Setting up the connection to Drive...")
-        drive_interface.print_credentials(force_reset=True, logger=logging, flags=args)
+        drive_interface.print_credentials(force_reset=True, logger=logging, flags=args, **drive_connection)
         logging.info("Setting up the connection to Box...")
-        box_interface.print_credentials(force_reset=True, logger=logging)
+        box_interface.print_credentials(force_reset=True, logger=logging, **box_connection)
         logging.info('Setup complete.')
 
     elif args.status:
         # Check the connections
         logging.info("Checking the connection to Drive...")
-        drive_interface.print_credentials(force_reset=False, logger=logging, flags=args)
+        drive_interface.print_credentials(force_reset=False, logger=logging, flags=args, **drive_connection)
         logging.info("Checking the connection to Box...")
-        box_interface.print_credentials(force_reset=False, logger=logging)
+        box_interface.print_credentials(force_reset=False, logger=logging, **box_connection)
         logging.info('Checks complete.')
 
     elif args.printdrive:
         # Map and print the Drive
-        logging.info("Mapping Drive at path: {0}".format(args.rootdrive if args.rootdrive else 'root'))
+        logging.info("Mapping Drive at path: %s", args.rootdrive if args.rootdrive else 'root')
         src_drive = drive_interface.Drive(path_prefix=PATH_ROOT,
                                           root_path=args.rootdrive,
                                           reset_cred=args.credentials,
                                           flags=args,
-                                          logger=logging)
+                                          logger=logging,
+                                          file_filter=file_filter,
+                                          shared_with_me=args.sharedwithme,
+                                          **drive_connection)
         logging.info("Printing Drive...")
         src_drive.print_drive(output_file=output_file)
         logging.info('Printing complete.')
 
     elif args.printbox:
         # Map and print the Box
-        logging.info("Mapping Box at path: {0}".format(args.rootbox if args.rootbox else 'root'))
+        logging.info("Mapping Box at path: %s", args.rootbox if args.rootbox else 'root')
         dest_box = box_interface.Box(path_prefix=PATH_ROOT,
                                      root_directory=args.rootbox,
                                      reset_cred=args.credentials,
-                                     logger=logging)
+                                     logger=logging,
+                                     strategy=args.boxstrategy,
+                                     search_query=args.boxsearchquery,
+                                     **box_connection)
         logging.info("Printing Box...")
         dest_box.print_box(output_file=output_file)
         logging.info('Printing complete.')
 
+    elif args.coordinator:
+        # List Drive once, split it into shards, and leave the rest to the workers
+        shard_queue = shards.ShardQueue(args.coordinator)
+        if shard_queue.is_created():
+            logging.info('Resuming the shards queued in %s, retrying %s failed shards', args.coordinator,
+                         shard_queue.retry_failed())
+            settings = shard_queue.settings()
+            if (settings['root_drive'], settings['root_box']) != (args.rootdrive, args.rootbox):
+                logging.warning('Using the roots the queue was created with: Drive <%s> and Box <%s>',
+                                settings['root_drive'], settings['root_box'])
+        else:
+            logging.info("Mapping Drive at path: %s", args.rootdrive if args.rootdrive else 'root')
+            recorder = shards.DriveRecorder(drive_interface.get_service(reset=args.credentials,
+                                                                        flags=args,
+                                                                        logger=logging,
+                                                                        **drive_connection),
+                                            shard_queue)
+            src_drive = drive_interface.Drive(path_prefix=PATH_ROOT,
+                                              root_path=args.rootdrive,
+                                              logger=logging,
+                                              file_filter=file_filter,
+                                              progress=progress_reporter,
+                                              service=recorder)
+            shard_count = shard_queue.create(src_drive, root_drive=args.rootdrive, root_box=args.rootbox)
+            logging.info('Split the migration into %s shards', shard_count)
+            del src_drive
+
+        # Log in to Box first, so the workers pick up its tokens rather than each logging in
+        box_interface.print_credentials(force_reset=args.credentials, logger=logging, **box_connection)
+        box_interface.flush_tokens()
+
+        logging.info('Starting %s workers', args.workers)
+        worker_processes = [subprocess.Popen(worker_command(args)) for _ in range(args.workers)]
+        finished = shards.wait(shard_queue, processes=worker_processes, progress_reporter=progress_reporter,
+                               logger=logging)
+        for worker_process in worker_processes:
+            worker_process.wait()
+
+        failures = shard_queue.failures()
+        for name, error in failures:
+            logging.error('Failed to migrate the shard <%s>: %s', name, error)
+        if args.printall:
+            migration.print_report(migration.merge_reports(shard_queue.reports()),
+                                   test_only=args.testmigrate,
+                                   print_file=output_file)
+        shard_queue.close()
+        if finished and not failures:
+            logging.info('Migration complete.')
+        else:
+            logging.error('Migration incomplete. Run the coordinator again to retry the remaining shards.')
+
+    elif args.worker:
+        # Migrate shards from the coordinator's queue until none are left
+        shard_queue = shards.ShardQueue(args.worker)
+        settings = shard_queue.settings()
+        migration_ledger = None
+        if args.ledger:
+            migration_ledger = ledger.Ledger(args.ledger)
+
+        def run_shard(shard):
+            src_drive = drive_interface.Drive(path_prefix=PATH_ROOT,
+                                              root_path=settings['root_drive'],
+                                              logger=logging,
+                                              progress=progress_reporter,
+                                              service=shards.SnapshotDriveService(shard_queue, shard))
+            report = map_and_migrate(args, src_drive, settings['root_box'], box_connection,
+                                     output_file=output_file,
+                                     progress_reporter=progress_reporter,
+                                     migration_ledger=migration_ledger,
+                                     shard=shard)
+            if migration_ledger is not None:
+                migration_ledger.commit()
+            return {section: list(paths) for section, paths in report.items()}
+
+        try:
+            shards_run = shards.work(shard_queue, run_shard, logger=logging)
+        finally:
+            if migration_ledger is not None:
+                migration_ledger.close()
+            shard_queue.close()
+        logging.info('Worker finished after migrating %s shards.', shards_run)
+
+    elif args.daemon:
+        def build_trees():
+            logging.info("Mapping Drive at path: %s", args.rootdrive if args.rootdrive else 'root')
+            src_drive = drive_interface.Drive(path_prefix=PATH_ROOT,
+                                              root_path=args.rootdrive,
+                                              reset_cred=args.credentials,
+                                              flags=args,
+                                              logger=logging,
+                                              file_filter=file_filter,
+                                              shared_with_me=args.sharedwithme,
+                                              progress=progress_reporter,
+                                              **drive_connection)
+            return src_drive, map_box(args, src_drive, args.rootbox, box_connection,
+                                      progress_reporter=progress_reporter)
+
+        warm_trees = daemon_server.WarmTrees(build_trees, refresh_interval=args.refresh, logger=logging)
+        warm_trees.start()
+        server = daemon_server.make_server(warm_trees,
+                                           test_only=args.testmigrate,
+                                           logger=logging,
+                                           port=args.daemonport,
+                                           socket_path=args.daemonsocket,
+                                           memory_budget=args.memorybudget * 1024 * 1024,
+                                           temp_dir=args.tempdir,
+                                           make_writer=lambda dest_box: make_writer(args, dest_box))
+        logging.info('Serving on %s', args.daemonsocket or 'http://localhost:{0}'.format(server.server_address[1]))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            warm_trees.stop()
+
+    elif user_emails:
+        # Migrate several users at once, acting as each of them, within one request budget per service
+        drive_budget = delegation.RateBudget(args.driverate)
+        box_budget = delegation.RateBudget(args.boxrate)
+        admin_client = box_interface.get_client(args.credentials, logging, api_url=args.boxapi,
+                                                network_layer=delegation.budgeted_network(box_budget))
+        if args.reportdir and not os.path.exists(args.reportdir):
+            os.makedirs(args.reportdir)
+        report_lock = threading.Lock()
+
+        def run_user(user_email):
+            # Each user's messages are logged under their own name
+            user_logger = logging.getLogger(user_email)
+            user_progress = None
+            if args.progress > 0 or args.statusfile:
+                status_file = None
+                if args.statusfile:
+                    status_root, status_ext = os.path.splitext(args.statusfile)
+                    status_file = '{0}-{1}{2}'.format(status_root, user_email, status_ext)
+                user_progress = progress.ProgressReporter(
+                    interval=args.progress if args.progress > 0 else progress.DEFAULT_INTERVAL,
+                    status_file=status_file,
+                    logger=user_logger if args.progress > 0 else None)
+                user_progress.start()
+
+            user_ledger = ledger.Ledger(args.ledger) if args.ledger else None
+            try:
+                user_logger.info("Mapping Drive at path: %s", args.rootdrive if args.rootdrive else 'root')
+                src_drive = drive_interface.Drive(path_prefix=PATH_ROOT,
+                                                  root_path=args.rootdrive,
+                                                  logger=user_logger,
+                                                  file_filter=file_filter,
+                                                  progress=user_progress,
+                                                  shared_with_me=args.sharedwithme,
+                                                  service=drive_interface.get_delegated_service(
+                                                      args.serviceaccount, user_email, logger=user_logger,
+                                                      api_url=args.driveapi,
+                                                      http=delegation.budgeted_http(drive_budget)))
+                dest_box = map_box(args, src_drive, args.rootbox,
+                                   {'client': box_interface.as_user(admin_client, user_email)},
+                                   progress_reporter=user_progress,
+                                   logger=user_logger)
+                report = migrate(args, src_drive, dest_box,
+                                 progress_reporter=user_progress,
+                                 migration_ledger=user_ledger,
+                                 print_details=False,
+                                 logger=user_logger)
+            finally:
+                if user_ledger is not None:
+                    user_ledger.close()
+                if user_progress:
+                    user_progress.stop()
+
+            if args.reportdir:
+                with open(os.path.join(args.reportdir, user_email + '.txt'), 'w', encoding='utf-8') as report_file:
+                    migration.print_report(report, test_only=args.testmigrate, print_file=report_file)
+            elif args.printall:
+                # Reports are printed whole, as users finish
+                with report_lock:
+                    print('Report for <{0}>:'.format(user_email), file=output_file)
+                    migration.print_report(report, test_only=args.testmigrate, print_file=output_file)
+            user_logger.info('%s matched, %s missed from Drive, %s missed from Box',
+                             len(report['matched']) + len(report['existing_metadata']),
+                             len(report['drive_missed']), len(report['box_missed']))
+            return len(report['matched'])
+
+        logging.info('Migrating %s users, %s at a time', len(user_emails), args.concurrentusers)
+        scheduler = delegation.UserScheduler(run_user, concurrency=args.concurrentusers, logger=logging)
+        finished = scheduler.run(user_emails)
+        logging.info('Made %s Drive requests (held back %.1fs) and %s Box requests (held back %.1fs)',
+                     drive_budget.requests, drive_budget.waited, box_budget.requests, box_budget.waited)
+        if finished:
+            logging.info('Migration complete.')
+        else:
+            logging.error('Migration incomplete. Failed to migrate %s of %s users: %s', len(scheduler.failures),
+                          len(user_emails), ', '.join(sorted(scheduler.failures)))
+
+    elif root_pairs or args.shareddrives:
+        if root_pairs:
+            # List Drive once, at the folder holding every pair's Drive root, and cut each pair's Drive out of it
+            drive_root, relative_roots = manifest.common_root(root_pairs)
+            logging.info("Mapping Drive at path: %s for %s root pairs", drive_root if drive_root else 'root',
+                         len(root_pairs))
+        else:
+            drive_root, relative_roots = args.rootdrive, [None]
+            root_pairs = [manifest.RootPair(name='My Drive', root_drive=args.rootdrive, root_box=args.rootbox,
+                                            report_file=None)]
+            logging.info("Mapping Drive at path: %s", drive_root if drive_root else 'root')
+        listed_drive = drive_interface.Drive(path_prefix=PATH_ROOT,
+                                             root_path=drive_root,
+                                             reset_cred=args.credentials,
+                                             flags=args,
+                                             logger=logging,
+                                             file_filter=file_filter,
+                                             progress=progress_reporter,
+                                             shared_with_me=args.sharedwithme,
+                                             **drive_connection)
+        src_drives = [listed_drive.subtree(relative_root, logger=logging) for relative_root in relative_roots]
+        del listed_drive
+
+        if args.shareddrives:
+            shared_drives = drive_interface.list_shared_drives(
+                drive_interface.get_service(reset=args.credentials, flags=args, logger=logging, **drive_connection),
+                logger=logging)
+            src_drives.extend(drive_interface.map_shared_drives(shared_drives,
+                                                                flags=args,
+                                                                logger=logging,
+                                                                progress=progress_reporter,
+                                                                file_filter=file_filter,
+                                                                threads=args.listingthreads,
+                                                                **drive_connection))
+            root_pairs.extend(manifest.RootPair(name=shared_drive['name'],
+                                                root_drive=None,
+                                                root_box='/'.join(filter(None, [args.shareddrivesbox,
+                                                                                shared_drive['name']])),
+                                                report_file=None)
+                              for shared_drive in shared_drives)
+
+        migrate_pairs(args, root_pairs, src_drives, box_connection, output_file, progress_reporter)
+        logging.info('Migration complete.')
+
     elif args.update or args.testmigrate:
         # Source Drive
-        logging.info("Mapping Drive at path: {0}".format(args.rootdrive if args.rootdrive else 'root'))
+        logging.info("Mapping Drive at path: %s", args.rootdrive if args.rootdrive else 'root')
         src_drive = drive_interface.Drive(path_prefix=PATH_ROOT,
                                           root_path=args.rootdrive,
                                           reset_cred=args.credentials,
                                           flags=args,
-                                          logger=logging)
-
-        # Destination Box
-        logging.info("Mapping Box at path: {0}".format(args.rootbox if args.rootbox else 'root'))
-        dest_box = box_interface.Box(path_prefix=PATH_ROOT,
-                                     root_directory=args.rootbox,
-                                     reset_cred=args.credentials,
-                                     logger=logging)
-
-        # Update the metadata
-        logging.info("Updating...")
-        migrate_metadata(box=dest_box,
-                         drive=src_drive,
-                         print_details=args.printall,
-                         print_file=output_file,
-                         test_only=args.testmigrate)
+                                          logger=logging,
+                                          file_filter=file_filter,
+                                          shared_with_me=args.sharedwithme,
+                                          progress=progress_reporter,
+                                          **drive_connection)
+
+        # Destination Box, and the metadata
+        migration_ledger = None
+        if args.ledger:
+            migration_ledger = ledger.Ledger(args.ledger)
+            logging.info('Using the ledger %s of %s migrated files', args.ledger, len(migration_ledger))
+        try:
+            map_and_migrate(args, src_drive, args.rootbox, box_connection,
+                            output_file=output_file,
+                            progress_reporter=progress_reporter,
+                            migration_ledger=migration_ledger)
+        finally:
+            if migration_ledger is not None:
+                migration_ledger.close()
         logging.info('Migration complete.')
 
     elif args.checkmetadata:
         # Map and print the Box
-        if box_interface.check_metadata_exists(args.checkmetadata):
-            logging.info("Mapping Box at path: {0}".format(args.rootbox if args.rootbox else 'root'))
+        if box_interface.check_metadata_exists(args.checkmetadata, **box_connection):
+            logging.info("Mapping Box at path: %s", args.rootbox if args.rootbox else 'root')
             dest_box = box_interface.Box(path_prefix=PATH_ROOT,
                                          root_directory=args.rootbox,
                                          reset_cred=args.credentials,
+                                         logger=logging,
+                                         strategy=args.boxstrategy,
+                                         search_query=args.boxsearchquery,
+                                         **box_connection)
+            if args.sample:
+                # Logged so that the same sample can be checked again
+                seed = args.sampleseed if args.sampleseed is not None else random.randrange(2 ** 32)
+                logging.info("Checking a sample of Box for Metadata of type: %s (seed %s)", args.checkmetadata,
+                             seed)
+                sampling.sample_check_metadata(box=dest_box,
+                                               metadata_name=args.checkmetadata,
+                                               sample_size=args.sample,
+                                               escalate_miss_rate=args.escalate,
+                                               depth=args.stratumdepth,
+                                               seed=seed,
+                                               print_file=output_file,
+                                               logger=logging)
+            else:
+                logging.info("Checking Box for Metadata of type: %s", args.checkmetadata)
+                migration.check_metadata(box=dest_box,
+                                         metadata_name=args.checkmetadata,
+                                         print_file=output_file,
                                          logger=logging)
-            logging.info("Checking Box for Metadata of type: {0}".format(args.checkmetadata))
-            check_metadata(box=dest_box,
-                           metadata_name=args.checkmetadata,
-                           print_file=output_file,
-                           logger=logging)
             logging.info('Check complete.')
         else:
-            logging.error("Error: metadata of type \'{0}\' does not exist in Box.".format(args.checkmetadata))
-
+            logging.error("Error: metadata of type \'%s\' does not exist in Box.", args.checkmetadata)
+
+    if progress_reporter:
+        progress_reporter.stop()
+    for endpoint in resilience.guard.endpoints():
+        logging.log(logging.INFO if endpoint.hedges or endpoint.breaker.opened else logging.DEBUG,
+                    '%s: %s requests, %s hedged (%s answered first by the hedge), %s failed, held back %s times',
+                    endpoint.name, endpoint.requests, endpoint.hedges, endpoint.hedge_wins, endpoint.failures,
+                    endpoint.breaker.opened)
+    if args.record:
+        logging.info('Saving %s API exchanges to %s', len(api_cassette.interactions), args.record)
+        api_cassette.save()
     if output_file:
         output_file.close()
     logging.info('Exiting Migration Tool.')
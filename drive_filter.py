@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+""" Rules restricting which Drive files are migrated
+
+A DriveFilter is built from command line flags and/or a config file. Everything
+the Drive query language can express (MIME types, modified and created time
+windows, owners) is compiled into the `q` parameter of `files.list`, so
+excluded files are never downloaded. Name globs can't be expressed in a query
+and are checked as the listing streams in.
+
+Folders are never filtered out, as they are needed to build the paths of the
+files which remain.
+
+Config file format:
+    [filter]
+    excludemimetypes = application/vnd.google-apps.form, application/vnd.google-apps.shortcut, video/*
+    modifiedafter = 2017-01-01
+    owners = someone@example.com
+    excludenames = *.tmp, ~$*
+
+"""
+
+# Imports
+import configparser
+import datetime
+import fnmatch
+
+FILTER_SECTION = 'filter'
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+LIST_OPTIONS = ['mimetypes', 'excludemimetypes', 'owners', 'names', 'excludenames']
+TIME_OPTIONS = ['modifiedafter', 'modifiedbefore', 'createdafter', 'createdbefore']
+
+
+class DriveFilter(object):
+    """ Rules restricting which Drive files are migrated
+
+    MIME types ending in '/*' (e.g. 'video/*') match every subtype. Times are
+    dates (YYYY-MM-DD) or RFC 3339 timestamps, and are taken as UTC if no
+    offset is given. Empty rules match everything.
+
+    Args:
+        mime_types ([str], optional): Only include files of these MIME types
+        exclude_mime_types ([str], optional): Skip files of these MIME types
+        modified_after (str, optional): Only include files last modified after this time
+        modified_before (str, optional): Only include files last modified before this time
+        created_after (str, optional): Only include files created after this time
+        created_before (str, optional): Only include files created before this time
+        owners ([str], optional): Only include files owned by one of these email addresses
+        names ([str], optional): Only include files with a name matching one of these globs
+        exclude_names ([str], optional): Skip files with a name matching any of these globs
+
+    Raises:
+        ValueError: If a time can't be parsed
+    """
+
+    def __init__(self, mime_types=None, exclude_mime_types=None, modified_after=None, modified_before=None,
+                 created_after=None, created_before=None, owners=None, names=None, exclude_names=None):
+        self.mime_types = list(mime_types or [])
+        self.exclude_mime_types = list(exclude_mime_types or [])
+        self.modified_after = _parse_time(modified_after)
+        self.modified_before = _parse_time(modified_before)
+        self.created_after = _parse_time(created_after)
+        self.created_before = _parse_time(created_before)
+        self.owners = set(owners or [])
+        self.names = list(names or [])
+        self.exclude_names = list(exclude_names or [])
+
+    @classmethod
+    def from_args(cls, args):
+        """ Build a filter from the parsed command line, on top of any filter file it names
+
+        Args:
+            args (argparse.Namespace): Parsed arguments (see drive-to-box-migration-tool.py)
+
+        Returns:
+            DriveFilter: The filter, or None if no rules were given
+        """
+        options = {}
+        if args.filterfile:
+            cfg = configparser.ConfigParser()
+            if not cfg.read(args.filterfile):
+                raise FileNotFoundError('Couldn\'t read the filter file <{0}>'.format(args.filterfile))
+            if FILTER_SECTION in cfg:
+                options.update(cfg[FILTER_SECTION])
+
+        # Flags take precedence over the file
+        for option in LIST_OPTIONS + TIME_OPTIONS:
+            if getattr(args, option, None):
+                options[option] = getattr(args, option)
+
+        if not any(options.get(option) for option in LIST_OPTIONS + TIME_OPTIONS):
+            return None
+        return cls(mime_types=_split(options.get('mimetypes')),
+                   exclude_mime_types=_split(options.get('excludemimetypes')),
+                   modified_after=options.get('modifiedafter'),
+                   modified_before=options.get('modifiedbefore'),
+                   created_after=options.get('createdafter'),
+                   created_before=options.get('createdbefore'),
+                   owners=_split(options.get('owners')),
+                   names=_split(options.get('names')),
+                   exclude_names=_split(options.get('excludenames')))
+
+    def query(self):
+        """ Compile the rules into a Drive `files.list` query
+
+        Returns:
+            str: The query
+        """
+        clauses = []
+        if self.mime_types:
+            clauses.append('(' + ' or '.join(_mime_type_clause(mime_type) for mime_type in self.mime_types) + ')')
+        for mime_type in self.exclude_mime_types:
+            clauses.append('not ' + _mime_type_clause(mime_type))
+        for field, operator, value in (('modifiedTime', '>', self.modified_after),
+                                       ('modifiedTime', '<', self.modified_before),
+                                       ('createdTime', '>', self.created_after),
+                                       ('createdTime', '<', self.created_before)):
+            if value:
+                clauses.append("{0} {1} '{2}'".format(field, operator, value.strftime('%Y-%m-%dT%H:%M:%S')))
+        if self.owners:
+            clauses.append('(' + ' or '.join("'{0}' in owners".format(_quote(owner))
+                                             for owner in sorted(self.owners)) + ')')
+
+        if not clauses:
+            return 'trashed = false'
+        return "trashed = false and (mimeType = '{0}' or ({1}))".format(FOLDER_MIME_TYPE, ' and '.join(clauses))
+
+    def matches(self, raw_file):
+        """ Check a file from the listing against every rule
+
+        The rules in the query are checked again, so that servers which ignore
+        the query (e.g. stub_server.py) give the same results.
+
+        Args:
+            raw_file (dict): File resource from `files.list`
+
+        Returns:
+            bool: Whether the file should be migrated
+        """
+        name = raw_file['name']
+        if self.names and not any(fnmatch.fnmatchcase(name, pattern) for pattern in self.names):
+            return False
+        if any(fnmatch.fnmatchcase(name, pattern) for pattern in self.exclude_names):
+            return False
+
+        mime_type = raw_file['mimeType']
+        if self.mime_types and not any(_mime_type_matches(mime_type, rule) for rule in self.mime_types):
+            return False
+        if any(_mime_type_matches(mime_type, rule) for rule in self.exclude_mime_types):
+            return False
+
+        if self.owners and not any(owner.get('emailAddress') in self.owners for owner in raw_file.get('owners', [])):
+            return False
+
+        for field, after, before in (('modifiedTime', self.modified_after, self.modified_before),
+                                     ('createdTime', self.created_after, self.created_before)):
+            if after or before:
+                if field not in raw_file:
+                    return False
+                value = _parse_time(raw_file[field])
+                if (after and value <= after) or (before and value >= before):
+                    return False
+        return True
+
+    def __repr__(self):
+        return "<filter: {0}{1}>".format(self.query(), ', names' if self.names or self.exclude_names else '')
+
+
+def _split(value):
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(',')
+    return [item.strip() for item in value if item.strip()]
+
+
+def _parse_time(value):
+    """ Parse a date or RFC 3339 timestamp, taking it as UTC if it has no offset
+
+    Args:
+        value (str): The time, or None
+
+    Returns:
+        datetime: The time in UTC, or None
+    """
+    if not value:
+        return None
+    parsed = datetime.datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=datetime.timezone.utc)
+    return parsed.astimezone(datetime.timezone.utc)
+
+
+def _quote(value):
+    return value.replace('\\', '\\\\').replace("'", "\\'")
+
+
+def _mime_type_clause(mime_type):
+    if mime_type.endswith('/*'):
+        return "mimeType contains '{0}'".format(_quote(mime_type[:-1]))
+    return "mimeType = '{0}'".format(_quote(mime_type))
+
+
+def _mime_type_matches(mime_type, rule):
+    if rule.endswith('/*'):
+        return mime_type.startswith(rule[:-1])
+    return mime_type == rule
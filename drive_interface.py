@@ -1,51 +1,347 @@
 # Imports
 from __future__ import print_function
 
-import httplib2
+import calendar
+import concurrent.futures
+import json
 import os
+import queue
+import threading
+import time
 
-from apiclient import discovery
-from oauth2client import client, tools
-from oauth2client.file import Storage
-
-CLIENT_KEY_FILE = 'client_secret.json'
+import auth_manager
+import resilience
 
+# The Google API client libraries are slow to import, so they are only loaded
+# once a Drive service is actually needed
 
-def print_credentials(force_reset=False, logger=None, flags=None):
-    credentials = _get_credentials(reset=force_reset, logger=logger, flags=flags)
-    http = credentials.authorize(httplib2.Http())
-    service = discovery.build('drive', 'v3', http=http)
-    about = service.about().get(fields="user").execute()
+CLIENT_KEY_FILE = 'client_secret.json'
+CREDENTIAL_DIR = os.path.join(os.path.expanduser('~'), '.credentials')
+DRIVE_SCOPE = 'https://www.googleapis.com/auth/drive'
+DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/drive/v3/rest'
+DISCOVERY_PATH = '/discovery/v1/apis/{api}/{apiVersion}/rest'
+DISCOVERY_CACHE_FILE = os.path.join(CREDENTIAL_DIR, 'drive-v3-discovery.json')
+DISCOVERY_MAX_AGE = 7 * 24 * 60 * 60  # Refetch the cached discovery document after a week
+NUM_RETRIES = 5  # Retries (with exponential backoff) for rate limited or failed requests
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+LISTING_THREADS = 8  # Shared drives listed at once
+SHARED_WITH_ME_ID = 'shared-with-me'  # ID of the folder holding items shared with the user from outside the Drive
+
+# Idle transports for hedged requests, by the ID of the transport of the service they were borrowed for
+_spare_transports = {}
+_spare_transports_lock = threading.Lock()
+
+
+def print_credentials(force_reset=False, logger=None, flags=None, api_url=None, http=None):
+    service = get_service(reset=force_reset, flags=flags, logger=logger, api_url=api_url, http=http)
+    about = _execute(service.about().get(fields="user"), 'drive:about.get')
     if logger:
-        logger.info('Logged into Drive with username: {0}'.format(about['user']['emailAddress']))
+        logger.info('Logged into Drive with username: %s', about['user']['emailAddress'])
 
 
 def _get_credentials(reset=False, flags=None, logger=None):
-    """Gets valid user credentials from storage.
+    """Gets valid user credentials, reading the credential store only once per process.
 
     If nothing has been stored, or if the stored credentials are invalid,
-    the OAuth2 flow is completed to obtain the new credentials.
+    the OAuth2 flow is completed to obtain the new credentials. The access
+    token is then refreshed in the background shortly before it expires.
 
     Returns:
         Credentials, the obtained credential.
     """
-    home_dir = os.path.expanduser('~')
-    credential_dir = os.path.join(home_dir, '.credentials')
-    if not os.path.exists(credential_dir):
-        os.makedirs(credential_dir)
-    credential_path = os.path.join(credential_dir, 'src-drive-migration-tool.json')
+    return auth_manager.clients.get(('drive-credentials',),
+                                    lambda: _load_credentials(reset=reset, flags=flags, logger=logger),
+                                    reset=reset)
+
+
+def _load_credentials(reset=False, flags=None, logger=None):
+    import httplib2
+    from oauth2client import client, tools
+    from oauth2client.file import Storage
+
+    if not os.path.exists(CREDENTIAL_DIR):
+        os.makedirs(CREDENTIAL_DIR)
+    credential_path = os.path.join(CREDENTIAL_DIR, 'src-drive-migration-tool.json')
 
     store = Storage(credential_path)
     credentials = store.get()
     if not credentials or credentials.invalid or reset:
-        flow = client.flow_from_clientsecrets(CLIENT_KEY_FILE,
-                                              'https://www.googleapis.com/auth/drive')
+        flow = client.flow_from_clientsecrets(CLIENT_KEY_FILE, DRIVE_SCOPE)
         flow.user_agent = 'Drive Migration Tool'
         credentials = tools.run_flow(flow, store, flags)
-        logger.info('Storing credentials to ' + credential_path)
+        logger.info('Storing credentials to %s', credential_path)
+
+    def expires_at():
+        if credentials.token_expiry is None:
+            return None
+        return calendar.timegm(credentials.token_expiry.timetuple())
+
+    # Refreshing also writes the new token back to the credential store
+    auth_manager.clients.keep_fresh(('drive-credentials',),
+                                    expires_at=expires_at,
+                                    refresh=lambda: credentials.refresh(httplib2.Http()))
     return credentials
 
 
+def _execute(request, endpoint):
+    """ Execute a read request through the endpoint's breaker, hedging it if it is slow
+
+    httplib2 transports aren't thread safe, and a hedged request may still be running after its answer has
+    been thrown away. So while hedging, each attempt borrows a spare transport with the service's
+    credentials, and gives it back once it has finished. Requests through any other kind of transport (e.g.
+    a metering, recording or replaying one) are never hedged, and requests without one (e.g. to a synthetic
+    service) are simply made again.
+
+    Args:
+        request (HttpRequest): The request
+        endpoint (str): Name of the endpoint (e.g. "drive:files.list")
+
+    Returns:
+        dict: The response
+    """
+    import httplib2
+
+    transport = getattr(request, 'http', None)
+    if not resilience.guard.hedging or type(transport) is not httplib2.Http:
+        return resilience.guard.call(endpoint,
+                                     lambda: request.execute(num_retries=NUM_RETRIES),
+                                     hedge=transport is None)
+
+    def attempt():
+        http = _borrow_transport(transport)
+        try:
+            return request.execute(http=http, num_retries=NUM_RETRIES)
+        finally:
+            with _spare_transports_lock:
+                _spare_transports[id(transport)].append(http)
+
+    return resilience.guard.call(endpoint, attempt)
+
+
+def _borrow_transport(transport):
+    """ Take a spare transport with the same credentials as a service's transport, making one if none is idle
+
+    Args:
+        transport (Http): The service's transport
+
+    Returns:
+        Http: The spare transport
+    """
+    import httplib2
+
+    with _spare_transports_lock:
+        spares = _spare_transports.setdefault(id(transport), [])
+        if spares:
+            return spares.pop()
+    credentials = getattr(transport.request, 'credentials', None)
+    return credentials.authorize(httplib2.Http()) if credentials else httplib2.Http()
+
+
+def _get_discovery_document(http, url=DISCOVERY_URL, use_cache=True, logger=None):
+    """ Get the Drive v3 discovery document, from the local cache where possible
+
+    Args:
+        http (Http): Transport used to fetch the document if it isn't cached
+        url (str, optional): URL of the discovery document
+        use_cache (bool, optional): Whether to read and write the local cache
+        logger (logger, optional): Logging file
+
+    Returns:
+        str: The discovery document
+    """
+    if use_cache and os.path.exists(DISCOVERY_CACHE_FILE) and \
+            time.time() - os.path.getmtime(DISCOVERY_CACHE_FILE) < DISCOVERY_MAX_AGE:
+        with open(DISCOVERY_CACHE_FILE, 'r', encoding='utf-8') as cache_file:
+            return cache_file.read()
+
+    if logger:
+        logger.debug('Fetching the Drive discovery document from %s', url)
+    response, content = http.request(url)
+    if int(response.status) >= 400:
+        raise IOError('Failed to fetch the Drive discovery document: HTTP {0}'.format(response.status))
+    document = content.decode('utf-8')
+
+    if use_cache:
+        # Make sure it parses before caching it
+        json.loads(document)
+        if not os.path.exists(CREDENTIAL_DIR):
+            os.makedirs(CREDENTIAL_DIR)
+        temp_file = DISCOVERY_CACHE_FILE + '.tmp'
+        with open(temp_file, 'w', encoding='utf-8') as cache_file:
+            cache_file.write(document)
+        os.replace(temp_file, DISCOVERY_CACHE_FILE)
+    return document
+
+
+def get_service(reset=False, flags=None, logger=None, api_url=None, http=None):
+    """ Get the Drive v3 service, either for Google or for a local stand-in
+
+    The service is only built once per endpoint and transport; later calls return the same one.
+    Credentials are shared by every service in the process.
+
+    Args:
+        reset (bool, optional): Whether to force a reset of the credentials
+        flags (argparse, optional): Flags for the OAuth2 flow
+        logger (logger, optional): Logging file
+        api_url (str, optional): URL of a Drive API stand-in to use instead of Google.
+            No credentials are used with a stand-in.
+        http (Http, optional): Transport to send requests through (e.g. to record or replay them).
+            No credentials are used with a replaying transport.
+
+    Returns:
+        discovery: Discovery service from the Drive API
+    """
+    return auth_manager.clients.get(('drive', api_url, id(http)),
+                                    lambda: _build_service(reset=reset, flags=flags, logger=logger,
+                                                           api_url=api_url, http=http),
+                                    reset=reset)
+
+
+def _build_service(reset=False, flags=None, logger=None, api_url=None, http=None):
+    import httplib2
+    from apiclient import discovery
+
+    if getattr(http, 'replaying', False):
+        if logger:
+            logger.info('Replaying recorded Drive responses')
+        # Recordings always include the discovery document, so never touch the local cache
+        document = _get_discovery_document(http, use_cache=False, logger=logger)
+        return discovery.build_from_document(document, http=http)
+
+    if api_url:
+        if logger:
+            logger.info('Using the Drive API at %s', api_url)
+        http = http or httplib2.Http()
+        document = _get_discovery_document(http, url=api_url.rstrip('/') + DISCOVERY_PATH.format(
+            api='drive', apiVersion='v3'), use_cache=False, logger=logger)
+        return discovery.build_from_document(document, http=http)
+
+    # Always fetch through a recording transport, so that the cassette can be replayed without a cache
+    document = _get_discovery_document(http or httplib2.Http(),
+                                       use_cache=not getattr(http, 'recording', False),
+                                       logger=logger)
+    credentials = _get_credentials(reset=reset, flags=flags, logger=logger)
+    return discovery.build_from_document(document, http=credentials.authorize(http or httplib2.Http()))
+
+
+def new_service(flags=None, logger=None, api_url=None):
+    """ Build a Drive v3 service with a transport of its own, for listing Drive on another thread
+
+    httplib2 transports aren't thread safe, so each thread listing Drive needs its own service. The
+    credentials and the cached discovery document are still shared.
+
+    Args:
+        flags (argparse, optional): Flags for the OAuth2 flow
+        logger (logger, optional): Logging file
+        api_url (str, optional): URL of a Drive API stand-in to use instead of Google
+
+    Returns:
+        discovery: Discovery service from the Drive API
+    """
+    return _build_service(flags=flags, logger=logger, api_url=api_url)
+
+
+def get_delegated_service(key_file, user_email, logger=None, api_url=None, http=None):
+    """ Build a Drive v3 service acting as a user of the domain, through domain-wide delegation
+
+    The service account's key file names the endpoint its tokens are requested from (token_uri), so a
+    stand-in can issue them too. Each call builds a new service, with its own transport.
+
+    Args:
+        key_file (str): Path to the JSON key file of a service account with domain-wide delegation
+        user_email (str): Email address of the user to act as
+        logger (logger, optional): Logging file
+        api_url (str, optional): URL of a Drive API stand-in to use instead of Google
+        http (Http, optional): Transport to send requests through (e.g. to meter them)
+
+    Returns:
+        discovery: Discovery service from the Drive API
+    """
+    import httplib2
+    from apiclient import discovery
+    from oauth2client.service_account import ServiceAccountCredentials
+
+    http = http or httplib2.Http()
+    if api_url:
+        document = _get_discovery_document(http, url=api_url.rstrip('/') + DISCOVERY_PATH.format(
+            api='drive', apiVersion='v3'), use_cache=False, logger=logger)
+    else:
+        document = _get_discovery_document(http, logger=logger)
+    credentials = ServiceAccountCredentials.from_json_keyfile_name(key_file, scopes=[DRIVE_SCOPE])
+    if logger:
+        logger.debug('Acting as <%s> in Drive', user_email)
+    return discovery.build_from_document(document, http=credentials.create_delegated(user_email).authorize(http))
+
+
+def list_shared_drives(service, logger=None):
+    """ List the shared drives the user is a member of
+
+    Args:
+        service (discovery): Discovery service from the Drive API
+        logger (logger, optional): Logging file
+
+    Returns:
+        [dict]: The ID and name of each shared drive
+    """
+    shared_drives = []
+    page_token = None
+    while True:
+        response = _execute(service.drives().list(pageSize=100,
+                                                  pageToken=page_token,
+                                                  fields="nextPageToken, drives(id, name)"), 'drive:drives.list')
+        shared_drives.extend(response.get('drives', []))
+        page_token = response.get('nextPageToken', None)
+        if page_token is None:
+            break
+
+    if logger:
+        logger.info('Found %s shared drives', len(shared_drives))
+    return shared_drives
+
+
+def map_shared_drives(shared_drives, flags=None, logger=None, progress=None, file_filter=None, api_url=None,
+                      http=None, threads=LISTING_THREADS):
+    """ Build a Drive for each shared drive, listing several of them at once
+
+    Each shared drive is its own root, with the drive's name (and a colon) as its path prefix.
+
+    Args:
+        shared_drives ([dict]): The ID and name of each shared drive, from list_shared_drives
+        flags (argparse, optional): Flags for the OAuth2 flow
+        logger (logger): Logging file
+        progress (ProgressReporter, optional): Reporter counting the items listed
+        file_filter (DriveFilter, optional): Rules restricting which files are included
+        api_url (str, optional): URL of a Drive API stand-in to use instead of Google
+        http (Http, optional): Transport to send requests through (e.g. to record or replay them).
+            The shared drives are listed one at a time through it.
+        threads (int, optional): Most shared drives listed at once
+
+    Returns:
+        [Drive]: The Drive of each shared drive, in the same order
+    """
+    local = threading.local()
+
+    def build(shared_drive):
+        if http:
+            service = get_service(flags=flags, logger=logger, api_url=api_url, http=http)
+        else:
+            if not hasattr(local, 'service'):
+                local.service = new_service(flags=flags, logger=logger, api_url=api_url)
+            service = local.service
+        return Drive(path_prefix=shared_drive['name'] + ':',
+                     logger=logger,
+                     progress=progress,
+                     service=service,
+                     file_filter=file_filter,
+                     shared_drive=shared_drive)
+
+    if not shared_drives:
+        return []
+    workers = 1 if http else min(threads, len(shared_drives))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='drive-listing') as pool:
+        return list(pool.map(build, shared_drives))
+
+
 class Drive(object):
     """Class for representing a Google Drive. Has children of Folders and Files.
 
@@ -54,42 +350,59 @@ class Drive(object):
         folders (set(Folder))   Set of folders inside the Drive
         files   (set(File))     Set of files inside the Drive
         users   (set(User))     Set of users inside the Drive
-        service (discovery)     Discovery service from the Drive API
+        service (discovery)     Discovery service from the Drive API, or the one passed in
+        shared_drive (dict)     ID and name of the shared drive listed, or None for "My Drive"
+        path_prefix (str)       The prefix added to each path
 
     Notes:
         The list of users is NOT a directory of users. It is only users who
             have some sort of permission/interaction with a file/folder inside
             the Drive (eg Last Modifying User, Owner, etc)
         When an instance of Drive is initiated, it executes two functions:
-            build_drive() creates the objects within the Drive (eg Folders)
-            generate_paths() creates the paths of every file/folder in
+            _get_all_files() lists the Drive, creating the objects within
+            it (eg Folders) as each page of results arrives
+            _generate_paths() creates the paths of every file/folder in
             the Drive (eg D:/Hello-world)
+        Items in a shared drive have no owner, so the shared drive stands
+            in as their owner
+        Items shared with the user from outside the Drive have no path,
+            unless shared_with_me names a folder under the root to hold them
 
     """
 
-    def __init__(self, path_prefix, root_path=None, reset_cred=True, flags=None, logger=None):
-        self.name = 'Source'
+    def __init__(self, path_prefix, root_path=None, reset_cred=True, flags=None, logger=None, progress=None,
+                 service=None, api_url=None, http=None, file_filter=None, shared_drive=None, shared_with_me=None):
+        self.name = shared_drive['name'] if shared_drive else 'Source'
+        self.shared_drive = shared_drive
         self.folders = []
         self.root = None
         self._owner = None
         self.files = []
         self.users = []
-        self._path_prefix = path_prefix
+        self._users_by_email = {}
+        self._files_by_path = {}
+        self._mime_types = {}
+        self.path_prefix = path_prefix
         self._root_path = root_path
+        self._progress = progress
+        self._filter = file_filter
+        self._shared_with_me = shared_with_me
 
-        print('attempting auth')
-        self._credentials = _get_credentials(reset=reset_cred, logger=logger)
-        http = self._credentials.authorize(httplib2.Http())
-        self.service = discovery.build('drive', 'v3', http=http)
+        if service:
+            # Use a ready-made service (e.g. a synthetic one for benchmarking)
+            self.service = service
+        else:
+            if logger:
+                logger.debug('Authenticating to Drive')
+            self.service = get_service(reset=reset_cred, flags=flags, logger=logger, api_url=api_url, http=http)
 
         # Initialise the drive
-        raw_files, raw_folders = self._get_all_files(logger)
+        drive_root, folders, files = self._get_all_files(logger)
 
-        self.root = self._create_root(self._root_path, raw_folders)
-        logger.debug("Generating paths for <{0}>.".format(self.name))
-        self._create_child_folders(self.root, raw_folders)
-        self._create_files(raw_files)
-        logger.info("Finished generating paths for <{0}>. Drive has been built.".format(self.name))
+        self.root = self._create_root(self._root_path, drive_root, folders)
+        logger.debug("Generating paths for <%s>.", self.name)
+        self._generate_paths(folders, files)
+        logger.info("Finished generating paths for <%s>. Drive has been built.", self.name)
 
     def _parse_path(self, path, logger):
         """ Parse a given file path, returning an ordered list of path objects
@@ -102,16 +415,16 @@ class Drive(object):
             [Folder/File]: Ordered list of folders/file objects
 
         """
-        if self._path_prefix not in path:
-            logger.error("Invalid path <{0}>.".format(path))
+        if self.path_prefix not in path:
+            logger.error("Invalid path <%s>.", path)
             return None
 
-        if path == self._path_prefix:
+        if path == self.path_prefix:
             # We're looking at root
             return [self.root]
 
         # Strip out the prefix
-        path = path.replace(self._path_prefix, '')
+        path = path.replace(self.path_prefix, '')
         path_list = path.split('/')
 
         # Build the list of path objects
@@ -144,8 +457,8 @@ class Drive(object):
                     break
 
         if logger and (not any(obj.name == path_list[-1] for obj in path_objects) or len(path_objects) == 0):
-            logger.error("Path <{0}> could not be found. Only found: <{1}>".format(
-                self._path_prefix + path, path_objects))
+            logger.error("Path <%s> could not be found. Only found: <%s>",
+                         self.path_prefix + path, path_objects)
             return None
 
         # Return the path objects
@@ -190,14 +503,107 @@ class Drive(object):
         Returns:
             File: File at the specified path
         """
-        for file in self.files:
-            if file.path == path:
-                return file
+        file = self._files_by_path.get(path)
+        if file:
+            return file
 
         if logger:
-            logger.error("Could not find file at <{0}> in <{1}>.".format(path, self.name))
+            logger.error("Could not find file at <%s> in <%s>.", path, self.name)
         return None
 
+    def subtree(self, root_path, logger=None):
+        """ Build the Drive for a folder within this one, without listing Drive again
+
+        The folders and files under it are copied, so the subtree's paths start at the folder while this
+        Drive's are left as they are. Users are shared with this Drive.
+
+        Args:
+            root_path (str): Path to the folder, relative to this Drive's root (e.g. "folder/subfolder")
+            logger (logger, optional): Logging file
+
+        Returns:
+            Drive: The Drive rooted at the folder, or this Drive if no path is given
+
+        Raises:
+            FileNotFoundError: If there's no folder at the path
+        """
+        if not root_path:
+            return self
+
+        source = self.root
+        for path in root_path.split('/'):
+            source = next((folder for folder in self.folders
+                           if folder.parent is source and folder.name == path.rstrip()), None)
+            if source is None:
+                raise FileNotFoundError('Couldn\'t find the root folder <{0}> in Drive'.format(root_path))
+
+        drive = Drive.__new__(Drive)
+        drive.name = self.name
+        drive.shared_drive = self.shared_drive
+        drive.service = self.service
+        drive.users = self.users
+        drive._users_by_email = self._users_by_email
+        drive._owner = self._owner
+        drive._mime_types = self._mime_types
+        drive.path_prefix = self.path_prefix
+        drive._root_path = root_path if not self._root_path else self._root_path + '/' + root_path
+        drive._progress = self._progress
+        drive._filter = self._filter
+        drive._shared_with_me = self._shared_with_me
+        drive.root = self._copy_root(source)
+        drive.folders = [drive.root]
+        drive.files = []
+        drive._files_by_path = {}
+
+        # Folder ID to its copy, or None if it isn't under the source folder
+        copies = {source.id: drive.root, self.root.id: None}
+        for folder in self.folders:
+            chain = []
+            node = folder
+            while node.id not in copies:
+                chain.append(node)
+                node = node.parent
+            for node in reversed(chain):
+                parent = copies[node.parent.id]
+                copy = None
+                if parent is not None:
+                    copy = Folder(identifier=node.id,
+                                  name=node.name,
+                                  owner=node.owner,
+                                  parent=parent,
+                                  created_time=node.created_time,
+                                  last_modified_time=node.last_modified_time,
+                                  last_modified_by=node.last_modified_by)
+                    drive.folders.append(copy)
+                copies[node.id] = copy
+
+        for file in self.files:
+            parent = copies[file.parent.id]
+            if parent is not None:
+                copy = File(identifier=file.id,
+                            name=file.name,
+                            owner=file.owner,
+                            created_time=file.created_time,
+                            last_modified_time=file.last_modified_time,
+                            last_modified_by=file.last_modified_by,
+                            mime_type=file.mime_type,
+                            parent=parent)
+                drive.files.append(copy)
+                drive._files_by_path.setdefault(copy.path, copy)
+
+        if logger:
+            logger.info("Built <%s> at <%s> from the listing: %s folders and %s files", drive.name,
+                        drive._root_path, len(drive.folders), len(drive.files))
+        return drive
+
+    def folder_paths(self):
+        """ Get the paths of every folder in the Drive
+
+        Returns:
+            set(str): Folder paths, including the root (the path prefix)
+        """
+        return {folder.path if folder.path else folder.name for folder in self.folders}
+
     def _create_or_retrieve_user(self, user_email, user_name):
         """Get a user by their email if they exist, otherwise add them
 
@@ -209,194 +615,365 @@ class Drive(object):
             User: User object corresponding to the given email address
         """
 
-        for user in self.users:
-            if user.email == user_email:
-                return user
-        new_user = User(user_name, user_email)
-        self.users.append(new_user)
-        return new_user
+        user = self._users_by_email.get(user_email)
+        if user is None:
+            user = User(user_name, user_email)
+            self._users_by_email[user_email] = user
+            self.users.append(user)
+        return user
+
+    def _list_pages(self):
+        """ List every item in the Drive, a page at a time
+
+        The next page is fetched on a background thread while the current one is being processed.
+
+        Yields:
+            [dict]: The file resources of each page
+        """
+
+        query = self._filter.query() if self._filter else "trashed = false"
+        corpus = {}
+        if self.shared_drive:
+            corpus = {'corpora': 'drive',
+                      'driveId': self.shared_drive['id'],
+                      'includeItemsFromAllDrives': True,
+                      'supportsAllDrives': True}
+
+        def fetch_pages():
+            page_token = None
+            while True:
+                # Get entire folder structure, we'll work down from here
+                request = self.service.files().list(q=query,
+                                                    pageSize=1000,
+                                                    pageToken=page_token,
+                                                    fields="nextPageToken, \
+                                                            files(id, \
+                                                                  mimeType, \
+                                                                  name, \
+                                                                  owners, \
+                                                                  parents, \
+                                                                  modifiedTime, \
+                                                                  lastModifyingUser, \
+                                                                  createdTime)",
+                                                    **corpus)
+                response = _execute(request, 'drive:files.list')
+                if self._progress:
+                    self._progress.requests += 1
+                yield response.get('files', [])
+
+                # Look for more pages of results
+                page_token = response.get('nextPageToken', None)
+                if page_token is None:
+                    return
+
+        return _prefetch(fetch_pages())
 
     def _get_all_files(self, logger=None):
-        """ Build the Google Drive for the given service
+        """ List the Drive for the given service, converting each page into folders and files as it arrives
+
+        Items are linked to their parent folder as soon as it has been seen. Until then they wait
+        in a map of pending items keyed by the parent's ID.
 
         Args:
             logger (logger, optional): Logging file
+
+        Returns:
+            (Folder, [Folder], [File]): The "My Drive" root folder, then every other folder and file
+                in the order they were listed
         """
 
         if logger:
-            logger.info("Retrieving drive data for <{0}>...".format(self.name))
-
-        # Get the root "My Drive" folder first
-        response = self.service.files().get(fileId='root',
-                                            fields="id, mimeType, name, owners").execute()
-
-        raw_files = []
-        raw_folders = [response]
+            logger.info("Retrieving drive data for <%s>...", self.name)
+
+        # Get the root "My Drive" folder first (a shared drive's ID is that of its root folder)
+        if self.shared_drive:
+            response = _execute(self.service.files().get(fileId=self.shared_drive['id'],
+                                                         fields="id, mimeType, name",
+                                                         supportsAllDrives=True), 'drive:files.get')
+            # Shared drives are owned by the organisation rather than a user
+            self._owner = self._create_or_retrieve_user(self.shared_drive['name'], self.shared_drive['name'])
+        else:
+            response = _execute(self.service.files().get(fileId='root', fields="id, mimeType, name, owners"),
+                                'drive:files.get')
 
-        # Set the owner
-        self._owner = self._create_or_retrieve_user(response['owners'][0]['emailAddress'],
-                                                    response['owners'][0]['displayName'])
+            # Set the owner
+            self._owner = self._create_or_retrieve_user(response['owners'][0]['emailAddress'],
+                                                        response['owners'][0]['displayName'])
         # Set the root
         if logger:
-            logger.debug("root_folder: {0}, root_owner: {1} ".format(response['name'],
-                                                                     response['owners'][0]['displayName']))
-
-        page_token = None
+            logger.debug("root_folder: %s, root_owner: %s ", response['name'], self._owner.name)
+        drive_root = Folder(identifier=response['id'],
+                            name=self.path_prefix,
+                            owner=self._owner,
+                            created_time='',
+                            last_modified_time='',
+                            last_modified_by=self._owner)
+
+        folders_by_id = {drive_root.id: drive_root}
+        pending = {}
+        folders = []
+        files = []
         page_no = 1
+        if self._progress:
+            self._progress.begin_phase('drive-listing')
 
         # Get the rest of the drive
-        while True:
-            # Get entire folder structure, we'll work down from here
-            response = self.service.files().list(q="trashed = false",
-                                                 pageSize=1000,
-                                                 pageToken=page_token,
-                                                 fields="nextPageToken, \
-                                                         files(id, \
-                                                               mimeType, \
-                                                               name, \
-                                                               owners, \
-                                                               parents, \
-                                                               modifiedTime, \
-                                                               lastModifyingUser, \
-                                                               createdTime)").execute()
-            results = response.get('files', [])
+        for results in self._list_pages():
+            if self._progress:
+                self._progress.items += len(results)
 
             for result in results:
-                if result['mimeType'] == 'application/vnd.google-apps.folder':
-                    raw_folders.append(result)
+                if result['mimeType'] == FOLDER_MIME_TYPE:
+                    if result['id'] in folders_by_id:
+                        continue
+                    item = self._make_folder(result)
+                    folders_by_id[item.id] = item
+                    folders.append(item)
+                    # Folders outside any other folder sit in the root
+                    parent_id = result['parents'][0] if 'parents' in result else drive_root.id
                     if logger:
-                        logger.debug("folder: {0}, owner: {1}".format(result['name'],
-                                                                      result['owners'][0]['displayName']))
-                else:
-                    raw_files.append(result)
+                        logger.debug("folder: %s, owner: %s", result['name'], item.owner)
+                elif 'parents' in result:
+                    if self._filter and not self._filter.matches(result):
+                        continue
+                    item = self._make_file(result)
+                    files.append(item)
+                    parent_id = result['parents'][0]
                     if logger:
-                        logger.debug("file: {0}, owner: {1}".format(result['name'],
-                                                                    result['owners'][0]['displayName']))
+                        logger.debug("file: %s, owner: %s", result['name'], item.owner)
+                else:
+                    # Files which aren't in any folder (e.g. shared with me) have no path
+                    continue
+
+                if parent_id in folders_by_id:
+                    item.parent = folders_by_id[parent_id]
+                else:
+                    pending.setdefault(parent_id, []).append(item)
 
-            # Look for more pages of results
-            page_token = response.get('nextPageToken', None)
+                # Anything which was waiting on this folder can now be linked to it
+                if item.id in pending:
+                    for child in pending.pop(item.id):
+                        child.parent = item
             page_no += 1
-            if page_token is None:
-                break
-        if logger:
-            logger.info("Found <{0}> pages of results for <{1}>. Building Drive...".format(page_no, self.name))
-
-        for raw_folder in raw_folders:
-            if 'parents' not in raw_folder:
-                raw_folder['parents'] = raw_folders[0]['id']
-
-        return raw_files, raw_folders
-
-    def _create_root(self, root_directory, raw_folders):
-        if root_directory and root_directory.startswith(self._path_prefix):
-            root_directory = root_directory.replace(self._path_prefix + '/', '')
-
-        current_folder = raw_folders[0]
-        if root_directory and root_directory != '':
-            paths = root_directory.split('/')
-            for path in paths:
-                found_path = False
-                for folder in raw_folders:
-                    if folder['name'] == path and 'parents' in folder and current_folder['id'] in folder['parents']:
-                        found_path = True
-                        current_folder = folder
-                        break
-                if not found_path:
-                    raise FileNotFoundError('Couldn\'t find the root folder <{0}> in Drive'.format(root_directory))
-        owner = self._create_or_retrieve_user(current_folder['owners'][0]['emailAddress'],
-                                              current_folder['owners'][0]['displayName'])
-
-        if 'lastModifyingUser' in current_folder and 'emailAddress' in current_folder['lastModifyingUser']:
-            modified_by = self._create_or_retrieve_user(current_folder['lastModifyingUser']['emailAddress'],
-                                                        current_folder['lastModifyingUser']['displayName'])
-        else:
-            # Set the last modifier to be the file owner if no last modified exists
-            modified_by = owner
 
-        created_time = current_folder['createdTime'] if 'createdTime' in current_folder else ''
-        modified_time = current_folder['modifiedTime'] if 'modifiedTime' in current_folder else created_time
+        if pending and self._shared_with_me:
+            # Items shared with the user from folders they can't see go in a folder of their own under the root
+            shared_folder = Folder(identifier=SHARED_WITH_ME_ID,
+                                   name=self._shared_with_me,
+                                   owner=self._owner,
+                                   parent=drive_root,
+                                   created_time='',
+                                   last_modified_time='',
+                                   last_modified_by=self._owner)
+            folders.append(shared_folder)
+            for children in pending.values():
+                for child in children:
+                    child.parent = shared_folder
+            if logger:
+                logger.info("Put %s items shared from outside <%s> in <%s>", sum(len(p) for p in pending.values()),
+                            self.name, self._shared_with_me)
+            pending = {}
 
-        root_folder = Folder(identifier=current_folder['id'],
-                             name=self._path_prefix,
-                             owner=owner,
-                             parent=None,
-                             created_time=created_time,
-                             last_modified_time=modified_time,
-                             last_modified_by=modified_by)
+        if logger:
+            logger.info("Found <%s> pages of results for <%s>. Building Drive...", page_no, self.name)
+            if pending:
+                logger.debug("%s items are in folders outside <%s>", sum(len(p) for p in pending.values()),
+                             self.name)
+
+        return drive_root, folders, files
+
+    def _make_folder(self, raw_folder):
+        owner = self._item_owner(raw_folder)
+        last_modifier = self._last_modifier(raw_folder, owner)
+
+        created_time = raw_folder['createdTime'] if 'createdTime' in raw_folder else ''
+        modified_time = raw_folder['modifiedTime'] if 'modifiedTime' in raw_folder else created_time
+
+        return Folder(identifier=raw_folder['id'],
+                      name=raw_folder['name'].rstrip(),
+                      owner=owner,
+                      created_time=created_time,
+                      last_modified_time=modified_time,
+                      last_modified_by=last_modifier)
+
+    def _make_file(self, raw_file):
+        filename = raw_file['name']
+        if raw_file['mimeType'] == 'application/vnd.google-apps.document'\
+                and not raw_file['name'].lower().endswith('.docx')\
+                and not raw_file['name'].lower().endswith('.doc')\
+                and not raw_file['name'].lower().endswith('.txt'):
+            filename = filename + '.docx'
+        elif raw_file['mimeType'] == 'application/vnd.google-apps.spreadsheet'\
+                and not raw_file['name'].lower().endswith('.xlsx')\
+                and not raw_file['name'].lower().endswith('.xls'):
+            filename = filename + '.xlsx'
+        elif raw_file['mimeType'] == 'application/vnd.google-apps.presentation'\
+                and not raw_file['name'].lower().endswith('.pptx')\
+                and not raw_file['name'].lower().endswith('.ppt'):
+            filename = filename + '.pptx'
+
+        filename = filename.rstrip()
+
+        owner = self._item_owner(raw_file)
+        last_modifier = self._last_modifier(raw_file, owner)
+
+        created_time = raw_file['createdTime'] if 'createdTime' in raw_file else ''
+        modified_time = raw_file['modifiedTime'] if 'modifiedTime' in raw_file else created_time
+
+        # Share one string per MIME type rather than one per file
+        mime_type = self._mime_types.setdefault(raw_file['mimeType'], raw_file['mimeType'])
+
+        return File(identifier=raw_file['id'],
+                    owner=owner,
+                    name=filename,
+                    created_time=created_time,
+                    last_modified_time=modified_time,
+                    last_modified_by=last_modifier,
+                    mime_type=mime_type)
+
+    def _item_owner(self, raw_item):
+        if 'owners' in raw_item:
+            return self._create_or_retrieve_user(raw_item['owners'][0]['displayName'],
+                                                 raw_item['owners'][0]['emailAddress'])
+        # Items in shared drives have no owner
+        return self._owner
+
+    def _last_modifier(self, raw_item, owner):
+        if 'lastModifyingUser' in raw_item and 'emailAddress' in raw_item['lastModifyingUser']:
+            return self._create_or_retrieve_user(raw_item['lastModifyingUser']['displayName'],
+                                                 raw_item['lastModifyingUser']['emailAddress'])
+        # Set the last modifier to be the file owner if no last modified exists
+        return owner
+
+    def _create_root(self, root_directory, drive_root, folders):
+        if root_directory and root_directory.startswith(self.path_prefix):
+            root_directory = root_directory.replace(self.path_prefix + '/', '')
+
+        if not root_directory:
+            self.folders.append(drive_root)
+            return drive_root
+
+        current_folder = drive_root
+        for path in root_directory.split('/'):
+            found_path = False
+            for folder in folders:
+                if folder.parent is current_folder and folder.name == path.rstrip():
+                    found_path = True
+                    current_folder = folder
+                    break
+            if not found_path:
+                raise FileNotFoundError('Couldn\'t find the root folder <{0}> in Drive'.format(root_directory))
 
+        root_folder = self._copy_root(current_folder)
+        root_folder.parent = current_folder
         self.folders.append(root_folder)
         return root_folder
 
-    def _create_child_folders(self, parent_folder, all_folders):
-        for raw_folder in all_folders:
+    def _copy_root(self, current_folder):
+        """ Make the root folder standing in for a folder, named after the path prefix
 
-            if parent_folder.id in raw_folder['parents'] and parent_folder.id != raw_folder['id']:
-                owner = self._create_or_retrieve_user(raw_folder['owners'][0]['displayName'],
-                                                      raw_folder['owners'][0]['emailAddress'])
-                if 'lastModifyingUser' in raw_folder:
-                    last_modifier = self._create_or_retrieve_user(raw_folder['lastModifyingUser']['displayName'],
-                                                                  raw_folder['lastModifyingUser']['emailAddress'])
-                else:
-                    last_modifier = owner
-
-                created_time = raw_folder['createdTime'] if 'createdTime' in raw_folder else ''
-                modified_time = raw_folder['modifiedTime'] if 'modifiedTime' in raw_folder else created_time
-
-                folder_name = raw_folder['name'].rstrip()
-
-                new_folder = Folder(identifier=raw_folder['id'],
-                                    name=folder_name,
-                                    owner=owner,
-                                    parent=parent_folder,
-                                    created_time=created_time,
-                                    last_modified_time=modified_time,
-                                    last_modified_by=last_modifier)
-                self.folders.append(new_folder)
-                self._create_child_folders(parent_folder=new_folder, all_folders=all_folders)
-
-    def _create_files(self, raw_files):
-        for raw_file in raw_files:
-            if 'parents' in raw_file:
-                for folder in self.folders:
-                    if folder.id in raw_file['parents']:
-                        filename = raw_file['name']
-                        if raw_file['mimeType'] == 'application/vnd.google-apps.document'\
-                                and not raw_file['name'].lower().endswith('.docx')\
-                                and not raw_file['name'].lower().endswith('.doc')\
-                                and not raw_file['name'].lower().endswith('.txt'):
-                            filename = filename + '.docx'
-                        elif raw_file['mimeType'] == 'application/vnd.google-apps.spreadsheet'\
-                                and not raw_file['name'].lower().endswith('.xlsx')\
-                                and not raw_file['name'].lower().endswith('.xls'):
-                            filename = filename + '.xlsx'
-                        elif raw_file['mimeType'] == 'application/vnd.google-apps.presentation'\
-                                and not raw_file['name'].lower().endswith('.pptx')\
-                                and not raw_file['name'].lower().endswith('.ppt'):
-                            filename = filename + '.pptx'
-
-                        filename = filename.rstrip()
-
-                        owner = self._create_or_retrieve_user(raw_file['owners'][0]['displayName'],
-                                                              raw_file['owners'][0]['emailAddress'])
-                        if 'lastModifyingUser' in raw_file:
-                            last_modifier = self._create_or_retrieve_user(
-                                raw_file['lastModifyingUser']['displayName'],
-                                raw_file['lastModifyingUser']['emailAddress'])
-                        else:
-                            last_modifier = owner
-
-                        created_time = raw_file['createdTime'] if 'createdTime' in raw_file else ''
-                        modified_time = raw_file['modifiedTime'] if 'modifiedTime' in raw_file else created_time
-
-                        new_file = File(identifier=raw_file['id'],
-                                        owner=owner,
-                                        name=filename,
-                                        parent=folder,
-                                        created_time=created_time,
-                                        last_modified_time=modified_time,
-                                        last_modified_by=last_modifier,
-                                        mime_type=raw_file['mimeType'])
-                        self.files.append(new_file)
+        Args:
+            current_folder (Folder): The folder to start in
+
+        Returns:
+            Folder: The new root folder, with no parent
+        """
+        # Folders store their users by display name (see _make_folder), while the root is keyed by email
+        owner = self._create_or_retrieve_user(current_folder.owner.name, current_folder.owner.email)
+        if current_folder.last_modified_by is current_folder.owner:
+            modified_by = owner
+        else:
+            modified_by = self._create_or_retrieve_user(current_folder.last_modified_by.name,
+                                                        current_folder.last_modified_by.email)
+
+        return Folder(identifier=current_folder.id,
+                      name=self.path_prefix,
+                      owner=owner,
+                      created_time=current_folder.created_time,
+                      last_modified_time=current_folder.last_modified_time,
+                      last_modified_by=modified_by)
+
+    def _generate_paths(self, folders, files):
+        """ Give a path to every folder and file under the root, and drop the rest
+
+        Args:
+            folders ([Folder]): Every folder in the Drive, except "My Drive"
+            files ([File]): Every file in the Drive which is in a folder
+        """
+        # Folder ID to its path, or None if it isn't under the root
+        root_source = self.root.parent
+        self.root.parent = None
+        paths = {self.root.id: self.root.name}
+        for folder in folders:
+            chain = []
+            node = folder
+            while node is not None and node.id not in paths:
+                chain.append(node)
+                node = node.parent
+            path = paths[node.id] if node is not None else None
+            for node in reversed(chain):
+                if path is not None:
+                    path = path + '/' + node.name
+                paths[node.id] = path
+
+        for folder in folders:
+            if folder is not root_source and paths[folder.id] is not None:
+                if folder.parent is root_source:
+                    folder.parent = self.root
+                folder.path = paths[folder.id]
+                self.folders.append(folder)
+
+        for file in files:
+            path = paths.get(file.parent.id) if file.parent else None
+            if path is not None:
+                if file.parent is root_source:
+                    file.parent = self.root
+                file.path = path + '/' + file.name
+                self.files.append(file)
+                self._files_by_path.setdefault(file.path, file)
+
+
+def _prefetch(iterator, depth=2):
+    """ Run an iterator on a background thread, keeping a few items ready ahead of the consumer
+
+    Args:
+        iterator (iterator): Iterator to run
+        depth (int, optional): Maximum number of items to keep ready
+
+    Yields:
+        The items of the iterator, in order. An exception raised by the iterator is re-raised here.
+    """
+    items = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for item in iterator:
+                while not stopped.is_set():
+                    try:
+                        items.put((item, None), timeout=0.5)
+                        break
+                    except queue.Full:
+                        pass
+                if stopped.is_set():
+                    return
+            items.put((done, None))
+        except Exception as err:  # Handed to the consumer
+            items.put((done, err))
+
+    thread = threading.Thread(target=produce, name='drive-listing', daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, err = items.get()
+            if err is not None:
+                raise err
+            if item is done:
+                return
+            yield item
+    finally:
+        stopped.set()
 
 
 class User(object):
@@ -412,6 +989,8 @@ class User(object):
 
     """
 
+    __slots__ = ('name', 'email')
+
     def __init__(self, name, email):
         self.name = name
         self.email = email
@@ -446,6 +1025,10 @@ class File(object):
 
     """
 
+    # Drives can hold millions of files, so don't give each one a __dict__
+    __slots__ = ('id', 'name', 'owner', 'created_time', 'last_modified_time', 'last_modified_by', 'mime_type',
+                 'parent', 'path')
+
     def __init__(self,
                  identifier,
                  name,
@@ -495,6 +1078,8 @@ class Folder(object):
 
     """
 
+    __slots__ = ('id', 'name', 'owner', 'created_time', 'last_modified_time', 'last_modified_by', 'parent', 'path')
+
     def __init__(self,
                  identifier,
                  name,
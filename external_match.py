@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+""" Path matching between Drive and Box within a fixed memory budget
+
+The in-memory matcher in migrate_metadata keeps every Box path in a list and
+looks each Drive path up in it. For trees of millions of files that means
+holding both sides' paths at once. The ExternalMatcher instead writes
+(path, index) records from each side to sorted runs on disk, then joins the
+two sides with a streaming merge which emits matched, missed and duplicate
+paths in path order. Only a bounded buffer per side is ever held in memory.
+
+Records are keyed by the path itself rather than a hash of it, so there are
+no collisions to resolve and the join comes out in the order the reports are
+printed in. Report lists are kept in DiskLists, which spill to disk the same
+way.
+
+"""
+
+# Imports
+import heapq
+import itertools
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import weakref
+
+DEFAULT_MEMORY_BUDGET = 256 * 1024 * 1024  # Bytes
+BUFFER_SHARE = 16  # Each buffer (one per side, one per report list) may use 1/16th of the budget
+RECORD_OVERHEAD = 100  # Approximate bytes held per buffered record, on top of the path itself
+CONSUMED = -1  # Index of a Drive record which only uses up a Box path (e.g. matched through the ledger)
+
+_HEADER = struct.Struct('<qI')
+
+MATCHED = 'matched'
+DRIVE_MISSED = 'drive_missed'
+BOX_MISSED = 'box_missed'
+DUPLICATE = 'duplicate'
+
+
+class _RunWriter(object):
+    """ Buffer (path, index) records, writing each full buffer to disk as a sorted run
+
+    Args:
+        directory (str): Directory for the run files
+        name (str): Prefix of the run files
+        buffer_bytes (int): Approximate bytes to buffer before writing a run
+    """
+
+    def __init__(self, directory, name, buffer_bytes):
+        self._directory = directory
+        self._name = name
+        self._buffer_bytes = buffer_bytes
+        self._buffer = []
+        self._buffered = 0
+        self._runs = []
+
+    def add(self, path, index):
+        self._buffer.append((path, index))
+        self._buffered += sys.getsizeof(path) + RECORD_OVERHEAD
+        if self._buffered >= self._buffer_bytes:
+            self._write_run()
+
+    def _write_run(self):
+        self._buffer.sort()
+        run_path = os.path.join(self._directory, '{0}-{1}.run'.format(self._name, len(self._runs)))
+        with open(run_path, 'wb') as run_file:
+            for path, index in self._buffer:
+                encoded = path.encode('utf-8', 'surrogatepass')
+                run_file.write(_HEADER.pack(index, len(encoded)))
+                run_file.write(encoded)
+        self._runs.append(run_path)
+        self._buffer = []
+        self._buffered = 0
+
+    def records(self):
+        """ Merge the runs and the buffer
+
+        Yields:
+            (str, int): Every record, sorted by path then index
+        """
+        self._buffer.sort()
+        return heapq.merge(*([_read_run(run_path) for run_path in self._runs] + [iter(self._buffer)]))
+
+
+def _read_run(run_path):
+    with open(run_path, 'rb') as run_file:
+        while True:
+            header = run_file.read(_HEADER.size)
+            if not header:
+                return
+            index, length = _HEADER.unpack(header)
+            yield run_file.read(length).decode('utf-8', 'surrogatepass'), index
+
+
+class DiskList(object):
+    """ An append-only list of paths which spills to disk, for the migration reports
+
+    Supports what print_list needs: append, len, sort and iteration. Iteration
+    is always in sorted order, so sort() does nothing. Empty items are counted
+    but not kept, as print_list skips them.
+
+    Args:
+        directory (str): Directory for the run files
+        name (str): Prefix of the run files
+        buffer_bytes (int): Approximate bytes to buffer before writing a run
+        owner (object, optional): Kept alive as long as the list, e.g. the matcher whose directory holds the runs
+    """
+
+    def __init__(self, directory, name, buffer_bytes, owner=None):
+        self._runs = _RunWriter(directory, name, buffer_bytes)
+        self._count = 0
+        self._owner = owner
+
+    def append(self, item):
+        self._count += 1
+        if item:
+            self._runs.add(item, 0)
+
+    def sort(self):
+        pass
+
+    def __len__(self):
+        return self._count
+
+    def __iter__(self):
+        return (path for path, _ in self._runs.records())
+
+
+class ExternalMatcher(object):
+    """ Match Drive and Box files by path through sorted runs on disk
+
+    Add every Drive file with add_drive and every Box file with add_box, then
+    call join. The results follow migrate_metadata's rules: every Drive file
+    at a path is matched to the first Box file at that path, each Drive file
+    uses up one Box file at its path, and a Drive file with none left to use
+    up is a duplicate.
+
+    Args:
+        memory_budget (int, optional): Approximate bytes of memory to use
+        temp_dir (str, optional): Directory in which to create the working directory
+
+    Attributes:
+        directory (str): Working directory for the run files, removed by close() or once the matcher and
+            its report lists are gone
+    """
+
+    def __init__(self, memory_budget=DEFAULT_MEMORY_BUDGET, temp_dir=None):
+        self.directory = tempfile.mkdtemp(prefix='gdmt-match-', dir=temp_dir)
+        # Remove the runs even if the migration fails part way
+        self._cleanup = weakref.finalize(self, shutil.rmtree, self.directory, True)
+        self._buffer_bytes = max(memory_budget // BUFFER_SHARE, 1024)
+        self._drive = _RunWriter(self.directory, 'drive', self._buffer_bytes)
+        self._box = _RunWriter(self.directory, 'box', self._buffer_bytes)
+        self._lists = 0
+
+    def add_drive(self, path, index=CONSUMED):
+        """ Add a Drive file
+
+        Args:
+            path (str): Path of the file
+            index (int, optional): Index of the file in drive.files, or CONSUMED if it only uses up a Box
+                file at its path and shouldn't be matched
+        """
+        self._drive.add(path, index)
+
+    def add_box(self, path, index):
+        """ Add a Box file
+
+        Args:
+            path (str): Path of the file
+            index (int): Index of the file in box.files
+        """
+        self._box.add(path, index)
+
+    def disk_list(self):
+        """ Create a report list which spills to disk alongside the runs
+
+        The working directory isn't removed until the list is gone too, unless close() is called.
+
+        Returns:
+            DiskList: An empty list
+        """
+        self._lists += 1
+        return DiskList(self.directory, 'list{0}'.format(self._lists), self._buffer_bytes, owner=self)
+
+    def join(self):
+        """ Join the Drive and Box records by path
+
+        Yields:
+            (str, str, int, int): Kind of result (MATCHED, DRIVE_MISSED, BOX_MISSED or DUPLICATE), path, and the
+                indexes of the Drive and Box files (or None). Results come in path order.
+        """
+        drive_groups = itertools.groupby(self._drive.records(), key=lambda record: record[0])
+        box_groups = itertools.groupby(self._box.records(), key=lambda record: record[0])
+        drive_path, drive_records = _next_group(drive_groups)
+        box_path, box_records = _next_group(box_groups)
+
+        while drive_path is not None or box_path is not None:
+            if box_path is None or (drive_path is not None and drive_path < box_path):
+                for _, index in drive_records:
+                    if index != CONSUMED:
+                        yield DRIVE_MISSED, drive_path, index, None
+                drive_path, drive_records = _next_group(drive_groups)
+
+            elif drive_path is None or box_path < drive_path:
+                for _, index in box_records:
+                    yield BOX_MISSED, box_path, None, index
+                box_path, box_records = _next_group(box_groups)
+
+            else:
+                box_indexes = [index for _, index in box_records]
+                drive_count = 0
+                for _, index in drive_records:
+                    drive_count += 1
+                    if index != CONSUMED:
+                        yield MATCHED, drive_path, index, box_indexes[0]
+                for _ in range(drive_count - len(box_indexes)):
+                    yield DUPLICATE, drive_path, None, None
+                for index in box_indexes[drive_count:]:
+                    yield BOX_MISSED, box_path, None, index
+                drive_path, drive_records = _next_group(drive_groups)
+                box_path, box_records = _next_group(box_groups)
+
+    def close(self):
+        """ Remove the working directory """
+        self._cleanup()
+
+
+def _next_group(groups):
+    for path, records in groups:
+        return path, records
+    return None, None
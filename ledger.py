@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+""" Durable record of the metadata written to Box in earlier runs
+
+The ledger maps each migrated Drive file to its Box file, along with the
+metadata values written and the Drive modifiedTime at the time. Later runs
+resolve matches by ID first and skip files which haven't changed since, so
+only new, moved or changed files reach the path matcher and the writer.
+
+"""
+
+# Imports
+import json
+import sqlite3
+import time
+from collections import namedtuple
+
+COMMIT_EVERY = 500  # Records buffered between writes, so a crash loses little work
+LOCK_TIMEOUT = 60  # Seconds to wait for another process (e.g. a shard worker) to finish writing
+
+LedgerEntry = namedtuple('LedgerEntry', ['drive_id', 'box_id', 'metadata', 'modified_time'])
+
+
+class Ledger(object):
+    """ SQLite ledger of migrated files
+
+    Records are buffered and written in one short transaction every COMMIT_EVERY records, so the
+    database is never locked while metadata is being written to Box, and several processes (e.g.
+    shard workers) can share the ledger.
+
+    Args:
+        path (str): Path of the database file; created if it doesn't exist
+
+    Attributes:
+        path (str): Path of the database file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = sqlite3.connect(path, timeout=LOCK_TIMEOUT)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS migrated ('
+                                 'drive_id TEXT PRIMARY KEY, '
+                                 'box_id TEXT NOT NULL, '
+                                 'metadata TEXT NOT NULL, '
+                                 'modified_time TEXT, '
+                                 'written_at REAL NOT NULL)')
+        self._connection.commit()
+        # Drive ID to the row to write, or None to delete it
+        self._pending = {}
+
+    def __len__(self):
+        self.commit()
+        return self._connection.execute('SELECT COUNT(*) FROM migrated').fetchone()[0]
+
+    def get(self, drive_id):
+        """ Look up a Drive file
+
+        Args:
+            drive_id (str): Drive ID of the file
+
+        Returns:
+            LedgerEntry: What was written for the file, or None if it isn't in the ledger
+        """
+        if drive_id in self._pending:
+            row = self._pending[drive_id]
+            return LedgerEntry(row[0], row[1], json.loads(row[2]), row[3]) if row else None
+        row = self._connection.execute('SELECT drive_id, box_id, metadata, modified_time FROM migrated '
+                                       'WHERE drive_id = ?', (drive_id,)).fetchone()
+        if row is None:
+            return None
+        return LedgerEntry(row[0], row[1], json.loads(row[2]), row[3])
+
+    def record(self, drive_id, box_id, metadata, modified_time):
+        """ Record the metadata written (or found) for a file
+
+        Args:
+            drive_id (str): Drive ID of the file
+            box_id (str): Box ID of the matched file
+            metadata (dict): Metadata values on the Box file
+            modified_time (str): Drive modifiedTime of the file when the metadata was written
+        """
+        self._pending[drive_id] = (drive_id, box_id, json.dumps(metadata, sort_keys=True), modified_time,
+                                   time.time())
+        if len(self._pending) >= COMMIT_EVERY:
+            self.commit()
+
+    def forget(self, drive_id):
+        """ Remove a file from the ledger (e.g. when its Box file has gone)
+
+        Args:
+            drive_id (str): Drive ID of the file
+        """
+        self._pending[drive_id] = None
+        if len(self._pending) >= COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        """ Write any outstanding records to disk """
+        if not self._pending:
+            return
+        with self._connection:
+            self._connection.executemany('INSERT OR REPLACE INTO migrated VALUES (?, ?, ?, ?, ?)',
+                                         [row for row in self._pending.values() if row])
+            self._connection.executemany('DELETE FROM migrated WHERE drive_id = ?',
+                                         [(drive_id,) for drive_id, row in self._pending.items() if not row])
+        self._pending = {}
+
+    def close(self):
+        """ Commit and close the ledger """
+        self.commit()
+        self._connection.close()
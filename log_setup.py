@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+""" Logging setup for the migration tool
+
+Records are handed to a queue on the calling thread and written out by a
+background listener, so the mapping and matching loops never wait on disk.
+Per-item debug records can be sampled or rate limited before they are queued,
+and the log file is rotated and compressed once it reaches a size limit.
+
+"""
+
+# Imports
+import gzip
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import threading
+import time
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024  # Rotate the log file after 100MB
+DEFAULT_BACKUP_COUNT = 10
+PLAIN_TYPES = (str, int, float, type(None))  # Logged arguments which can be formatted later, on the listener thread
+
+
+class DebugSampler(logging.Filter):
+    """ Sample and rate limit DEBUG records, keyed on their unformatted message
+
+    Because the message template (e.g. 'Matched metadata at %s') is shared by
+    every record for a given kind of item, it is used as the key so that each
+    kind of per-item message is sampled independently.
+
+    Args:
+        sample_every (int, optional): Keep one in every N records for each message (1 keeps all)
+        max_per_second (float, optional): Maximum records per second for each message (0 for no limit)
+
+    """
+
+    def __init__(self, sample_every=1, max_per_second=0):
+        super(DebugSampler, self).__init__()
+        self._sample_every = max(int(sample_every), 1)
+        self._max_per_second = max_per_second
+        self._counts = {}
+        self._windows = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+
+        with self._lock:
+            count = self._counts.get(record.msg, 0)
+            self._counts[record.msg] = count + 1
+            if count % self._sample_every:
+                return False
+
+            if self._max_per_second:
+                now = int(time.time())
+                window, emitted = self._windows.get(record.msg, (now, 0))
+                if window != now:
+                    window, emitted = now, 0
+                if emitted >= self._max_per_second:
+                    return False
+                self._windows[record.msg] = (window, emitted + 1)
+        return True
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """ Queue handler which leaves the formatting to the listener thread where it can
+
+    The stock QueueHandler formats every record before queueing it, which puts
+    the cost back on the calling thread. A record whose arguments are all plain
+    strings and numbers is queued as-is, as they can't change before the
+    listener formats it. One with any other argument (e.g. a Folder or the
+    parsed args) is formatted first, so it logs the object as it was.
+    """
+
+    def prepare(self, record):
+        if record.args:
+            values = record.args.values() if isinstance(record.args, dict) else record.args
+            if not all(isinstance(value, PLAIN_TYPES) for value in values):
+                record.msg = record.getMessage()
+                record.args = None
+        return record
+
+
+def _compressed_name(name):
+    return name + '.gz'
+
+
+def _compress_rotated(source, dest):
+    """ Rotator which gzips the rotated log file
+
+    Args:
+        source (str): Path of the log file being rotated
+        dest (str): Path of the compressed backup
+    """
+    with open(source, 'rb') as source_file, gzip.open(dest, 'wb') as dest_file:
+        shutil.copyfileobj(source_file, dest_file)
+    os.remove(source)
+
+
+def setup_logging(log_file, console_level=logging.INFO, sample_every=1, max_per_second=0,
+                  max_bytes=DEFAULT_MAX_BYTES, backup_count=DEFAULT_BACKUP_COUNT):
+    """ Route all logging through a queue to a rotating log file and the console
+
+    Args:
+        log_file (str): Path of the log file
+        console_level (int/str, optional): Logging level for console output
+        sample_every (int, optional): Keep one in every N debug records for each message
+        max_per_second (float, optional): Maximum debug records per second for each message (0 for no limit)
+        max_bytes (int, optional): Size at which the log file is rotated (0 to never rotate)
+        backup_count (int, optional): Number of compressed backups to keep
+
+    Returns:
+        QueueListener: The started listener, which must be stopped to flush the log on exit
+    """
+    file_handler = logging.handlers.RotatingFileHandler(log_file, 'a', maxBytes=max_bytes,
+                                                        backupCount=backup_count, encoding='utf-8')
+    file_handler.namer = _compressed_name
+    file_handler.rotator = _compress_rotated
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    file_handler.setLevel(logging.DEBUG)
+
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(console_level)
+
+    log_queue = queue.Queue(-1)
+    queue_handler = _DeferredQueueHandler(log_queue)
+    if sample_every > 1 or max_per_second:
+        queue_handler.addFilter(DebugSampler(sample_every=sample_every, max_per_second=max_per_second))
+
+    root_logger = logging.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(queue_handler)
+    root_logger.setLevel(logging.DEBUG)
+
+    listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler,
+                                              respect_handler_level=True)
+    listener.start()
+    return listener
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+""" Manifests of (Drive root, Box root) pairs migrated together in one run
+
+Each section of a manifest is one pair. Drive is listed once for the whole
+manifest, at the deepest folder holding every pair's Drive root, and each
+pair's Drive is then cut out of that listing (see Drive.subtree).
+
+Manifest format:
+    [finance]
+    rootdrive = Departments/Finance
+    rootbox = Finance
+    reportfile = reports/finance.txt
+
+    [legal]
+    rootdrive = Departments/Legal
+    rootbox = Legal
+
+rootdrive and rootbox are paths as given to -r and -R, and are the root of
+Drive or Box if left out. reportfile is optional; without it, a pair's report
+is printed along with the others.
+
+"""
+
+# Imports
+import configparser
+from collections import namedtuple
+
+CRAWL_THREADS = 4  # Box roots crawled at once
+
+# The Drive root is stored without the path prefix; None stands for the root of Drive/Box, or no report file
+RootPair = namedtuple('RootPair', ['name', 'root_drive', 'root_box', 'report_file'])
+
+
+def read_manifest(path, path_prefix):
+    """ Read the root pairs from a manifest file
+
+    Args:
+        path (str): Path to the manifest file
+        path_prefix (str): The prefix Drive paths may start with (e.g. "D:")
+
+    Returns:
+        [RootPair]: The pairs, in the order of the file
+
+    Raises:
+        FileNotFoundError: If the file can't be read
+        ValueError: If the file has no pairs
+    """
+    cfg = configparser.ConfigParser()
+    if not cfg.read(path):
+        raise FileNotFoundError('Couldn\'t read the manifest file <{0}>'.format(path))
+
+    pairs = []
+    for name in cfg.sections():
+        section = cfg[name]
+        root_drive = section.get('rootdrive', '').strip()
+        if root_drive.startswith(path_prefix):
+            root_drive = root_drive[len(path_prefix):]
+        pairs.append(RootPair(name=name,
+                              root_drive=root_drive.strip('/') or None,
+                              root_box=section.get('rootbox', '').strip() or None,
+                              report_file=section.get('reportfile', '').strip() or None))
+    if not pairs:
+        raise ValueError('The manifest file <{0}> has no root pairs'.format(path))
+    return pairs
+
+
+def common_root(pairs):
+    """ Find the deepest Drive folder holding every pair's Drive root
+
+    Args:
+        pairs ([RootPair]): The pairs
+
+    Returns:
+        (str, [str]): Path to the common folder (or None for the root), and each pair's Drive root relative
+            to it (or None if it is the common folder)
+    """
+    split_roots = [pair.root_drive.split('/') if pair.root_drive else [] for pair in pairs]
+    common = []
+    for names in zip(*split_roots):
+        if any(name.rstrip() != names[0].rstrip() for name in names):
+            break
+        common.append(names[0])
+
+    relative_roots = ['/'.join(names[len(common):]) or None for names in split_roots]
+    return '/'.join(common) or None, relative_roots
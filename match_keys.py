@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+""" Canonical keys for matching paths which are written differently in Drive and Box
+
+Names don't always come through a migration unchanged: Box may hold them in
+another Unicode normal form, in another case, with trailing spaces, with '/'
+written as "002f", or without the extension added to exported Google files.
+Each level's key is looser than the one before, and a Box file is indexed by
+its key at every level up to the one chosen, so a Drive path that doesn't
+match exactly can be looked up level by level, strictest first.
+
+Levels:
+    exact    The path as built
+    unicode  NFC normal form, without trailing whitespace in each name
+    case     ... and in any case
+    loose    ... and NFKC normal form, with runs of whitespace collapsed, a "002f" standing on its own read
+             as '/', and " - Modify" dropped from the end of a name. A Google file's key also drops the
+             extension added when it's exported (e.g. ".xlsx" for a Google Sheet), so it matches a Box
+             file without one.
+
+"""
+
+# Imports
+import re
+import unicodedata
+
+EXACT = 'exact'
+UNICODE = 'unicode'
+CASE = 'case'
+LOOSE = 'loose'
+LEVELS = [EXACT, UNICODE, CASE, LOOSE]  # Strictest first
+
+# Extension added to the name of each type of Google file when it's exported
+EXPORT_EXTENSIONS = {'application/vnd.google-apps.document': '.docx',
+                     'application/vnd.google-apps.spreadsheet': '.xlsx',
+                     'application/vnd.google-apps.presentation': '.pptx'}
+
+_WHITESPACE = re.compile(r'\s+')
+_SLASH = re.compile(r'(?<![^\s/])002f(?![^\s/])')  # "002f" between spaces or the ends of a name
+_MODIFY = re.compile(r' - modify(?=(\.[^.]*)?$)')  # " - Modify" at the end of a name, or before its extension
+
+
+def match_keys(path, level=LOOSE, mime_type=None):
+    """ Compute the keys of a path at each level after exact, up to a given level
+
+    Args:
+        path (str): The path
+        level (str, optional): The loosest level
+        mime_type (str, optional): MIME type of the Drive file at the path, so a Google file's export
+            extension can be dropped from its loose key. Leave out for Box files.
+
+    Returns:
+        [(str, str)]: Each level and the path's key at it, strictest first
+    """
+    keys = []
+    last = LEVELS.index(level)
+    if last >= LEVELS.index(UNICODE):
+        path = '/'.join(name.rstrip() for name in unicodedata.normalize('NFC', path).split('/'))
+        keys.append((UNICODE, path))
+    if last >= LEVELS.index(CASE):
+        path = path.casefold()
+        keys.append((CASE, path))
+    if last >= LEVELS.index(LOOSE):
+        # Read the same way as a '/' in a Drive name, which the path doesn't tell apart from a separator
+        names = _SLASH.sub('/', unicodedata.normalize('NFKC', path).casefold()).split('/')
+        extension = EXPORT_EXTENSIONS.get(mime_type)
+        if extension and names[-1].endswith(extension):
+            names[-1] = names[-1][:-len(extension)]
+        names = [_MODIFY.sub('', _WHITESPACE.sub(' ', name).strip()) for name in names]
+        keys.append((LOOSE, '/'.join(names)))
+    return keys
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+""" Check the memory of the object model and the matcher against budgets
+
+Builds the Drive and Box from synthetic trees of each size, as benchmark.py
+does, and measures:
+
+    * the bytes held per File, Folder, BoxObject and User (the object and the
+      strings it owns, each string counted once however many nodes share it)
+    * the peak memory traced while matching (migrate_metadata) and while
+      printing the report, per Drive file
+    * the peak memory traced over the whole run, from which a linear scaling
+      curve is fitted to estimate the memory a run of a given size will need
+
+A small tree is measured first and thrown away, so the one-off allocations of
+the first run (imports, interned strings, compiled regexes) aren't counted
+against the first size.
+
+Any measure over its budget is listed and the script exits with status 1, so
+a change which makes the nodes or the matcher bigger shows up before a worker
+runs out of memory in the middle of a migration. So is a scaling curve whose
+bytes per item aren't positive, or are over budget, as no estimate can be
+made from it.
+
+Usage:
+    python3 memory_budget.py --sizes 10000,50000,100000 --items 2000000
+
+"""
+
+# Imports
+from __future__ import print_function
+
+import argparse
+import gc
+import io
+import logging
+import sys
+import tracemalloc
+
+import box_interface
+import drive_interface
+import migration
+import synthetic
+
+PATH_ROOT = 'D:'
+DEFAULT_SIZES = '10000,50000,100000'
+NODE_BUDGETS = {'File': 640, 'Folder': 640, 'BoxObject': 480, 'User': 224}  # Bytes per node
+PEAK_BUDGETS = {'match': 160, 'report': 200}  # Peak bytes per Drive file
+SCALING_BUDGET = 1536  # Traced bytes per item of the scaling curve
+WARMUP_SIZE = 1000  # Size of the tree measured and thrown away before the others
+HEADROOM = 2.5  # Process memory per traced byte (interpreter, fragmentation and untraced buffers)
+
+NODE_ATTRIBUTES = ('id', 'name', 'path', 'created_time', 'last_modified_time', 'mime_type', 'email')
+
+
+def build_arg_parser():
+    """ Build and return an args parser
+
+    Returns:
+        argparse: Args parser
+    """
+    parser = argparse.ArgumentParser(description='Check the memory used by the Drive Migration Tool against budgets.')
+    parser.add_argument('--sizes', type=str, default=DEFAULT_SIZES,
+                        help='Comma separated tree sizes (total files and folders) to measure')
+    parser.add_argument('--depth', type=int, default=8,
+                        help='Maximum folder depth of the synthetic trees')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed for the synthetic trees')
+    parser.add_argument('--items', type=int, default=0,
+                        help='Estimate the memory needed to migrate this many Drive files and folders')
+    return parser
+
+
+def node_sizes(drive, box):
+    """ Find the average bytes held per node of each type
+
+    Args:
+        drive (Drive): A mapped Drive
+        box (Box): A mapped Box
+
+    Returns:
+        dict: Node type to its average bytes (None if there are no nodes of the type)
+    """
+    seen = set()
+    sizes = {}
+    for node_type, nodes in (('User', drive.users),
+                             ('Folder', drive.folders),
+                             ('File', drive.files),
+                             ('BoxObject', box.folders + box.files)):
+        total = sum(_owned_size(node, seen) for node in nodes)
+        sizes[node_type] = float(total) / len(nodes) if nodes else None
+    return sizes
+
+
+def measure_size(size, depth=8, seed=0):
+    """ Build the Drive and Box for a tree of one size, match them and print the report, measuring memory
+
+    Args:
+        size (int): Tree size
+        depth (int, optional): Maximum folder depth of the tree
+        seed (int, optional): Random seed for the tree
+
+    Returns:
+        dict: Item counts, bytes per node type, peak bytes per Drive file of the match and report, and the
+            peak bytes of the whole run
+    """
+    logger = logging.getLogger('memory_budget')
+    tree = synthetic.SyntheticTree(size, max_depth=depth, seed=seed)
+
+    gc.collect()
+    tracemalloc.start()
+    drive = drive_interface.Drive(path_prefix=PATH_ROOT, service=synthetic.SyntheticDriveService(tree), logger=logger)
+    box = box_interface.Box(path_prefix=PATH_ROOT, client=synthetic.SyntheticBoxClient(tree), logger=logger)
+
+    # Each phase's peak is measured from a reset, so the run's peak is the highest of them (or of the build)
+    run_peak = tracemalloc.get_traced_memory()[1]
+    peaks = {}
+
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    report = migration.migrate_metadata(box=box, drive=drive, test_only=True)
+    peak = tracemalloc.get_traced_memory()[1]
+    peaks['match'] = peak - before
+    run_peak = max(run_peak, peak)
+
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    migration.print_report(report, print_file=io.StringIO())
+    peak = tracemalloc.get_traced_memory()[1]
+    peaks['report'] = peak - before
+    run_peak = max(run_peak, peak)
+    tracemalloc.stop()
+
+    items = len(drive.files) + len(drive.folders)
+    return {'items': items,
+            'drive_files': len(drive.files),
+            'nodes': node_sizes(drive, box),
+            'peaks': {phase: float(peak) / max(len(drive.files), 1) for phase, peak in peaks.items()},
+            'run_peak': run_peak}
+
+
+def measure_sizes(sizes, depth=8, seed=0):
+    """ Measure a tree of each size, after a warm-up run whose results are thrown away
+
+    Args:
+        sizes ([int]): Tree sizes
+        depth (int, optional): Maximum folder depth of the trees
+        seed (int, optional): Random seed for the trees
+
+    Returns:
+        iter(dict): Results of measure_size for each size, as each is measured
+    """
+    measure_size(WARMUP_SIZE, depth=depth, seed=seed)
+    for size in sizes:
+        yield measure_size(size, depth=depth, seed=seed)
+
+
+def fit_curve(points):
+    """ Fit a line through (items, bytes) points by least squares
+
+    Args:
+        points ([(int, int)]): Item counts and the peak bytes of their runs
+
+    Returns:
+        (float, float): The fixed bytes and the bytes per item
+    """
+    if len(points) == 1:
+        return 0.0, float(points[0][1]) / points[0][0]
+    mean_items = float(sum(items for items, _ in points)) / len(points)
+    mean_bytes = float(sum(peak for _, peak in points)) / len(points)
+    spread = sum((items - mean_items) ** 2 for items, _ in points)
+    per_item = sum((items - mean_items) * (peak - mean_bytes) for items, peak in points) / spread
+    return mean_bytes - per_item * mean_items, per_item
+
+
+def over_budget(results, curve=None):
+    """ List the measures over their budgets
+
+    Args:
+        results ([dict]): Results of measure_size
+        curve ((float, float), optional): The scaling curve fitted to the results (see fit_curve)
+
+    Returns:
+        [str]: A description of each measure over its budget
+    """
+    failures = []
+    if curve:
+        per_item = curve[1]
+        if per_item <= 0:
+            failures.append('Scaling curve: {0:.0f} bytes per item isn\'t positive; measure larger sizes'.format(
+                per_item))
+        elif per_item > SCALING_BUDGET:
+            failures.append('Scaling curve: {0:.0f} bytes per item (budget {1})'.format(per_item, SCALING_BUDGET))
+    for result in results:
+        for node_type, budget in sorted(NODE_BUDGETS.items()):
+            size = result['nodes'].get(node_type)
+            if size is not None and size > budget:
+                failures.append('{0} items: {1} holds {2:.0f} bytes (budget {3})'.format(
+                    result['items'], node_type, size, budget))
+        for phase, budget in sorted(PEAK_BUDGETS.items()):
+            if result['peaks'][phase] > budget:
+                failures.append('{0} items: {1} peaks at {2:.0f} bytes per file (budget {3})'.format(
+                    result['items'], phase, result['peaks'][phase], budget))
+    return failures
+
+
+def _owned_size(node, seen):
+    size = sys.getsizeof(node)
+    if hasattr(node, '__dict__'):
+        size += sys.getsizeof(node.__dict__)
+    for attribute in NODE_ATTRIBUTES:
+        value = getattr(node, attribute, None)
+        if isinstance(value, str) and id(value) not in seen:
+            seen.add(id(value))
+            size += sys.getsizeof(value)
+    return size
+
+
+def _format_bytes(size):
+    return '{0:.1f}MB'.format(size / (1024.0 * 1024.0))
+
+
+if __name__ == '__main__':
+    args = build_arg_parser().parse_args()
+    logging.getLogger('memory_budget').setLevel(logging.WARNING)
+
+    results = []
+    for result in measure_sizes([int(size) for size in args.sizes.split(',')], depth=args.depth, seed=args.seed):
+        print('Measured a tree of {0} items'.format(result['items']))
+        results.append(result)
+        print('\t{0}'.format(', '.join('{0} {1:.0f}B'.format(node_type, result['nodes'][node_type])
+                                       for node_type in sorted(NODE_BUDGETS) if result['nodes'][node_type])))
+        print('\tmatch {0:.0f}B/file, report {1:.0f}B/file, run peak {2}'.format(
+            result['peaks']['match'], result['peaks']['report'], _format_bytes(result['run_peak'])))
+
+    fixed, per_item = fit_curve([(result['items'], result['run_peak']) for result in results])
+    print('Scaling curve: {0} + {1:.0f} bytes per item (traced)'.format(_format_bytes(fixed), per_item))
+    if args.items and per_item > 0:
+        estimate = (max(fixed, 0.0) + per_item * args.items) * HEADROOM
+        print('Estimated memory for {0} items: {1:.2f}GB'.format(args.items, estimate / (1024.0 ** 3)))
+
+    failures = over_budget(results, curve=(fixed, per_item))
+    if failures:
+        print('Over budget:')
+        for failure in failures:
+            print('\t{0}'.format(failure))
+        sys.exit(1)
+    print('Every measure is within its budget.')
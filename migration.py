@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+""" Matching and reporting between a source Drive and a destination Box
+
+"""
+
+# Imports
+from __future__ import print_function
+
+import collections
+import functools
+
+import box_interface
+import match_keys
+import write_behind
+
+
+def under(path, root):
+    """ Check whether a path is at or below another
+
+    Args:
+        path (str): The path
+        root (str): The path it may be under (e.g. "D:/Folder"), or None for everything
+
+    Returns:
+        bool: Whether the path is under the root
+    """
+    if not root:
+        return True
+    root = root.rstrip('/')
+    return path == root or path.startswith(root + '/')
+
+
+def migrate_metadata(box, drive, print_details=False, print_file=None, logger=None, test_only=True,
+                     progress_reporter=None, ledger=None, memory_budget=None, temp_dir=None, writer=None,
+                     subtree=None):
+    """ Move the metadata from Drive to Box
+
+    With a ledger, files migrated by an earlier run are matched by ID rather than path. They are skipped if
+    they haven't changed in Drive since, and have their metadata updated if they have. An entry whose Box
+    file has gone is dropped, and the file is matched by path again.
+
+    With a memory budget, paths are matched through sorted runs on disk (see external_match) rather than
+    in memory, and the report lists are kept on disk too.
+
+    Without one, a Drive file with no Box file at its exact path is matched by the looser keys of its path,
+    up to the Box's match level (see match_keys), unless the Box file found is at the exact path of another
+    Drive file or has already been matched by its key. These matches are listed in the report's normalized
+    section. A Drive file whose key is held by several Box files isn't matched, and is listed in the
+    ambiguous section (as well as missed).
+
+    With a write-behind queue, matching carries on while the metadata is written, and the queue is flushed
+    before the report is built. Files whose metadata couldn't be written are listed in the report's failed
+    section rather than stopping the migration.
+
+    Args:
+        box (Box): The box object for metadata to be migrated to
+        drive (Drive): The drive object for metadata to be migrated from
+        print_details (bool, optional): Whether to print details of matched, missed, and duplicate files
+        print_file (file, optional): The file to which any logging should be printed
+        logger (logger, optional): Logging file
+        test_only (bool, optional): Whether to update the metadata in Box
+        progress_reporter (ProgressReporter, optional): Reporter tracking the files matched or written
+        ledger (Ledger, optional): Ledger of files migrated by earlier runs, updated with the files written
+        memory_budget (int, optional): Approximate bytes of memory the matching may use
+        temp_dir (str, optional): Directory for the on-disk runs when matching within a memory budget
+        writer (WriteBehindQueue, optional): Queue through which the metadata is written (see write_behind)
+        subtree (str, optional): Only match the Drive files at or under this path (e.g. "D:/Folder"), and only
+            report the Box files and pruned folders under it
+
+    Returns:
+        dict: The paths in each section of the report (see print_report)
+    """
+
+    if logger:
+        logger.debug('Matching files between Drive at %s and Box at %s', drive.root.path,
+                     box.root_directory or 'the root')
+
+    matcher = None
+    if memory_budget:
+        import external_match
+        matcher = external_match.ExternalMatcher(memory_budget=memory_budget, temp_dir=temp_dir)
+        new_list = matcher.disk_list
+    else:
+        new_list = list
+
+    matched_files = new_list()
+    existing_metadata_files = new_list()
+    box_missed_files = new_list()
+    drive_missed_files = new_list()
+    duplicate_files = new_list()
+    unchanged_files = new_list()
+    changed_files = new_list()
+    normalized_files = new_list()
+    failed_files = new_list()
+    ambiguous_files = new_list()
+
+    # Box paths not matched yet, each with the number of Box files at it, so a match is crossed off in one step
+    box_unmatched = collections.Counter()
+    if not matcher:
+        for box_file in box.files:
+            if box_file.path:
+                box_unmatched[box_file.path] += 1
+
+    if progress_reporter:
+        progress_reporter.begin_phase('matching', total=len(drive.files))
+
+    def mark_matched(box_file):
+        if matcher:
+            # Uses up the Box file when the runs are joined
+            if box_file.path:
+                matcher.add_drive(box_file.path)
+            return
+        if box_unmatched[box_file.path]:
+            box_unmatched[box_file.path] -= 1
+        else:
+            # Add to the duplicates list if we've already matched a file at this path
+            duplicate_files.append(box_file.path)
+            if logger:
+                logger.debug('Found a duplicate at %s', box_file.path)
+
+    def applied(drive_file, box_file, written, error=None):
+        if error is not None:
+            failed_files.append(drive_file.path)
+            return
+        if written:
+            matched_files.append(drive_file.path)
+            if logger:
+                logger.debug('Wrote metadata at %s', drive_file.path)
+        else:
+            existing_metadata_files.append(drive_file.path)
+            if logger:
+                logger.debug('Metadata already exists at %s', drive_file.path)
+        if ledger is not None:
+            # Files which already had metadata are recorded too, so they aren't checked again
+            ledger.record(drive_file.id, box_file.id, box_interface.metadata_values(drive_file),
+                          drive_file.last_modified_time)
+
+    def updated(drive_file, box_file, values, written=True, error=None):
+        if error is not None:
+            failed_files.append(drive_file.path)
+            return
+        ledger.record(drive_file.id, box_file.id, values, drive_file.last_modified_time)
+        changed_files.append(drive_file.path)
+        if logger:
+            logger.debug('Changed since the last run at %s', drive_file.path)
+
+    def write_matched(drive_file, box_file):
+        if not test_only:
+            if writer:
+                writer.submit(box_file, drive_file, callback=functools.partial(applied, drive_file, box_file))
+            else:
+                applied(drive_file, box_file, box.apply_metadata(box_file, drive_file))
+        else:
+            matched_files.append(drive_file.path)
+            if logger:
+                logger.debug('Matched metadata at %s', drive_file.path)
+
+    for index, drive_file in enumerate(drive.files):
+        if progress_reporter:
+            progress_reporter.items += 1
+        if drive_file.path and under(drive_file.path, subtree):
+            entry = ledger.get(drive_file.id) if ledger is not None else None
+            box_file = box.get_file_via_id(entry.box_id) if entry else None
+            if entry and not box_file and not test_only:
+                # The Box file has gone, so the entry is dropped and the file is matched by path again
+                ledger.forget(drive_file.id)
+            if box_file:
+                # Migrated by an earlier run, so the match is already known
+                mark_matched(box_file)
+                values = box_interface.metadata_values(drive_file)
+                if entry.modified_time == drive_file.last_modified_time and entry.metadata == values:
+                    unchanged_files.append(drive_file.path)
+                    if logger:
+                        logger.debug('Unchanged since the last run at %s', drive_file.path)
+                elif test_only:
+                    changed_files.append(drive_file.path)
+                    if logger:
+                        logger.debug('Changed since the last run at %s', drive_file.path)
+                elif writer:
+                    writer.submit(box_file, drive_file, kind=write_behind.UPDATE,
+                                  callback=functools.partial(updated, drive_file, box_file, values))
+                else:
+                    box.update_metadata(box_file, drive_file)
+                    updated(drive_file, box_file, values)
+                continue
+
+            if matcher:
+                matcher.add_drive(drive_file.path, index)
+                continue
+
+            box_file, level, candidates = box.match_file(drive_file.path, mime_type=drive_file.mime_type)
+            if candidates:
+                ambiguous_files.append('{0} -> {1}'.format(drive_file.path, ', '.join(candidates)))
+                if logger:
+                    logger.debug('Not matching %s, as its %s key is held by %s Box files', drive_file.path, level,
+                                 len(candidates))
+            elif box_file and level != match_keys.EXACT:
+                if drive.get_file_via_path(box_file.path) not in (None, drive_file):
+                    # The Box file is another Drive file's exact match
+                    box_file = None
+                elif not box_unmatched[box_file.path]:
+                    # Another Drive file has already been matched to it by its key, so it isn't written twice
+                    if logger:
+                        logger.debug('Not matching %s to %s, which is already matched', drive_file.path,
+                                     box_file.path)
+                    box_file = None
+                else:
+                    normalized_files.append('{0} -> {1}'.format(drive_file.path, box_file.path))
+                    if logger:
+                        logger.debug('Matched %s to %s by its %s key', drive_file.path, box_file.path, level)
+            if box_file:
+                write_matched(drive_file, box_file)
+                mark_matched(box_file)
+            else:
+                drive_missed_files.append(drive_file.path)
+                if logger:
+                    logger.debug('Failed to match file at %s', drive_file.path)
+
+    if matcher:
+        for index, box_file in enumerate(box.files):
+            if box_file.path and under(box_file.path, subtree):
+                matcher.add_box(box_file.path, index)
+
+        if progress_reporter:
+            progress_reporter.begin_phase('joining')
+        for kind, path, drive_index, box_index in matcher.join():
+            if progress_reporter:
+                progress_reporter.items += 1
+            if kind == external_match.MATCHED:
+                write_matched(drive.files[drive_index], box.files[box_index])
+            elif kind == external_match.DRIVE_MISSED:
+                drive_missed_files.append(path)
+                if logger:
+                    logger.debug('Failed to match file at %s', path)
+            elif kind == external_match.BOX_MISSED:
+                box_missed_files.append(path)
+            else:
+                duplicate_files.append(path)
+                if logger:
+                    logger.debug('Found a duplicate at %s', path)
+
+    if not matcher:
+        box_missed_files.extend(path for path in box_unmatched.elements() if under(path, subtree))
+
+    if writer:
+        writer.flush()
+
+    report = {'matched': matched_files,
+              'existing_metadata': existing_metadata_files,
+              'drive_missed': drive_missed_files,
+              'box_missed': box_missed_files,
+              'duplicates': duplicate_files,
+              'pruned_folders': [folder.path for folder in box.pruned_folders if under(folder.path, subtree)]}
+    if normalized_files:
+        report['normalized'] = normalized_files
+    if failed_files:
+        report['failed'] = failed_files
+    if ambiguous_files:
+        report['ambiguous'] = ambiguous_files
+    if box.search_query:
+        report['searched_for'] = [box.search_query]
+    if ledger is not None:
+        report['unchanged'] = unchanged_files
+        report['changed'] = changed_files
+
+    if print_details:
+        print_report(report, test_only=test_only, print_file=print_file)
+
+    # With a memory budget, the matcher's working directory is removed once the report lists are gone
+    return report
+
+
+def print_report(report, test_only=True, print_file=None):
+    """ Print the matched, missed, and duplicate files of a migration
+
+    Args:
+        report (dict): The paths in each section, from migrate_metadata (or merge_reports). The unchanged and
+            changed sections are only printed if present, i.e. if a ledger was used, the normalized and
+            ambiguous sections only if any files were matched (or left unmatched) by a looser key than their
+            exact path, the failed section only if any writes through a write-behind queue failed, and the
+            searched_for section only if the Box was mapped through search.
+        test_only (bool, optional): Whether the metadata was only matched rather than written
+        print_file (file, optional): The file to which any logging should be printed
+    """
+
+    if test_only:
+        print_list(list_to_print=report['matched'],
+                   header_message='Matched paths for {0} Files:'.format(str(len(report['matched']))),
+                   print_file=print_file)
+
+    else:
+        print_list(list_to_print=report['existing_metadata'],
+                   header_message='Found existing metadata for {0} matched Files:'.format(
+                       str(len(report['existing_metadata']))),
+                   print_file=print_file)
+
+        print_list(list_to_print=report['matched'],
+                   header_message='Added metadata for {0} matched Files:'.format(str(len(report['matched']))),
+                   print_file=print_file)
+
+    print_list(list_to_print=report['drive_missed'],
+               header_message='Failed to Match {0} File paths from Drive:'.format(str(len(report['drive_missed']))),
+               print_file=print_file)
+
+    print_list(list_to_print=report['box_missed'],
+               header_message='Failed to Match {0} File pathss from Box:'.format(str(len(report['box_missed']))),
+               print_file=print_file)
+
+    print_list(list_to_print=report['duplicates'],
+               header_message='Found {0} Duplicate Files:'.format(str(len(report['duplicates']))),
+               print_file=print_file)
+
+    if report.get('failed'):
+        print_list(list_to_print=report['failed'],
+                   header_message='Failed to write metadata for {0} matched Files:'.format(
+                       str(len(report['failed']))),
+                   print_file=print_file)
+
+    if report.get('normalized'):
+        print_list(list_to_print=report['normalized'],
+                   header_message='Matched {0} Files by a normalized path (Drive path -> Box path):'.format(
+                       str(len(report['normalized']))),
+                   print_file=print_file)
+
+    if report.get('ambiguous'):
+        print_list(list_to_print=report['ambiguous'],
+                   header_message='Skipped {0} Files whose normalized path matches several in Box '
+                                  '(Drive path -> Box paths):'.format(str(len(report['ambiguous']))),
+                   print_file=print_file)
+
+    if 'unchanged' in report:
+        print_list(list_to_print=report['unchanged'],
+                   header_message='Skipped {0} Files unchanged since the last run:'.format(
+                       str(len(report['unchanged']))),
+                   print_file=print_file)
+
+        print_list(list_to_print=report['changed'],
+                   header_message='{0} metadata for {1} Files changed since the last run:'.format(
+                       'Found' if test_only else 'Updated', str(len(report['changed']))),
+                   print_file=print_file)
+
+    if report.get('searched_for'):
+        # Merged reports hold the query once per shard
+        print_list(list_to_print=sorted(set(report['searched_for'])),
+                   header_message='Mapped Box through search, so only Box Files matching these queries were found '
+                                  'and Box Files with other extensions aren\'t listed as missed:',
+                   print_file=print_file)
+
+    if report['pruned_folders']:
+        print_list(list_to_print=report['pruned_folders'],
+                   header_message='Skipped {0} Folder paths from Box which aren\'t in Drive:'.format(
+                       str(len(report['pruned_folders']))),
+                   print_file=print_file)
+
+
+def merge_reports(reports):
+    """ Combine the reports of several migrations (e.g. of each shard) into one
+
+    Args:
+        reports (iter(dict)): Reports from migrate_metadata
+
+    Returns:
+        dict: The paths in each section of any of the reports
+    """
+
+    merged = {}
+    for report in reports:
+        for section, paths in report.items():
+            merged.setdefault(section, []).extend(paths)
+    return merged
+
+
+def check_metadata(box, metadata_name, print_file=None, logger=None):
+    """ Check for metadata of the specified type on files in Box
+
+    Args:
+        box (Box): The list to be printed
+        metadata_name (str): The name of the metadata to search for
+        print_file (file, optional): The file to which any logging should be printed
+        logger (logger, optional): Logging file
+    """
+
+    hits = []
+    misses = []
+    for file in box.files:
+        if box.check_metadata(file, metadata_name):
+            hits.append(file.path)
+            if logger:
+                logger.debug('Found metadata for %s', file.path)
+        else:
+            misses.append(file.path)
+            if logger:
+                logger.debug('Failed to find metadata for %s', file.path)
+
+    print_list(list_to_print=hits,
+               header_message='Found metadata for {0} File Paths:'.format(str(len(hits))),
+               print_file=print_file)
+
+    print_list(list_to_print=misses,
+               header_message='Failed to find metadata for {0} File Paths:'.format(str(len(misses))),
+               print_file=print_file)
+
+
+def print_list(list_to_print, header_message=None, footer_message=None, prefix='\t', print_file=None):
+    """ Sort and print out a list of strings, along with optional header and footer messages
+
+    Args:
+        list_to_print ([String]): The list to be printed
+        prefix (String, optional): The prefix to put in front of each item in the list. Default is a tab
+        print_file (file, optional): The file to which any logging should be printed
+        header_message (String, optional): A message to be displayed before the list is printed
+        footer_message (String, optional): A message to be displayed after the list is printed
+    """
+
+    list_to_print.sort()
+    if header_message:
+        print(header_message, file=print_file)
+    for list_item in list_to_print:
+        if list_item:
+            print((prefix + list_item), file=print_file)
+    if footer_message:
+        print(footer_message, file=print_file)
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+""" Progress reporting for long-running mapping and migration phases
+
+The reporter keeps plain integer counters which the mapping and matching loops
+bump directly. A background thread samples the counters at a fixed interval to
+derive throughput and an ETA, so the hot path never formats or writes anything.
+
+"""
+
+# Imports
+from __future__ import print_function
+
+import json
+import os
+import threading
+import time
+
+DEFAULT_INTERVAL = 10.0  # Seconds between progress reports
+
+
+class ProgressReporter(object):
+    """ Periodically report item/request throughput and an ETA for the current phase
+
+    Args:
+        interval (float, optional): Seconds between reports
+        status_file (str, optional): Path of a JSON status file to rewrite on every report
+        logger (logger, optional): Logging file to which the progress lines are written
+
+    Attributes:
+        phase (str): Name of the phase currently being tracked
+        items (int): Items processed in the current phase
+        requests (int): API requests made in the current phase
+        total (int): Expected number of items in the current phase, if known
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL, status_file=None, logger=None):
+        self.phase = None
+        self.items = 0
+        self.requests = 0
+        self.total = None
+        self._interval = interval
+        self._status_file = status_file
+        self._logger = logger
+        self._started = time.time()
+        self._phase_started = self._started
+        self._last_progress = self._started
+        self._last_items = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """ Start the background reporting thread """
+        self._thread = threading.Thread(target=self._run, name='progress', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """ Stop the background thread and write a final report """
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join()
+        self.report(state='finished')
+
+    def begin_phase(self, phase, total=None):
+        """ Start tracking a new phase, resetting the counters
+
+        Args:
+            phase (str): Name of the phase (e.g. 'drive-listing')
+            total (int, optional): Expected number of items, used for the ETA
+        """
+        if self.phase:
+            self.report()
+        self.phase = phase
+        self.total = total
+        self.items = 0
+        self.requests = 0
+        self._last_items = 0
+        self._phase_started = time.time()
+        self._last_progress = self._phase_started
+
+    def snapshot(self):
+        """ Build a machine-readable view of the current progress
+
+        Returns:
+            dict: Counters, rates and ETA for the current phase
+        """
+        now = time.time()
+        items = self.items
+        requests = self.requests
+        elapsed = max(now - self._phase_started, 1e-6)
+
+        if items != self._last_items:
+            self._last_items = items
+            self._last_progress = now
+
+        items_per_sec = items / elapsed
+        eta = None
+        if self.total is not None and items_per_sec > 0:
+            eta = max(self.total - items, 0) / items_per_sec
+
+        return {'pid': os.getpid(),
+                'phase': self.phase,
+                'items': items,
+                'requests': requests,
+                'total': self.total,
+                'items_per_sec': round(items_per_sec, 2),
+                'requests_per_sec': round(requests / elapsed, 2),
+                'eta_seconds': round(eta, 1) if eta is not None else None,
+                'phase_elapsed_seconds': round(elapsed, 1),
+                'run_elapsed_seconds': round(now - self._started, 1),
+                'updated_at': now,
+                'last_progress_at': self._last_progress}
+
+    def report(self, state='running'):
+        """ Log the current progress and rewrite the status file
+
+        Args:
+            state (str, optional): Run state recorded in the status file
+        """
+        if not self.phase:
+            return
+        status = self.snapshot()
+        status['state'] = state
+
+        if self._logger:
+            if status['total'] is not None:
+                count = '{0}/{1}'.format(status['items'], status['total'])
+            else:
+                count = str(status['items'])
+            eta = status['eta_seconds']
+            self._logger.info('[%s] %s items, %.1f items/s, %.1f requests/s, ETA %s',
+                              status['phase'], count, status['items_per_sec'], status['requests_per_sec'],
+                              _format_duration(eta) if eta is not None else 'unknown')
+
+        if self._status_file:
+            _write_status(self._status_file, status)
+
+    def _run(self):
+        while not self._stop_event.wait(self._interval):
+            self.report()
+
+
+class SharedPhase(object):
+    """ Stands in for a ProgressReporter for one of several tasks running at once in the same phase
+
+    Each task (e.g. mapping one of several Box roots) would otherwise start the phase itself, resetting the
+    counts of the others. Through this, starting a phase does nothing and the counts go to the reporter.
+
+    Args:
+        reporter (ProgressReporter): The reporter, with the phase already started
+    """
+
+    def __init__(self, reporter):
+        self._reporter = reporter
+
+    def begin_phase(self, phase, total=None):
+        """ Leave the reporter's phase running """
+        pass
+
+    @property
+    def items(self):
+        """ int: Items processed in the reporter's phase """
+        return self._reporter.items
+
+    @items.setter
+    def items(self, value):
+        self._reporter.items = value
+
+    @property
+    def requests(self):
+        """ int: API requests made in the reporter's phase """
+        return self._reporter.requests
+
+    @requests.setter
+    def requests(self, value):
+        self._reporter.requests = value
+
+
+def _format_duration(seconds):
+    """ Format a number of seconds as H:MM:SS
+
+    Args:
+        seconds (float): Duration in seconds
+
+    Returns:
+        str: Formatted duration
+    """
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{0}:{1:02d}:{2:02d}'.format(hours, minutes, seconds)
+
+
+def _write_status(status_file, status):
+    """ Atomically replace the status file so readers never see a partial write
+
+    Args:
+        status_file (str): Path of the status file
+        status (dict): Status to write
+    """
+    temp_file = status_file + '.tmp'
+    with open(temp_file, 'w', encoding='utf-8') as output:
+        json.dump(status, output, indent=2)
+    os.replace(temp_file, status_file)
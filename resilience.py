@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+""" Hedged requests and circuit breakers for the read calls made to Drive and Box
+
+A few requests to an endpoint sometimes hang for far longer than the rest,
+stalling everything waiting on them. With hedging, once a read request has
+taken longer than a percentile of the endpoint's recent latencies, a
+duplicate is sent and whichever answers first is used. Hedges are capped at a
+share of the endpoint's requests, so an endpoint which is slow all over isn't
+sent twice the load.
+
+Each endpoint also has a circuit breaker. After a run of failed requests
+(errors other than answers such as 404), it opens and holds every request to
+the endpoint back until its reset time has passed. A single probe request is
+then let through, closing the breaker if it succeeds and opening it again if
+not. The request which failed still raises, so only the requests queued up
+behind a failing endpoint are held back.
+
+Only idempotent reads go through hedging, as a duplicate may still be running
+after its answer has been thrown away.
+
+"""
+
+# Imports
+import concurrent.futures
+import threading
+import time
+from collections import deque
+
+HEDGE_PERCENTILE = 0  # Latency percentile after which a read is hedged (0 to never hedge)
+HEDGE_SHARE = 0.1  # Most requests to an endpoint which may be hedged
+MIN_SAMPLES = 20  # Latencies needed before an endpoint's requests are hedged
+LATENCY_WINDOW = 500  # Recent latencies kept per endpoint
+FAILURE_THRESHOLD = 5  # Failures in a row which open an endpoint's breaker (0 to never open it)
+RESET_TIMEOUT = 30  # Seconds an open breaker holds requests back for before probing the endpoint
+HEDGE_THREADS = 64  # Most requests in flight at once while hedging
+
+# Breaker states
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+def is_failure(err):
+    """ Decide whether an error means the endpoint is failing, rather than answering
+
+    Args:
+        err (Exception): Error raised by a request
+
+    Returns:
+        bool: False for HTTP errors below 500 other than 429 (e.g. 404 for missing metadata), True otherwise
+    """
+    status = getattr(err, 'status', None)
+    if status is None:
+        # googleapiclient's HttpError keeps the status on its response
+        status = getattr(getattr(err, 'resp', None), 'status', None)
+    try:
+        return status is None or int(status) >= 500 or int(status) == 429
+    except (TypeError, ValueError):
+        return True
+
+
+class LatencyWindow(object):
+    """ The latencies of an endpoint's recent requests
+
+    Args:
+        size (int, optional): Latencies kept
+    """
+
+    def __init__(self, size=LATENCY_WINDOW):
+        self._latencies = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._latencies)
+
+    def record(self, seconds):
+        """ Add the latency of a request
+
+        Args:
+            seconds (float): How long the request took
+        """
+        with self._lock:
+            self._latencies.append(seconds)
+
+    def percentile(self, percent):
+        """ Find a percentile of the recent latencies
+
+        Args:
+            percent (float): The percentile, from 0 to 100
+
+        Returns:
+            float: The latency, or None if there are too few to go on
+        """
+        with self._lock:
+            if len(self._latencies) < MIN_SAMPLES:
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[min(int(len(ordered) * percent / 100.0), len(ordered) - 1)]
+
+
+class CircuitBreaker(object):
+    """ Holds requests to an endpoint back while it is failing
+
+    Args:
+        failure_threshold (int, optional): Failures in a row which open the breaker (0 to never open it)
+        reset_timeout (float, optional): Seconds the breaker stays open before letting a probe through
+
+    Attributes:
+        state (str): CLOSED, OPEN or HALF_OPEN (a probe is in flight)
+        opened (int): Times the breaker has opened
+    """
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, reset_timeout=RESET_TIMEOUT):
+        self.state = CLOSED
+        self.opened = 0
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = 0.0
+        self._condition = threading.Condition()
+
+    def wait_turn(self):
+        """ Block until a request may be sent to the endpoint """
+        with self._condition:
+            while True:
+                if self.state == CLOSED:
+                    return
+                if self.state == OPEN:
+                    wait = self._opened_at + self._reset_timeout - time.monotonic()
+                    if wait <= 0:
+                        # This request is the probe
+                        self.state = HALF_OPEN
+                        return
+                    self._condition.wait(wait)
+                else:
+                    # Wait for the probe's answer
+                    self._condition.wait()
+
+    def record(self, success):
+        """ Record the outcome of a request
+
+        Args:
+            success (bool): Whether the endpoint answered
+        """
+        with self._condition:
+            if success:
+                self._failures = 0
+                if self.state != CLOSED:
+                    self.state = CLOSED
+                    self._condition.notify_all()
+                return
+            self._failures += 1
+            if self.state == HALF_OPEN or (self._failure_threshold and self.state == CLOSED and
+                                           self._failures >= self._failure_threshold):
+                self.state = OPEN
+                self.opened += 1
+                self._opened_at = time.monotonic()
+                self._condition.notify_all()
+
+
+class Endpoint(object):
+    """ What is known about one endpoint
+
+    Args:
+        name (str): Name of the endpoint (e.g. "box:folder-items")
+        failure_threshold (int): Failures in a row which open its breaker
+        reset_timeout (float): Seconds its breaker stays open for
+
+    Attributes:
+        name (str): Name of the endpoint
+        latencies (LatencyWindow): Latencies of its recent requests
+        breaker (CircuitBreaker): Its circuit breaker
+        requests (int): Requests made to it, not counting hedges
+        hedges (int): Duplicate requests sent to it
+        hedge_wins (int): Hedged requests which the duplicate answered first
+        failures (int): Requests to it which failed
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.latencies = LatencyWindow()
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failures = 0
+
+
+class Guard(object):
+    """ Sends read requests through each endpoint's breaker, hedging the slow ones
+
+    Args:
+        hedge_percentile (float, optional): Latency percentile after which a request is hedged (0 to never hedge)
+        failure_threshold (int, optional): Failures in a row which open an endpoint's breaker (0 to never open it)
+        reset_timeout (float, optional): Seconds an open breaker holds requests back for
+        logger (logger, optional): Logging file
+    """
+
+    def __init__(self, hedge_percentile=HEDGE_PERCENTILE, failure_threshold=FAILURE_THRESHOLD,
+                 reset_timeout=RESET_TIMEOUT, logger=None):
+        self._endpoints = {}
+        self._lock = threading.Lock()
+        self._pool = None
+        self.configure(hedge_percentile, failure_threshold, reset_timeout, logger)
+
+    def configure(self, hedge_percentile=HEDGE_PERCENTILE, failure_threshold=FAILURE_THRESHOLD,
+                  reset_timeout=RESET_TIMEOUT, logger=None):
+        """ Change the settings, for endpoints first used from now on (and hedging everywhere)
+
+        Args:
+            hedge_percentile (float, optional): Latency percentile after which a request is hedged
+            failure_threshold (int, optional): Failures in a row which open an endpoint's breaker
+            reset_timeout (float, optional): Seconds an open breaker holds requests back for
+            logger (logger, optional): Logging file
+        """
+        self._hedge_percentile = hedge_percentile
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._logger = logger
+
+    @property
+    def hedging(self):
+        """ bool: Whether slow requests are hedged """
+        return bool(self._hedge_percentile)
+
+    def endpoint(self, name):
+        """ Get what is known about an endpoint
+
+        Args:
+            name (str): Name of the endpoint
+
+        Returns:
+            Endpoint: The endpoint
+        """
+        with self._lock:
+            if name not in self._endpoints:
+                self._endpoints[name] = Endpoint(name, self._failure_threshold, self._reset_timeout)
+            return self._endpoints[name]
+
+    def endpoints(self):
+        """ List the endpoints used so far
+
+        Returns:
+            [Endpoint]: The endpoints, by name
+        """
+        with self._lock:
+            return [self._endpoints[name] for name in sorted(self._endpoints)]
+
+    def call(self, name, request, duplicate=None, hedge=True):
+        """ Make a read request to an endpoint
+
+        Args:
+            name (str): Name of the endpoint
+            request (callable): Makes the request, returning its answer
+            duplicate (callable, optional): Makes the duplicate request, if it can't simply be made by request
+                again (e.g. because the transport isn't thread safe)
+            hedge (bool, optional): Whether the request may be hedged
+
+        Returns:
+            The answer of whichever request answered first
+
+        Raises:
+            Exception: Whatever the request raised
+        """
+        endpoint = self.endpoint(name)
+        endpoint.breaker.wait_turn()
+        endpoint.requests += 1
+        started = time.monotonic()
+        try:
+            if hedge and self._hedge_percentile:
+                answer = self._hedged(endpoint, request, duplicate or request)
+            else:
+                answer = request()
+        except Exception as err:
+            failed = is_failure(err)
+            if not failed:
+                endpoint.latencies.record(time.monotonic() - started)
+            self._record(endpoint, not failed)
+            raise
+        endpoint.latencies.record(time.monotonic() - started)
+        self._record(endpoint, True)
+        return answer
+
+    def _hedged(self, endpoint, request, duplicate):
+        delay = endpoint.latencies.percentile(self._hedge_percentile)
+        pool = self._get_pool()
+        first = pool.submit(request)
+        if delay is None or endpoint.hedges >= HEDGE_SHARE * endpoint.requests:
+            return first.result()
+
+        done, _ = concurrent.futures.wait([first], timeout=delay)
+        if done:
+            return first.result()
+        endpoint.hedges += 1
+        second = pool.submit(duplicate)
+        pending = {first, second}
+        while True:
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                err = future.exception()
+                if err is None or not is_failure(err) or not pending:
+                    if future is second:
+                        endpoint.hedge_wins += 1
+                    # The other request is left to finish, and its answer thrown away
+                    return future.result()
+
+    def _record(self, endpoint, success):
+        previous_state = endpoint.breaker.state
+        endpoint.breaker.record(success)
+        if not success:
+            endpoint.failures += 1
+        if self._logger and endpoint.breaker.state != previous_state:
+            if endpoint.breaker.state == OPEN:
+                self._logger.warning('%s is failing; holding its requests back for %ss', endpoint.name,
+                                     self._reset_timeout)
+            elif endpoint.breaker.state == CLOSED:
+                self._logger.info('%s has recovered', endpoint.name)
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=HEDGE_THREADS,
+                                                                   thread_name_prefix='hedge')
+            return self._pool
+
+
+# Shared by everything in the process, so every request to an endpoint counts towards its breaker
+guard = Guard()
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+""" Checking Box for metadata on a random sample of files rather than every file
+
+The files are split into strata by the folder they are in (down to a given
+depth below the root) and by file type, and a random sample of each stratum
+is checked. Each stratum's coverage is reported with a Wilson score interval,
+and the coverage of the whole Box is estimated by weighting each stratum (and
+the bounds of its interval) by its number of files.
+
+A stratum whose sampled miss rate is above a threshold is escalated to a full
+check, so its coverage is known exactly and every file missing metadata in it
+is listed.
+
+"""
+
+# Imports
+from __future__ import print_function
+
+import math
+import os
+import random
+
+from collections import OrderedDict
+
+from migration import print_list
+
+SAMPLE_SIZE = 30  # Files checked per stratum
+ESCALATE_MISS_RATE = 0.01  # Sampled miss rate above which a stratum is checked in full
+STRATUM_DEPTH = 1  # Folder levels below the root which the strata are split by
+CONFIDENCE_Z = 1.96  # Normal quantile of the confidence intervals (95%)
+
+
+def wilson_interval(hits, count, z=CONFIDENCE_Z):
+    """ Find the Wilson score interval of a proportion
+
+    Args:
+        hits (int): Successes
+        count (int): Trials
+        z (float, optional): Normal quantile of the confidence level
+
+    Returns:
+        (float, float): Lower and upper bounds (0 to 1 if there were no trials)
+    """
+    if not count:
+        return 0.0, 1.0
+    proportion = float(hits) / count
+    denominator = 1 + z * z / count
+    centre = (proportion + z * z / (2 * count)) / denominator
+    spread = z * math.sqrt(proportion * (1 - proportion) / count + z * z / (4 * count * count)) / denominator
+    return max(0.0, centre - spread), min(1.0, centre + spread)
+
+
+def stratum_of(path, depth=STRATUM_DEPTH):
+    """ Find the stratum of a file
+
+    Args:
+        path (str): Path to the file (e.g. "D:/Finance/2017/Budget.xlsx")
+        depth (int, optional): Folder levels below the root which the strata are split by
+
+    Returns:
+        (str, str): The folder (e.g. "D:/Finance") and the file type (e.g. ".xlsx")
+    """
+    parts = path.split('/')
+    folder = '/'.join(parts[:min(depth + 1, len(parts) - 1)])
+    return folder, os.path.splitext(parts[-1])[1].lower() or '(none)'
+
+
+class Stratum(object):
+    """ Files of one folder and type, and what was found checking them
+
+    Args:
+        key ((str, str)): Folder and file type
+
+    Attributes:
+        key ((str, str)): Folder and file type
+        files ([BoxObject]): Every file in the stratum
+        checked (int): Files checked
+        hits (int): Files checked which have the metadata
+        misses ([str]): Paths of the files checked which don't have the metadata
+        escalated (bool): Whether every file was checked as the sampled miss rate was too high
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.files = []
+        self.checked = 0
+        self.hits = 0
+        self.misses = []
+        self.escalated = False
+
+    @property
+    def exact(self):
+        """ bool: Whether every file in the stratum was checked """
+        return self.checked == len(self.files)
+
+    def coverage(self):
+        """ Estimate the share of the stratum's files with the metadata
+
+        Returns:
+            (float, float, float): The estimate, and the lower and upper bounds of its interval
+        """
+        estimate = float(self.hits) / self.checked if self.checked else 0.0
+        if self.exact:
+            return estimate, estimate, estimate
+        low, high = wilson_interval(self.hits, self.checked)
+        return estimate, low, high
+
+
+def sample_check_metadata(box, metadata_name, sample_size=SAMPLE_SIZE, escalate_miss_rate=ESCALATE_MISS_RATE,
+                          depth=STRATUM_DEPTH, seed=None, print_file=None, logger=None):
+    """ Check a stratified random sample of the files in Box for metadata of the specified type
+
+    Args:
+        box (Box): The Box to check
+        metadata_name (str): The name of the metadata to search for
+        sample_size (int, optional): Files checked per stratum
+        escalate_miss_rate (float, optional): Sampled miss rate above which a stratum is checked in full
+        depth (int, optional): Folder levels below the root which the strata are split by
+        seed (int, optional): Random seed for the sample
+        print_file (file, optional): The file to which the report should be printed
+        logger (logger, optional): Logging file
+
+    Returns:
+        dict: The estimated coverage with its interval, the files checked, and the strata
+    """
+    rand = random.Random(seed)
+    strata = OrderedDict()
+    for box_file in box.files:
+        if box_file.path:
+            key = stratum_of(box_file.path, depth)
+            if key not in strata:
+                strata[key] = Stratum(key)
+            strata[key].files.append(box_file)
+
+    def check(stratum, files):
+        for box_file in files:
+            stratum.checked += 1
+            if box.check_metadata(box_file, metadata_name):
+                stratum.hits += 1
+            else:
+                stratum.misses.append(box_file.path)
+                if logger:
+                    logger.debug('Failed to find metadata for %s', box_file.path)
+
+    for stratum in strata.values():
+        order = list(range(len(stratum.files)))
+        rand.shuffle(order)
+        check(stratum, [stratum.files[index] for index in order[:sample_size]])
+        if not stratum.exact and len(stratum.misses) > escalate_miss_rate * stratum.checked:
+            stratum.escalated = True
+            if logger:
+                logger.info('Checking every file in %s (%s): %s of %s sampled files have no metadata',
+                            stratum.key[0], stratum.key[1], len(stratum.misses), stratum.checked)
+            check(stratum, [stratum.files[index] for index in order[sample_size:]])
+
+    # Each stratum is weighted by its files. Weighting the strata's Wilson bounds the same way gives a
+    # conservative interval, which stays honest for strata where every sampled file had metadata
+    total = sum(len(stratum.files) for stratum in strata.values())
+    estimate = low = high = 0.0
+    for stratum in strata.values():
+        weight = float(len(stratum.files)) / total
+        stratum_estimate, stratum_low, stratum_high = stratum.coverage()
+        estimate += weight * stratum_estimate
+        low += weight * stratum_low
+        high += weight * stratum_high
+    result = {'coverage': estimate if total else None,
+              'low': low if total else None,
+              'high': high if total else None,
+              'files': total,
+              'checked': sum(stratum.checked for stratum in strata.values()),
+              'misses': [path for stratum in strata.values() for path in stratum.misses],
+              'strata': list(strata.values())}
+    print_sample_report(result, print_file=print_file)
+    return result
+
+
+def print_sample_report(result, print_file=None):
+    """ Print the report of a sampled metadata check
+
+    Args:
+        result (dict): What sample_check_metadata found
+        print_file (file, optional): The file to which the report should be printed
+    """
+    strata = result['strata']
+    print('Checked {0} of {1} files in {2} strata ({3} checked in full):'.format(
+        result['checked'], result['files'], len(strata), sum(1 for stratum in strata if stratum.exact)),
+        file=print_file)
+    if result['files']:
+        print('Estimated coverage: {0:.2%} (95% confidence: {1:.2%} - {2:.2%})'.format(
+            result['coverage'], result['low'], result['high']), file=print_file)
+
+    lines = []
+    for stratum in strata:
+        estimate, low, high = stratum.coverage()
+        if stratum.exact:
+            detail = 'all {0} checked{1}'.format(len(stratum.files), ', escalated' if stratum.escalated else '')
+            interval = '{0:.2%}'.format(estimate)
+        else:
+            detail = '{0} of {1} checked'.format(stratum.checked, len(stratum.files))
+            interval = '{0:.2%} ({1:.2%} - {2:.2%})'.format(estimate, low, high)
+        lines.append('{0} ({1}): {2}, {3}'.format(stratum.key[0], stratum.key[1], interval, detail))
+    print_list(list_to_print=lines, header_message='Coverage by stratum:', print_file=print_file)
+
+    print_list(list_to_print=list(result['misses']),
+               header_message='Failed to find metadata for {0} checked File Paths:'.format(len(result['misses'])),
+               print_file=print_file)
@@ -0,0 +1,555 @@
+# -*- coding: utf-8 -*-
+""" Splitting a migration into shards which several worker processes can run
+
+A coordinator lists Drive once and splits the migration by the folders
+directly under the root: each shard is everything under the top level folders
+of one name, in both Drive and Box. One more shard holds the files directly
+under the root, along with any Box folders which aren't in Drive.
+
+The shards, a snapshot of the Drive listing and each shard's report are kept
+in an SQLite queue file. Workers lease shards from it, map their part of Drive
+from the snapshot (so Drive is never listed again) and their part of Box, and
+run the matching and writing for it. A lease runs out if its worker stops
+renewing it, e.g. because the worker crashed, and the shard is then handed to
+another worker. The largest shards are handed out first, so workers finish at
+about the same time.
+
+"""
+
+# Imports
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+LEASE_SECONDS = 5 * 60  # Leases run out unless renewed within this many seconds
+MAX_ATTEMPTS = 3  # Leases of a shard before it is given up as failed
+POLL_INTERVAL = 5  # Seconds between checks on shards leased by other workers
+LOCK_TIMEOUT = 60  # Seconds to wait for another process to finish writing to the queue
+PAGE_SIZE = 1000  # Snapshot items served per Drive listing page
+ROOT_SHARD = ''  # Name of the shard of files directly under the root
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+
+class Shard(object):
+    """ Part of a migration: everything under the top level folders of one name
+
+    Args:
+        name (str): Name of the top level folders in the shard, or ROOT_SHARD
+        folder_shards (set(str)): Names of every shard other than ROOT_SHARD
+
+    Attributes:
+        name (str): Name of the top level folders in the shard, or ROOT_SHARD
+    """
+
+    def __init__(self, name, folder_shards):
+        self.name = name
+        self._folder_shards = folder_shards
+
+    def includes(self, name, is_folder):
+        """ Check whether an item directly under the root belongs to the shard
+
+        ROOT_SHARD holds every file, and every folder which isn't a shard of its own (i.e. isn't in Drive).
+
+        Args:
+            name (str): Name of the item
+            is_folder (bool): Whether the item is a folder
+
+        Returns:
+            bool: Whether the item, and everything below it, is in the shard
+        """
+        if self.name == ROOT_SHARD:
+            return not is_folder or name not in self._folder_shards
+        return is_folder and name == self.name
+
+    def __repr__(self):
+        return "<shard: {0}>".format(self.name if self.name != ROOT_SHARD else '(root)')
+
+
+class ShardQueue(object):
+    """ SQLite queue of shards, with the Drive snapshot and each shard's report
+
+    Safe to share between threads, and between processes on the same machine.
+
+    Args:
+        path (str): Path of the queue file; created if it doesn't exist
+
+    Attributes:
+        path (str): Path of the queue file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._folder_shards = None
+        # Used by the Drive listing and lease threads as well as the main one
+        self._connection = sqlite3.connect(path, timeout=LOCK_TIMEOUT, check_same_thread=False)
+        with self._lock:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS shards ('
+                                     'name TEXT PRIMARY KEY, '
+                                     'size INTEGER NOT NULL, '
+                                     'state TEXT NOT NULL, '
+                                     'worker TEXT, '
+                                     'lease_expires REAL, '
+                                     'attempts INTEGER NOT NULL DEFAULT 0, '
+                                     'error TEXT, '
+                                     'report TEXT)')
+            self._connection.execute('CREATE TABLE IF NOT EXISTS drive_items ('
+                                     'position INTEGER PRIMARY KEY, '
+                                     'drive_id TEXT NOT NULL, '
+                                     'parent_id TEXT, '
+                                     'shard TEXT, '
+                                     'shared INTEGER NOT NULL DEFAULT 0, '
+                                     'item TEXT NOT NULL)')
+            self._connection.commit()
+
+    def is_created(self):
+        """ Check whether the shards have been created, e.g. by an earlier coordinator
+
+        Returns:
+            bool: Whether there are shards in the queue
+        """
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM shards').fetchone()[0] > 0
+
+    def begin_snapshot(self):
+        """ Discard any snapshot left by a coordinator which stopped before creating the shards """
+        with self._lock:
+            self._connection.execute('DELETE FROM drive_items')
+            self._connection.commit()
+
+    def record_root(self, item):
+        """ Save the "My Drive" root folder resource to the snapshot
+
+        Args:
+            item (dict): Response of `files.get` for the root
+        """
+        self._set('drive_root', item)
+
+    def record_items(self, items):
+        """ Save a page of the Drive listing to the snapshot
+
+        Args:
+            items ([dict]): File resources from `files.list`
+        """
+        with self._lock:
+            self._connection.executemany('INSERT INTO drive_items (drive_id, parent_id, item) VALUES (?, ?, ?)',
+                                         ((item['id'], item['parents'][0] if 'parents' in item else None,
+                                           json.dumps(item)) for item in items))
+            self._connection.commit()
+
+    def create(self, drive, root_drive=None, root_box=None):
+        """ Split the snapshot into shards by the top level folder each item is under
+
+        Items which aren't under the Drive's root (or were filtered out of it) are dropped from the snapshot.
+        The folders above the root are kept in every shard, so each worker can find the root.
+
+        Args:
+            drive (Drive): The Drive built from the snapshot
+            root_drive (str, optional): Path of the root within Drive
+            root_box (str, optional): Path of the root within Box
+
+        Returns:
+            int: Number of shards
+        """
+        # Shard of each folder: its own name if it's directly under the root, else its parent's shard
+        shard_names = {drive.root.id: ROOT_SHARD}
+        for folder in drive.folders:
+            chain = []
+            node = folder
+            while node.id not in shard_names:
+                chain.append(node)
+                node = node.parent
+            name = shard_names[node.id]
+            for node in reversed(chain):
+                if node.parent is drive.root:
+                    name = node.name
+                shard_names[node.id] = name
+
+        assignments = [(shard_names[folder.id], folder.id) for folder in drive.folders if folder is not drive.root]
+        assignments.extend((shard_names[file.parent.id], file.id) for file in drive.files)
+        sizes = {ROOT_SHARD: 0}
+        for name, _ in assignments:
+            sizes[name] = sizes.get(name, 0) + 1
+
+        with self._lock:
+            self._connection.execute('CREATE INDEX IF NOT EXISTS items_by_id ON drive_items (drive_id)')
+            self._connection.executemany('UPDATE drive_items SET shard = ? WHERE drive_id = ?', assignments)
+
+            # Folders from the root up to "My Drive"
+            seen = set()
+            node_id = drive.root.id
+            while node_id and node_id not in seen:
+                seen.add(node_id)
+                row = self._connection.execute('SELECT parent_id FROM drive_items WHERE drive_id = ?',
+                                               (node_id,)).fetchone()
+                if row is None:
+                    break
+                self._connection.execute('UPDATE drive_items SET shared = 1 WHERE drive_id = ?', (node_id,))
+                node_id = row[0]
+
+            self._connection.execute('DELETE FROM drive_items WHERE shard IS NULL AND shared = 0')
+            self._connection.execute('CREATE INDEX IF NOT EXISTS items_by_shard ON drive_items (shard, position)')
+            self._connection.executemany('INSERT INTO shards (name, size, state) VALUES (?, ?, ?)',
+                                         ((name, size, PENDING) for name, size in sizes.items()))
+            for key, value in (('root_drive', root_drive), ('root_box', root_box)):
+                self._connection.execute('INSERT OR REPLACE INTO settings VALUES (?, ?)', (key, json.dumps(value)))
+            self._connection.commit()
+        return len(sizes)
+
+    def settings(self):
+        """ Get the settings the coordinator created the shards with
+
+        Returns:
+            dict: The root_drive and root_box paths
+        """
+        with self._lock:
+            return {key: json.loads(value) for key, value in self._connection.execute('SELECT * FROM settings')}
+
+    def lease(self, worker, duration=LEASE_SECONDS):
+        """ Lease the largest shard which isn't done and isn't leased by another worker
+
+        Args:
+            worker (str): Name of the worker taking the lease
+            duration (float, optional): Seconds until the lease runs out, unless renewed
+
+        Returns:
+            Shard: The shard, or None if there's none to lease
+        """
+        with self._lock:
+            now = time.time()
+            # Take the write lock up front, so no other worker can lease the same shard
+            self._connection.execute('BEGIN IMMEDIATE')
+            try:
+                self._connection.execute('UPDATE shards SET state = ?, error = ? '
+                                         'WHERE state = ? AND lease_expires < ? AND attempts >= ?',
+                                         (FAILED, 'The lease ran out', LEASED, now, MAX_ATTEMPTS))
+                row = self._connection.execute('SELECT name FROM shards '
+                                               'WHERE state = ? OR (state = ? AND lease_expires < ?) '
+                                               'ORDER BY size DESC, name LIMIT 1', (PENDING, LEASED, now)).fetchone()
+                if row is not None:
+                    self._connection.execute('UPDATE shards SET state = ?, worker = ?, lease_expires = ?, '
+                                             'attempts = attempts + 1 WHERE name = ?',
+                                             (LEASED, worker, now + duration, row[0]))
+                self._connection.commit()
+            except sqlite3.Error:
+                self._connection.rollback()
+                raise
+            if row is None:
+                return None
+            if self._folder_shards is None:
+                self._folder_shards = {name for name, in self._connection.execute('SELECT name FROM shards')
+                                       if name != ROOT_SHARD}
+            return Shard(row[0], self._folder_shards)
+
+    def renew(self, shard, worker, duration=LEASE_SECONDS):
+        """ Extend a worker's lease on a shard
+
+        Args:
+            shard (Shard): The leased shard
+            worker (str): Name of the worker holding the lease
+            duration (float, optional): Seconds from now until the lease runs out
+
+        Returns:
+            bool: False if the lease had already run out and been taken by another worker
+        """
+        with self._lock:
+            cursor = self._connection.execute('UPDATE shards SET lease_expires = ? '
+                                              'WHERE name = ? AND worker = ? AND state = ?',
+                                              (time.time() + duration, shard.name, worker, LEASED))
+            self._connection.commit()
+            return cursor.rowcount > 0
+
+    def complete(self, shard, report):
+        """ Mark a shard as done
+
+        Args:
+            shard (Shard): The shard
+            report (dict): Paths in each section of the shard's report (see migration.migrate_metadata)
+        """
+        with self._lock:
+            self._connection.execute('UPDATE shards SET state = ?, report = ?, error = NULL WHERE name = ?',
+                                     (DONE, json.dumps(report), shard.name))
+            self._connection.commit()
+
+    def fail(self, shard, worker, error):
+        """ Give up a worker's lease on a shard after an error, so it can be retried
+
+        Args:
+            shard (Shard): The leased shard
+            worker (str): Name of the worker holding the lease
+            error (str): What went wrong
+        """
+        with self._lock:
+            self._connection.execute('UPDATE shards SET state = CASE WHEN attempts >= ? THEN ? ELSE ? END, '
+                                     'error = ? WHERE name = ? AND worker = ? AND state = ?',
+                                     (MAX_ATTEMPTS, FAILED, PENDING, error, shard.name, worker, LEASED))
+            self._connection.commit()
+
+    def retry_failed(self):
+        """ Queue the shards which failed every attempt again, with a fresh set of attempts
+
+        Returns:
+            int: Number of shards queued again
+        """
+        with self._lock:
+            cursor = self._connection.execute('UPDATE shards SET state = ?, attempts = 0 WHERE state = ?',
+                                              (PENDING, FAILED))
+            self._connection.commit()
+            return cursor.rowcount
+
+    def counts(self):
+        """ Count the shards in each state
+
+        Returns:
+            dict: Number of shards, by state
+        """
+        with self._lock:
+            counts = {PENDING: 0, LEASED: 0, DONE: 0, FAILED: 0}
+            counts.update(self._connection.execute('SELECT state, COUNT(*) FROM shards GROUP BY state'))
+            return counts
+
+    def reports(self):
+        """ Get the reports of the finished shards
+
+        Returns:
+            [dict]: Paths in each section of each shard's report
+        """
+        with self._lock:
+            return [json.loads(report) for report, in
+                    self._connection.execute('SELECT report FROM shards WHERE state = ? ORDER BY name', (DONE,))]
+
+    def failures(self):
+        """ Get the shards which failed every attempt
+
+        Returns:
+            [(str, str)]: Name of each failed shard, and its last error
+        """
+        with self._lock:
+            return list(self._connection.execute('SELECT name, error FROM shards WHERE state = ? ORDER BY name',
+                                                 (FAILED,)))
+
+    def drive_root(self):
+        """ Get the "My Drive" root folder resource from the snapshot
+
+        Returns:
+            dict: Response of `files.get` for the root
+        """
+        return self.settings()['drive_root']
+
+    def drive_page(self, shard, after=None, limit=PAGE_SIZE):
+        """ Get a page of the Drive snapshot for a shard
+
+        The first page also holds the folders above the root.
+
+        Args:
+            shard (Shard): The shard
+            after (int, optional): Position of the last item of the previous page
+            limit (int, optional): Most items of the shard to return
+
+        Returns:
+            ([dict], int): The file resources, and the position to pass as `after` for the next page (or None)
+        """
+        with self._lock:
+            items = []
+            if after is None:
+                items.extend(json.loads(item) for item, in
+                             self._connection.execute('SELECT item FROM drive_items WHERE shared = 1 '
+                                                      'ORDER BY position'))
+            rows = self._connection.execute('SELECT position, item FROM drive_items '
+                                            'WHERE shard = ? AND position > ? ORDER BY position LIMIT ?',
+                                            (shard.name, after if after is not None else -1, limit)).fetchall()
+        items.extend(json.loads(item) for _, item in rows)
+        return items, rows[-1][0] if len(rows) == limit else None
+
+    def close(self):
+        """ Close the queue """
+        with self._lock:
+            self._connection.close()
+
+    def _set(self, key, value):
+        with self._lock:
+            self._connection.execute('INSERT OR REPLACE INTO settings VALUES (?, ?)', (key, json.dumps(value)))
+            self._connection.commit()
+
+
+class _Request(object):
+    """ Stand-in for a googleapiclient HttpRequest """
+
+    def __init__(self, response):
+        self._response = response
+
+    def execute(self, http=None, num_retries=0):
+        return self._response
+
+
+class _SnapshotFiles(object):
+    def __init__(self, shard_queue, shard):
+        self._queue = shard_queue
+        self._shard = shard
+
+    def get(self, fileId, fields=None, **kwargs):
+        return _Request(self._queue.drive_root())
+
+    def list(self, pageSize=PAGE_SIZE, pageToken=None, **kwargs):
+        items, after = self._queue.drive_page(self._shard, int(pageToken) if pageToken else None, pageSize)
+        response = {'files': items}
+        if after is not None:
+            response['nextPageToken'] = str(after)
+        return _Request(response)
+
+
+class SnapshotDriveService(object):
+    """ Stand-in for the Drive v3 discovery service, serving one shard of a coordinator's snapshot
+
+    Args:
+        shard_queue (ShardQueue): Queue holding the snapshot
+        shard (Shard): The shard to serve
+    """
+
+    def __init__(self, shard_queue, shard):
+        self._files = _SnapshotFiles(shard_queue, shard)
+
+    def files(self):
+        return self._files
+
+
+class _RecordingRequest(object):
+    def __init__(self, request, record):
+        self._request = request
+        self._record = record
+
+    def execute(self, *args, **kwargs):
+        response = self._request.execute(*args, **kwargs)
+        self._record(response)
+        return response
+
+
+class _RecordingFiles(object):
+    def __init__(self, files, shard_queue):
+        self._files = files
+        self._queue = shard_queue
+
+    def get(self, **kwargs):
+        return _RecordingRequest(self._files.get(**kwargs), self._queue.record_root)
+
+    def list(self, **kwargs):
+        return _RecordingRequest(self._files.list(**kwargs),
+                                 lambda response: self._queue.record_items(response.get('files', [])))
+
+
+class DriveRecorder(object):
+    """ Wraps a Drive service, saving the root and every item listed to a queue's snapshot
+
+    Args:
+        service (discovery): The Drive service
+        shard_queue (ShardQueue): Queue to save the snapshot to
+    """
+
+    def __init__(self, service, shard_queue):
+        self._service = service
+        self._queue = shard_queue
+        shard_queue.begin_snapshot()
+
+    def files(self):
+        return _RecordingFiles(self._service.files(), self._queue)
+
+    def about(self):
+        return self._service.about()
+
+
+class _LeaseKeeper(object):
+    """ Renew a lease on a background thread until stopped """
+
+    def __init__(self, shard_queue, shard, worker, duration, logger=None):
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(shard_queue, shard, worker, duration, logger),
+                                        name='lease', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+    def _run(self, shard_queue, shard, worker, duration, logger):
+        while not self._stop_event.wait(duration / 3.0):
+            if not shard_queue.renew(shard, worker, duration) and logger:
+                logger.warning('The lease on %s ran out and was taken by another worker', shard)
+
+
+def work(shard_queue, run_shard, worker=None, duration=LEASE_SECONDS, logger=None):
+    """ Lease and run shards until every shard is done or has failed
+
+    Args:
+        shard_queue (ShardQueue): The queue
+        run_shard (callable): Runs the migration of a Shard, returning its report
+        worker (str, optional): Name of the worker, by default the host name and process ID
+        duration (float, optional): Seconds until a lease runs out, unless renewed
+        logger (logger, optional): Logging file
+
+    Returns:
+        int: Number of shards run by this worker
+    """
+    worker = worker or '{0}:{1}'.format(socket.gethostname(), os.getpid())
+    shards_run = 0
+    while True:
+        shard = shard_queue.lease(worker, duration)
+        if shard is None:
+            counts = shard_queue.counts()
+            if not counts[PENDING] and not counts[LEASED]:
+                return shards_run
+            # Wait in case a lease held by another worker runs out
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        if logger:
+            logger.info('Worker %s migrating %s', worker, shard)
+        lease_keeper = _LeaseKeeper(shard_queue, shard, worker, duration, logger)
+        try:
+            report = run_shard(shard)
+        except Exception as err:  # Handed to another attempt, or recorded as the shard's error
+            if logger:
+                logger.exception('Failed to migrate %s', shard)
+            shard_queue.fail(shard, worker, repr(err))
+        else:
+            shard_queue.complete(shard, report)
+        finally:
+            lease_keeper.stop()
+        shards_run += 1
+
+
+def wait(shard_queue, processes=None, progress_reporter=None, logger=None):
+    """ Wait until every shard is done or has failed
+
+    Args:
+        shard_queue (ShardQueue): The queue
+        processes ([Popen], optional): Local worker processes. If all of them exit, the wait ends even if
+            shards remain, as no worker may be left to run them
+        progress_reporter (ProgressReporter, optional): Reporter tracking the shards finished
+        logger (logger, optional): Logging file
+
+    Returns:
+        bool: Whether every shard is done or has failed
+    """
+    counts = shard_queue.counts()
+    if progress_reporter:
+        progress_reporter.begin_phase('shards', total=sum(counts.values()))
+    while True:
+        counts = shard_queue.counts()
+        if progress_reporter:
+            progress_reporter.items = counts[DONE] + counts[FAILED]
+        if not counts[PENDING] and not counts[LEASED]:
+            return True
+        if processes and all(process.poll() is not None for process in processes):
+            if logger:
+                logger.error('Every worker has exited with %s shards left to migrate',
+                             counts[PENDING] + counts[LEASED])
+            return False
+        time.sleep(POLL_INTERVAL)
@@ -0,0 +1,522 @@
+# -*- coding: utf-8 -*-
+""" Local stand-in for the Drive and Box APIs, for offline load testing
+
+Serves a synthetic tree through the endpoints the migration tool uses:
+
+    Drive   /discovery/v1/apis/drive/v3/rest
+            /drive/v3/files/{id}, /drive/v3/files, /drive/v3/about, /drive/v3/drives
+    Box     /box/2.0/folders/{id}/items, /box/2.0/folders/{id}
+            /box/2.0/files/{id}/metadata/enterprise/{template}
+            /box/2.0/users/me, /box/2.0/users, /box/2.0/metadata_templates/enterprise/{template}/schema
+            /box/2.0/search (file names only, with Box's offset limit)
+            /box/oauth2/token
+    Google  /oauth2/token (service account JWT grants)
+
+Shared drives are served as further synthetic trees, each of which is
+copied to a Box folder of the same name under the Box root.
+
+Users of the domain each get a synthetic tree of their own, which is served
+when a request acts as them: in Drive, through a token granted to a service
+account for the user, and in Box, through the As-User header. Any key file
+pointing its token_uri at the stand-in is accepted.
+
+Each request is delayed according to a latency distribution, and a share of
+requests can be answered with 429 Too Many Requests. Point the tool at it with
+`--driveapi http://localhost:PORT --boxapi http://localhost:PORT/box`.
+
+Usage:
+    python3 stub_server.py --size 100000 --latency lognormal:0.08:0.5 --ratelimit 0.01
+    python3 stub_server.py --size 10000 --shareddrives 300 --shareddrivesize 1000
+    python3 stub_server.py --users 20 --usersize 5000
+
+"""
+
+# Imports
+from __future__ import print_function
+
+import argparse
+import base64
+import json
+import math
+import random
+import re
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import synthetic
+
+DEFAULT_PORT = 8765
+METADATA_TEMPLATES = ['legacyData']
+DRIVES_PAGE_SIZE = 100  # Most shared drives returned per drives.list page
+SEARCH_LIMIT = 200  # Most results Box returns per search request
+SEARCH_MAX_OFFSET = 10000  # Highest search offset Box accepts
+
+
+class LatencyModel(object):
+    """ Distribution of the delay added to every response
+
+    Args:
+        spec (str): One of 'none', 'fixed:SECONDS', 'uniform:MIN:MAX' or 'lognormal:MEDIAN:SIGMA'
+        seed (int, optional): Random seed
+    """
+
+    def __init__(self, spec='none', seed=0):
+        self._rand = random.Random(seed)
+        self._lock = threading.Lock()
+        parts = spec.split(':')
+        self._kind = parts[0]
+        self._params = [float(part) for part in parts[1:]]
+        if self._kind not in ('none', 'fixed', 'uniform', 'lognormal'):
+            raise ValueError('Unknown latency distribution <{0}>'.format(spec))
+
+    def sample(self):
+        """ Draw a delay
+
+        Returns:
+            float: Delay in seconds
+        """
+        with self._lock:
+            if self._kind == 'fixed':
+                return self._params[0]
+            if self._kind == 'uniform':
+                return self._rand.uniform(self._params[0], self._params[1])
+            if self._kind == 'lognormal':
+                return self._rand.lognormvariate(math.log(self._params[0]), self._params[1])
+        return 0.0
+
+
+class StubState(object):
+    """ Everything the stand-in serves, shared between request threads
+
+    Args:
+        tree (SyntheticTree): The tree to serve
+        latency (LatencyModel): Delay added to each response
+        rate_limit (float, optional): Share of requests answered with 429
+        retry_after (int, optional): Retry-After seconds sent with each 429
+        drive_page_size (int, optional): Maximum items per Drive `files.list` page
+        box_page_size (int, optional): Maximum items per Box `get_items` page
+        seed (int, optional): Random seed for the 429 injection
+        shared_trees ([SyntheticTree], optional): The trees of the shared drives
+        user_states (dict, optional): Email address to the state served when acting as each user of the domain
+    """
+
+    def __init__(self, tree, latency, rate_limit=0.0, retry_after=1, drive_page_size=1000, box_page_size=1000,
+                 seed=0, shared_trees=None, user_states=None):
+        self.tree = tree
+        self.user_states = dict(user_states or {})
+        self.box_user_ids = {email: str(1000 + index) for index, email in enumerate(self.user_states)}
+        self.shared_trees = list(shared_trees or [])
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.drive_page_size = drive_page_size
+        self.box_page_size = box_page_size
+        self.box_children = tree.box_children()
+        for shared_tree in self.shared_trees:
+            self.box_children.update(shared_tree.box_children())
+            self.box_children.setdefault(synthetic.BOX_ROOT_ID, []).append(
+                ('folder', shared_tree.box_root_id, shared_tree.shared_drive['name']))
+        self._box_files = None
+        self.metadata = {}
+        self.requests = 0
+        self.throttled = 0
+        self._rand = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def should_throttle(self):
+        """ Count a request and decide whether to answer it with a 429
+
+        Returns:
+            bool: Whether the request should be throttled
+        """
+        with self._lock:
+            self.requests += 1
+            if self.rate_limit and self._rand.random() < self.rate_limit:
+                self.throttled += 1
+                return True
+        return False
+
+    def acting_as(self, headers):
+        """ Find the state to serve a request from, following the user it acts as
+
+        Args:
+            headers (Message): Headers of the request
+
+        Returns:
+            StubState: The state of the user acted as, or this state if the request doesn't act as a user
+        """
+        authorization = headers.get('Authorization') or ''
+        if authorization.startswith('Bearer delegated-'):
+            return self.user_states.get(authorization[len('Bearer delegated-'):], self)
+        as_user = headers.get('As-User')
+        for email, user_id in self.box_user_ids.items():
+            if as_user == user_id:
+                return self.user_states[email]
+        return self
+
+    def drive_tree(self, identifier=None, drive_id=None):
+        """ Find the tree serving a Drive item or shared drive
+
+        Args:
+            identifier (str, optional): Drive ID of an item
+            drive_id (str, optional): ID of a shared drive
+
+        Returns:
+            SyntheticTree: The tree, which is that of "My Drive" unless the item or drive is in a shared drive
+        """
+        for shared_tree in self.shared_trees:
+            if drive_id == shared_tree.root_id or (identifier and (identifier == shared_tree.root_id or
+                                                                   identifier.startswith(shared_tree.root_id + '-'))):
+                return shared_tree
+        return self.tree
+
+    def box_files(self):
+        """ List every Box file with its path_collection, for search
+
+        Returns:
+            [(str, str, [dict])]: ID, name and path_collection entries of every file
+        """
+        with self._lock:
+            if self._box_files is None:
+                self._box_files = []
+                stack = [(synthetic.BOX_ROOT_ID, [{'type': 'folder', 'id': synthetic.BOX_ROOT_ID, 'name': 'All Files'}])]
+                while stack:
+                    folder_id, path = stack.pop()
+                    for item_type, object_id, name in self.box_children.get(folder_id, []):
+                        if item_type == 'folder':
+                            stack.append((object_id, path + [{'type': 'folder', 'id': object_id, 'name': name}]))
+                        else:
+                            self._box_files.append((object_id, name, path))
+            return self._box_files
+
+
+def drive_discovery_document(base_url):
+    """ Build a minimal Drive v3 discovery document rooted at the stand-in
+
+    Only the methods and parameters used by the migration tool are described.
+
+    Args:
+        base_url (str): URL of the stand-in (e.g. http://localhost:8765/)
+
+    Returns:
+        dict: The discovery document
+    """
+    def query(param_type='string'):
+        return {'type': param_type, 'location': 'query'}
+
+    list_parameters = {name: query() for name in ('q', 'pageToken', 'corpora', 'driveId', 'orderBy', 'spaces')}
+    list_parameters['pageSize'] = query('integer')
+    list_parameters['includeItemsFromAllDrives'] = query('boolean')
+    list_parameters['supportsAllDrives'] = query('boolean')
+
+    return {'kind': 'discovery#restDescription',
+            'discoveryVersion': 'v1',
+            'id': 'drive:v3',
+            'name': 'drive',
+            'version': 'v3',
+            'rootUrl': base_url,
+            'servicePath': 'drive/v3/',
+            'batchPath': 'batch/drive/v3',
+            'parameters': {'alt': {'type': 'string', 'default': 'json', 'enum': ['json'], 'location': 'query'},
+                           'fields': query(),
+                           'key': query(),
+                           'quotaUser': query(),
+                           'prettyPrint': query('boolean')},
+            'schemas': {'File': {'id': 'File', 'type': 'object'},
+                        'FileList': {'id': 'FileList', 'type': 'object'},
+                        'DriveList': {'id': 'DriveList', 'type': 'object'},
+                        'About': {'id': 'About', 'type': 'object'}},
+            'resources': {
+                'files': {'methods': {
+                    'get': {'id': 'drive.files.get',
+                            'path': 'files/{fileId}',
+                            'httpMethod': 'GET',
+                            'parameters': {'fileId': {'type': 'string', 'required': True, 'location': 'path'},
+                                           'supportsAllDrives': query('boolean')},
+                            'parameterOrder': ['fileId'],
+                            'response': {'$ref': 'File'}},
+                    'list': {'id': 'drive.files.list',
+                             'path': 'files',
+                             'httpMethod': 'GET',
+                             'parameters': list_parameters,
+                             'response': {'$ref': 'FileList'}}}},
+                'drives': {'methods': {
+                    'list': {'id': 'drive.drives.list',
+                             'path': 'drives',
+                             'httpMethod': 'GET',
+                             'parameters': {'pageSize': query('integer'), 'pageToken': query()},
+                             'response': {'$ref': 'DriveList'}}}},
+                'about': {'methods': {
+                    'get': {'id': 'drive.about.get',
+                            'path': 'about',
+                            'httpMethod': 'GET',
+                            'response': {'$ref': 'About'}}}}}}
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    """ Route requests to the Drive and Box handlers """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        # Keep the console quiet under load
+        pass
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def _dispatch(self, method):
+        state = self.server.state
+        url = urlparse(self.path)
+        params = {key: values[0] for key, values in parse_qs(url.query).items()}
+        parts = [part for part in url.path.split('/') if part]
+        body = None
+        if method in ('POST', 'PUT'):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length) if length else b''
+
+        time.sleep(state.latency.sample())
+        if parts[:3] != ['discovery', 'v1', 'apis'] and state.should_throttle():
+            self._send(429, {'error': {'code': 429, 'message': 'Rate limit exceeded'}},
+                       headers={'Retry-After': str(state.retry_after)})
+            return
+
+        if parts[:3] == ['discovery', 'v1', 'apis']:
+            base_url = 'http://{0}/'.format(self.headers.get('Host'))
+            self._send(200, drive_discovery_document(base_url))
+        elif parts == ['oauth2', 'token']:
+            self._grant(state, body)
+        elif parts[:2] == ['drive', 'v3']:
+            self._drive(state.acting_as(self.headers), parts[2:], params)
+        elif parts == ['box', '2.0', 'users']:
+            words = params.get('filter_term', '').lower()
+            entries = [{'type': 'user', 'id': user_id, 'login': email}
+                       for email, user_id in state.box_user_ids.items() if email.lower().startswith(words)]
+            self._send(200, {'total_count': len(entries), 'offset': 0, 'limit': 100, 'entries': entries})
+        elif parts[:2] == ['box', '2.0']:
+            self._box(state.acting_as(self.headers), method, parts[2:], params, body)
+        elif parts[:2] == ['box', 'oauth2']:
+            self._send(200, {'access_token': 'stub-access-token', 'refresh_token': 'stub-refresh-token',
+                             'expires_in': 3600, 'token_type': 'bearer'})
+        else:
+            self._send(404, {'error': {'code': 404, 'message': 'Unknown endpoint'}})
+
+    def _grant(self, state, body):
+        # A JWT bearer grant; the claims are taken on trust and the user in 'sub' is acted as
+        form = {key: values[0] for key, values in parse_qs((body or b'').decode('utf-8')).items()}
+        try:
+            claims = form['assertion'].split('.')[1]
+            subject = json.loads(base64.urlsafe_b64decode(claims + '=' * (-len(claims) % 4))).get('sub')
+        except (KeyError, IndexError, ValueError):
+            self._send(400, {'error': 'invalid_grant'})
+            return
+        if subject not in state.user_states:
+            self._send(401, {'error': 'unauthorized_client', 'error_description': 'Unknown user'})
+            return
+        self._send(200, {'access_token': 'delegated-{0}'.format(subject), 'expires_in': 3600, 'token_type': 'Bearer'})
+
+    def _drive(self, state, parts, params):
+        tree = state.tree
+        if parts == ['about']:
+            display_name, email = tree.users[0]
+            self._send(200, {'user': {'displayName': display_name, 'emailAddress': email}})
+        elif parts == ['drives']:
+            page_size = min(int(params.get('pageSize', 10)), DRIVES_PAGE_SIZE)
+            offset = int(params.get('pageToken') or 0)
+            response = {'drives': [shared_tree.shared_drive
+                                   for shared_tree in state.shared_trees[offset:offset + page_size]]}
+            if offset + page_size < len(state.shared_trees):
+                response['nextPageToken'] = str(offset + page_size)
+            self._send(200, response)
+        elif parts == ['files']:
+            if params.get('corpora') == 'drive':
+                tree = state.drive_tree(drive_id=params.get('driveId'))
+                if tree is state.tree:
+                    self._send(404, {'error': {'code': 404, 'message': 'Shared drive not found'}})
+                    return
+            page_size = min(int(params.get('pageSize', 100)), state.drive_page_size)
+            offset = int(params.get('pageToken') or 0)
+            end = min(offset + page_size, tree.drive_item_count())
+            response = {'files': [tree.drive_item_at(position) for position in range(offset, end)]}
+            if end < tree.drive_item_count():
+                response['nextPageToken'] = str(end)
+            self._send(200, response)
+        elif len(parts) == 2 and parts[0] == 'files':
+            item = tree.drive_root() if parts[1] == 'root' else state.drive_tree(parts[1]).drive_item(parts[1])
+            if item:
+                self._send(200, item)
+            else:
+                self._send(404, {'error': {'code': 404, 'message': 'File not found: {0}'.format(parts[1])}})
+        else:
+            self._send(404, {'error': {'code': 404, 'message': 'Unknown endpoint'}})
+
+    def _box(self, state, method, parts, params, body):
+        if parts == ['users', 'me']:
+            display_name, email = state.tree.users[0]
+            self._send(200, {'type': 'user', 'id': '1', 'name': display_name, 'login': email})
+        elif len(parts) == 3 and parts[0] == 'folders' and parts[2] == 'items':
+            limit = min(int(params.get('limit', 100)), state.box_page_size)
+            offset = int(params.get('offset', 0))
+            children = state.box_children.get(parts[1], [])
+            entries = [{'type': item_type, 'id': object_id, 'name': name}
+                       for item_type, object_id, name in children[offset:offset + limit]]
+            self._send(200, {'total_count': len(children), 'offset': offset, 'limit': limit, 'entries': entries})
+        elif len(parts) == 2 and parts[0] == 'folders':
+            self._send(200, {'type': 'folder', 'id': parts[1]})
+        elif parts == ['search']:
+            self._search(state, params)
+        elif len(parts) == 5 and parts[0] == 'files' and parts[2] == 'metadata':
+            key = (parts[1], parts[3], parts[4])
+            if method == 'POST':
+                if key in state.metadata:
+                    self._send(409, {'type': 'error', 'status': 409, 'code': 'tuple_already_exists'})
+                else:
+                    state.metadata[key] = json.loads(body.decode('utf-8') or '{}')
+                    self._send(201, state.metadata[key])
+            elif method == 'PUT':
+                # A JSON Patch of add/replace operations
+                if key not in state.metadata:
+                    self._send(404, {'type': 'error', 'status': 404, 'code': 'instance_not_found'})
+                    return
+                for operation in json.loads(body.decode('utf-8') or '[]'):
+                    if operation.get('op') in ('add', 'replace'):
+                        state.metadata[key][operation['path'].lstrip('/')] = operation['value']
+                self._send(200, state.metadata[key])
+            elif key in state.metadata:
+                self._send(200, state.metadata[key])
+            else:
+                self._send(404, {'type': 'error', 'status': 404, 'code': 'instance_not_found'})
+        elif len(parts) == 4 and parts[0] == 'metadata_templates' and parts[3] == 'schema':
+            if parts[2] in METADATA_TEMPLATES:
+                self._send(200, {'templateKey': parts[2], 'scope': parts[1], 'fields': []})
+            else:
+                self._send(404, {'type': 'error', 'status': 404, 'code': 'not_found'})
+        else:
+            self._send(404, {'type': 'error', 'status': 404, 'code': 'not_found'})
+
+    def _search(self, state, params):
+        # Matches names containing any of the words of an "a OR b" query, like a content_types=name search
+        if not params.get('query') or int(params.get('offset', 0)) > SEARCH_MAX_OFFSET:
+            self._send(400, {'type': 'error', 'status': 400, 'code': 'bad_request'})
+            return
+        words = {word.lower() for word in params['query'].split(' OR ')}
+        ancestors = set(params.get('ancestor_folder_ids', synthetic.BOX_ROOT_ID).split(','))
+        limit = min(int(params.get('limit', 30)), SEARCH_LIMIT)
+        offset = int(params.get('offset', 0))
+        matches = [(object_id, name, path) for object_id, name, path in state.box_files()
+                   if words & set(re.split(r'\W+', name.lower())) and ancestors & {entry['id'] for entry in path}]
+        entries = [{'type': 'file', 'id': object_id, 'name': name,
+                    'path_collection': {'total_count': len(path), 'entries': path}}
+                   for object_id, name, path in matches[offset:offset + limit]]
+        self._send(200, {'total_count': len(matches), 'offset': offset, 'limit': limit, 'entries': entries})
+
+    def _send(self, status, payload, headers=None):
+        content = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+
+def make_server(state, host='localhost', port=DEFAULT_PORT):
+    """ Create (but don't start) a stand-in server
+
+    Args:
+        state (StubState): What the server should serve
+        host (str, optional): Interface to listen on
+        port (int, optional): Port to listen on (0 picks a free port)
+
+    Returns:
+        ThreadingHTTPServer: The server; call serve_forever() to start it
+    """
+    server = ThreadingHTTPServer((host, port), StubRequestHandler)
+    server.daemon_threads = True
+    server.state = state
+    return server
+
+
+def build_arg_parser():
+    """ Build and return an args parser
+
+    Returns:
+        argparse: Args parser
+    """
+    parser = argparse.ArgumentParser(description='Local stand-in for the Drive and Box APIs.')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help='Port to listen on')
+    parser.add_argument('--size', type=int, default=10000,
+                        help='Number of files and folders in the synthetic tree')
+    parser.add_argument('--depth', type=int, default=8,
+                        help='Maximum folder depth of the synthetic tree')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Random seed for the tree, latencies and throttling')
+    parser.add_argument('--latency', type=str, default='none', metavar='DISTRIBUTION',
+                        help='Response delay: none, fixed:SECONDS, uniform:MIN:MAX or lognormal:MEDIAN:SIGMA')
+    parser.add_argument('--ratelimit', type=float, default=0.0, metavar='SHARE',
+                        help='Share of requests to answer with 429 Too Many Requests')
+    parser.add_argument('--retryafter', type=int, default=1, metavar='SECONDS',
+                        help='Retry-After value sent with each 429')
+    parser.add_argument('--shareddrives', type=int, default=0, metavar='COUNT',
+                        help='Number of shared drives, each with a synthetic tree of its own')
+    parser.add_argument('--shareddrivesize', type=int, default=1000, metavar='SIZE',
+                        help='Number of files and folders in each shared drive')
+    parser.add_argument('--users', type=int, default=0, metavar='COUNT',
+                        help='Number of users of the domain (user0@example.com, ...), each with a synthetic tree')
+    parser.add_argument('--usersize', type=int, default=1000, metavar='SIZE',
+                        help='Number of files and folders in each user\'s tree')
+    parser.add_argument('--drivepagesize', type=int, default=1000,
+                        help='Maximum items per Drive files.list page')
+    parser.add_argument('--boxpagesize', type=int, default=1000,
+                        help='Maximum items per Box folder items page')
+    return parser
+
+
+if __name__ == '__main__':
+    args = build_arg_parser().parse_args()
+    print('Generating a tree of {0} items...'.format(args.size))
+    if args.shareddrives:
+        print('Generating {0} shared drives of {1} items...'.format(args.shareddrives, args.shareddrivesize))
+    shared_drive_trees = [synthetic.SyntheticTree(args.shareddrivesize,
+                                                  max_depth=args.depth,
+                                                  seed=args.seed + 1 + index,
+                                                  shared_drive={'id': 'drive{0}'.format(index),
+                                                                'name': 'Shared Drive {0}'.format(index)})
+                          for index in range(args.shareddrives)]
+    if args.users:
+        print('Generating {0} users with {1} items each...'.format(args.users, args.usersize))
+    user_trees = {'user{0}@example.com'.format(index): synthetic.SyntheticTree(args.usersize,
+                                                                              max_depth=args.depth,
+                                                                              seed=args.seed + 1000 + index)
+                  for index in range(args.users)}
+    stub_state = StubState(tree=synthetic.SyntheticTree(args.size, max_depth=args.depth, seed=args.seed),
+                           latency=LatencyModel(args.latency, seed=args.seed),
+                           rate_limit=args.ratelimit,
+                           retry_after=args.retryafter,
+                           drive_page_size=args.drivepagesize,
+                           box_page_size=args.boxpagesize,
+                           seed=args.seed,
+                           shared_trees=shared_drive_trees,
+                           user_states={email: StubState(tree=user_tree,
+                                                         latency=LatencyModel(),
+                                                         drive_page_size=args.drivepagesize,
+                                                         box_page_size=args.boxpagesize)
+                                        for email, user_tree in user_trees.items()})
+    stub_server = make_server(stub_state, port=args.port)
+    print('Serving on http://localhost:{0}'.format(stub_server.server_address[1]))
+    try:
+        stub_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print('Served {0} requests ({1} throttled).'.format(stub_state.requests, stub_state.throttled))
@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+""" Synthetic Drive and Box trees for benchmarking without live accounts
+
+A SyntheticTree describes one logical hierarchy. It can be served as Drive
+`files.list` pages through SyntheticDriveService, and as Box folder listings
+through SyntheticBoxClient, so that the real Drive/Box construction and
+matching code can be run against it.
+
+The Box side is rendered the way a transfer service leaves it: Google Docs
+gain an Office suffix, '/' in names becomes '002f', and a share of files only
+exist on one side. Optionally, a share of files are named in upper case in
+Box, so they are only found by a looser match key (see match_keys).
+
+"""
+
+# Imports
+import random
+
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+EXPORT_SUFFIXES = {'application/vnd.google-apps.document': '.docx',
+                   'application/vnd.google-apps.spreadsheet': '.xlsx',
+                   'application/vnd.google-apps.presentation': '.pptx'}
+FILE_MIME_TYPES = [('application/pdf', '.pdf', 20),
+                   ('image/jpeg', '.jpg', 15),
+                   ('application/vnd.openxmlformats-officedocument.wordprocessingml.document', '.docx', 10),
+                   ('text/plain', '.txt', 5),
+                   ('application/vnd.google-apps.document', '', 25),
+                   ('application/vnd.google-apps.spreadsheet', '', 15),
+                   ('application/vnd.google-apps.presentation', '', 10)]
+ROOT_ID = 'root-0'
+BOX_ROOT_ID = '0'
+
+
+class SyntheticTree(object):
+    """ A randomly generated folder/file hierarchy with a realistic shape
+
+    Args:
+        size (int): Total number of files and folders
+        max_depth (int, optional): Maximum folder depth below the root
+        folder_ratio (float, optional): Share of items which are folders
+        duplicate_ratio (float, optional): Share of files which reuse a sibling's name
+        slash_ratio (float, optional): Share of names containing a '/' (escaped as '002f' in Box)
+        missing_ratio (float, optional): Share of files which only exist on one side
+        variant_ratio (float, optional): Share of files named in upper case in Box
+        user_count (int, optional): Number of distinct owners/modifiers
+        seed (int, optional): Random seed, so the same arguments always give the same tree
+        shared_drive (dict, optional): ID and name of the shared drive to render the tree as. Its items
+            have no owners, and every Drive and Box ID is prefixed with the drive's ID.
+
+    Attributes:
+        folders ([(int, str)]): (parent index, name) of every folder; index 0 is the root
+        files ([(int, str, str, int)]): (parent folder index, name, mime type, side) of every file,
+            where side is 0 for both, 1 for Drive only and 2 for Box only
+        users ([(str, str)]): (display name, email) of every user
+        variants (set(int)): Indexes of the files named in upper case in Box
+        shared_drive (dict): ID and name of the shared drive, or None for "My Drive"
+        root_id (str): Drive ID of the root folder
+        box_root_id (str): Box ID of the root folder
+    """
+
+    def __init__(self, size, max_depth=8, folder_ratio=0.1, duplicate_ratio=0.01, slash_ratio=0.005,
+                 missing_ratio=0.02, variant_ratio=0.0, user_count=50, seed=0, shared_drive=None):
+        rand = random.Random(seed)
+        self._drive_files = None
+        self.shared_drive = shared_drive
+        self._prefix = shared_drive['id'] + '-' if shared_drive else ''
+        self.root_id = shared_drive['id'] if shared_drive else ROOT_ID
+        self.box_root_id = self._prefix + BOX_ROOT_ID if shared_drive else BOX_ROOT_ID
+        self.users = [('User {0}'.format(i), 'user{0}@example.com'.format(i)) for i in range(user_count)]
+
+        folder_count = max(int(size * folder_ratio), 1)
+        file_count = max(size - folder_count, 0)
+
+        # Grow the folders by attaching each one to an existing folder which isn't too deep.
+        # Picking from the most recent folders gives a mix of deep chains and wide levels.
+        self.folders = [(-1, '')]
+        depths = [0]
+        for index in range(1, folder_count):
+            parent = rand.randrange(max(index - 50, 0), index)
+            while depths[parent] >= max_depth:
+                parent = rand.randrange(0, index)
+            self.folders.append((parent, self._make_name(rand, 'Folder', index, '', slash_ratio)))
+            depths.append(depths[parent] + 1)
+
+        # Files land in folders with a skew, so a few folders are very wide
+        weights = [1.0 / (1 + (i % 97)) for i in range(folder_count)]
+        parents = rand.choices(range(folder_count), weights=weights, k=file_count)
+        mime_types = rand.choices(FILE_MIME_TYPES, weights=[m[2] for m in FILE_MIME_TYPES], k=file_count)
+        self.files = []
+        last_name = {}
+        for index in range(file_count):
+            parent = parents[index]
+            mime_type, extension, _ = mime_types[index]
+            if parent in last_name and rand.random() < duplicate_ratio:
+                name = last_name[parent]
+            else:
+                name = self._make_name(rand, 'File', index, extension, slash_ratio)
+                last_name[parent] = name
+            side = 0
+            if rand.random() < missing_ratio:
+                side = rand.choice((1, 2))
+            self.files.append((parent, name, mime_type, side))
+
+        # Drawn separately, so the rest of the tree is the same whatever the ratio
+        variant_rand = random.Random(seed)
+        self.variants = {index for index in range(file_count) if variant_rand.random() < variant_ratio}
+
+    @staticmethod
+    def _make_name(rand, kind, index, extension, slash_ratio):
+        name = '{0} {1}{2}'.format(kind, index, extension)
+        if rand.random() < slash_ratio:
+            name = '{0} {1}/{2}{3}'.format(kind, index, rand.randrange(100), extension)
+        return name
+
+    def drive_items(self):
+        """ Render every non-root item as a Drive `files.list` entry
+
+        Yields:
+            dict: A file resource, in the shape returned by the Drive API
+        """
+        for index in range(1, len(self.folders)):
+            parent, name = self.folders[index]
+            yield self._drive_item(self._prefix + 'folder-{0}'.format(index), name, FOLDER_MIME_TYPE, parent, index)
+
+        for index, (parent, name, mime_type, side) in enumerate(self.files):
+            if side != 2:
+                yield self._drive_item(self._prefix + 'file-{0}'.format(index), name, mime_type, parent, index)
+
+    def drive_item_count(self):
+        """ Count the items yielded by drive_items()
+
+        Returns:
+            int: Number of non-root Drive items
+        """
+        return len(self.folders) - 1 + len(self._drive_file_indexes())
+
+    def drive_item_at(self, position):
+        """ Render the item at a position of drive_items(), for serving pages by offset
+
+        Args:
+            position (int): Position of the item
+
+        Returns:
+            dict: A file resource, in the shape returned by the Drive API
+        """
+        if position < len(self.folders) - 1:
+            return self.drive_item(self._prefix + 'folder-{0}'.format(position + 1))
+        return self.drive_item(self._prefix + 'file-{0}'.format(
+            self._drive_file_indexes()[position - len(self.folders) + 1]))
+
+    def drive_item(self, identifier):
+        """ Render an item by its Drive ID
+
+        Args:
+            identifier (str): Drive ID of the item
+
+        Returns:
+            dict: A file resource, or None if no item has that ID
+        """
+        if identifier == self.root_id:
+            return self.drive_root()
+        if not identifier.startswith(self._prefix):
+            return None
+        kind, _, index = identifier[len(self._prefix):].partition('-')
+        if not index.isdigit():
+            return None
+        index = int(index)
+        if kind == 'folder' and 0 < index < len(self.folders):
+            parent, name = self.folders[index]
+            return self._drive_item(identifier, name, FOLDER_MIME_TYPE, parent, index)
+        if kind == 'file' and index < len(self.files) and self.files[index][3] != 2:
+            parent, name, mime_type, _ = self.files[index]
+            return self._drive_item(identifier, name, mime_type, parent, index)
+        return None
+
+    def _drive_file_indexes(self):
+        if self._drive_files is None:
+            self._drive_files = [index for index, item in enumerate(self.files) if item[3] != 2]
+        return self._drive_files
+
+    def drive_root(self):
+        """ Render the root "My Drive" folder as returned by `files.get`
+
+        Returns:
+            dict: The root folder resource
+        """
+        if self.shared_drive:
+            return {'id': self.root_id, 'mimeType': FOLDER_MIME_TYPE, 'name': self.shared_drive['name']}
+        display_name, email = self.users[0]
+        return {'id': ROOT_ID,
+                'mimeType': FOLDER_MIME_TYPE,
+                'name': 'My Drive',
+                'owners': [{'displayName': display_name, 'emailAddress': email}]}
+
+    def _drive_item(self, identifier, name, mime_type, parent, index):
+        owner_name, owner_email = self.users[index % len(self.users)]
+        modifier_name, modifier_email = self.users[(index * 7) % len(self.users)]
+        item = {'id': identifier,
+                'mimeType': mime_type,
+                'name': name,
+                'owners': [{'kind': 'drive#user',
+                            'displayName': owner_name,
+                            'emailAddress': owner_email,
+                            'me': index % len(self.users) == 0,
+                            'permissionId': str(index % len(self.users))}],
+                'parents': [self._prefix + 'folder-{0}'.format(parent) if parent else self.root_id],
+                'modifiedTime': '2017-{0:02d}-{1:02d}T10:00:00.000Z'.format(index % 12 + 1, index % 28 + 1),
+                'lastModifyingUser': {'kind': 'drive#user',
+                                      'displayName': modifier_name,
+                                      'emailAddress': modifier_email,
+                                      'me': False,
+                                      'permissionId': str((index * 7) % len(self.users))},
+                'createdTime': '2016-{0:02d}-{1:02d}T10:00:00.000Z'.format(index % 12 + 1, index % 28 + 1)}
+        if self.shared_drive:
+            # Items in shared drives belong to the drive rather than a user
+            del item['owners']
+            item['driveId'] = self.root_id
+        return item
+
+    def box_children(self):
+        """ Group the Box side of the tree by parent folder
+
+        Returns:
+            dict: Box folder ID to a list of (type, ID, name) tuples for its children
+        """
+        children = {}
+        for index in range(1, len(self.folders)):
+            parent, name = self.folders[index]
+            children.setdefault(self._box_folder_id(parent), []).append(
+                ('folder', self._box_folder_id(index), _box_name(name)))
+
+        for index, (parent, name, mime_type, side) in enumerate(self.files):
+            if side != 1:
+                box_name = _box_name(name + EXPORT_SUFFIXES.get(mime_type, ''))
+                if index in self.variants:
+                    box_name = box_name.upper()
+                children.setdefault(self._box_folder_id(parent), []).append(
+                    ('file', self._prefix + 'f{0}'.format(index), box_name))
+        return children
+
+    def _box_folder_id(self, index):
+        return self._prefix + str(index) if index else self.box_root_id
+
+
+def _box_name(name):
+    """ Escape a name the way Box stores imported names containing '/'
+
+    Args:
+        name (str): Name of the item in Drive
+
+    Returns:
+        str: Name of the item in Box
+    """
+    if '/' in name:
+        return name.replace('/', '002f') + ' - Modify'
+    return name
+
+
+class _Request(object):
+    """ Stand-in for a googleapiclient HttpRequest """
+
+    def __init__(self, response):
+        self._response = response
+
+    def execute(self, http=None, num_retries=0):
+        return self._response
+
+
+class _DriveFiles(object):
+    def __init__(self, tree, page_size):
+        self._tree = tree
+        self._page_size = page_size
+        self._items = None
+
+    def get(self, fileId, fields=None, **kwargs):
+        return _Request(self._tree.drive_root())
+
+    def list(self, pageSize=100, pageToken=None, **kwargs):
+        if self._items is None or pageToken is None:
+            self._items = self._tree.drive_items()
+        page_size = min(pageSize, self._page_size)
+        files = []
+        for item in self._items:
+            files.append(item)
+            if len(files) == page_size:
+                break
+        response = {'files': files}
+        if len(files) == page_size:
+            response['nextPageToken'] = str(int(pageToken or 0) + 1)
+        return _Request(response)
+
+
+class _DriveAbout(object):
+    def __init__(self, tree):
+        self._tree = tree
+
+    def get(self, fields=None, **kwargs):
+        display_name, email = self._tree.users[0]
+        return _Request({'user': {'displayName': display_name, 'emailAddress': email}})
+
+
+class SyntheticDriveService(object):
+    """ In-memory stand-in for the Drive v3 discovery service
+
+    Pages are rendered on demand from the tree, so the service itself holds
+    no more than one page of raw dicts at a time.
+
+    Args:
+        tree (SyntheticTree): The tree to serve
+        page_size (int, optional): Maximum number of items returned per page
+    """
+
+    def __init__(self, tree, page_size=1000):
+        self._files = _DriveFiles(tree, page_size)
+        self._about = _DriveAbout(tree)
+
+    def files(self):
+        return self._files
+
+    def about(self):
+        return self._about
+
+
+class _BoxItem(object):
+    def __init__(self, item_type, object_id, name):
+        self.type = item_type
+        self.object_id = object_id
+        self.name = name
+
+
+class _BoxFolder(object):
+    def __init__(self, children, folder_id):
+        self._children = children
+        self.object_id = folder_id
+        self.type = 'folder'
+
+    def get_items(self, limit, offset=0, fields=None):
+        return [_BoxItem(*child) for child in self._children.get(self.object_id, [])[offset:offset + limit]]
+
+
+class _BoxMetadata(object):
+    def __init__(self, store, key):
+        self._store = store
+        self._key = key
+
+    def get(self):
+        return self._store.get(self._key)
+
+    def create(self, metadata):
+        self._store[self._key] = metadata
+        return metadata
+
+    def start_update(self):
+        return _BoxMetadataUpdate()
+
+    def update(self, metadata_update):
+        metadata = self._store[self._key]
+        for key, value in metadata_update.values.items():
+            metadata[key] = value
+        return metadata
+
+
+class _BoxMetadataUpdate(object):
+    def __init__(self):
+        self.values = {}
+
+    def add(self, path, value):
+        self.values[path.lstrip('/')] = value
+
+
+class _BoxFile(object):
+    def __init__(self, store, file_id):
+        self._store = store
+        self.object_id = file_id
+
+    def metadata(self, scope='global', template='properties'):
+        return _BoxMetadata(self._store, (self.object_id, scope, template))
+
+
+class SyntheticBoxClient(object):
+    """ In-memory stand-in for an authenticated Box client
+
+    Metadata instances written through it are kept in `metadata`.
+
+    Args:
+        tree (SyntheticTree): The tree to serve
+    """
+
+    def __init__(self, tree):
+        self._children = tree.box_children()
+        self.metadata = {}
+
+    def folder(self, folder_id):
+        return _BoxFolder(self._children, folder_id)
+
+    def file(self, file_id):
+        return _BoxFile(self.metadata, file_id)
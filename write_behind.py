@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+""" Writing metadata to Box behind the matcher
+
+Each metadata write is a round trip or two to Box, and migrate_metadata
+would otherwise wait for every one before matching the next file. A
+WriteBehindQueue accepts writes straight away and a background thread sends
+them to Box in batches, a few at a time on writer threads, drawing on a rate
+budget. Batches are sent one after another, so writes to the same file are
+never in flight at once and land in the order they were submitted.
+
+Writes to a file which is already waiting in the queue are coalesced into
+the waiting one, so the file is only written once:
+
+    * a later apply (create the metadata if it is missing) is dropped, as the
+      metadata will exist by the time it would have run, and reports that
+      the metadata was already there
+    * a later update (overwrite the metadata) replaces the waiting write,
+      with the later Drive file's values
+
+The outcome of each write is handed to its callback as callback(written,
+error), on the thread which submits and flushes the writes rather than a
+writer thread, so callbacks can update reports and the ledger without locks.
+Callbacks are run in the order the writes were submitted, those of coalesced
+writes along with the write they were coalesced into.
+
+"""
+
+# Imports
+import collections
+import concurrent.futures
+import threading
+
+APPLY = 'apply'  # Create the metadata if the file has none (Box.apply_metadata)
+UPDATE = 'update'  # Overwrite the metadata (Box.update_metadata)
+
+BATCH_SIZE = 100  # Most writes sent to Box in one batch
+MAX_PENDING = 10000  # Writes waiting in the queue before submitting one blocks
+
+
+class _Write(object):
+    """ A write waiting in the queue
+
+    Args:
+        box_file (BoxObject): File to write the metadata of
+        drive_file (Drive.File): File the metadata comes from
+        kind (str): APPLY or UPDATE
+
+    Attributes:
+        callbacks ([(callable, bool)]): Callbacks of the writes coalesced into this one, each with whether it
+            was an apply dropped in favour of this write
+        written (bool): Whether the metadata was written, once sent
+        error (Exception): Why the write failed, or None
+    """
+
+    __slots__ = ('box_file', 'drive_file', 'kind', 'callbacks', 'written', 'error')
+
+    def __init__(self, box_file, drive_file, kind):
+        self.box_file = box_file
+        self.drive_file = drive_file
+        self.kind = kind
+        self.callbacks = []
+        self.written = False
+        self.error = None
+
+
+class WriteBehindQueue(object):
+    """ Queue of metadata writes, sent to Box in the background
+
+    Args:
+        box (Box): The Box to write to
+        writers (int, optional): Writes sent at once
+        batch_size (int, optional): Most writes sent in one batch
+        max_pending (int, optional): Writes waiting before submitting one blocks, which bounds the memory held
+        budget (RateBudget, optional): Budget each write draws on (see delegation.RateBudget)
+        logger (logger, optional): Logging file
+
+    Attributes:
+        submitted (int): Writes submitted
+        coalesced (int): Writes coalesced into one already waiting
+        written (int): Writes sent which wrote metadata
+        failed (int): Writes sent which failed
+        batches (int): Batches sent
+    """
+
+    def __init__(self, box, writers=4, batch_size=BATCH_SIZE, max_pending=MAX_PENDING, budget=None, logger=None):
+        self.submitted = 0
+        self.coalesced = 0
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self._box = box
+        self._batch_size = batch_size
+        self._max_pending = max_pending
+        self._budget = budget
+        self._logger = logger
+        # Box ID to the write waiting for it, in the order they were submitted
+        self._pending = collections.OrderedDict()
+        # Writes sent, whose callbacks are still to be run
+        self._done = collections.deque()
+        self._in_flight = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=writers, thread_name_prefix='writer')
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+
+    def submit(self, box_file, drive_file, kind=APPLY, callback=None):
+        """ Queue a write, first running the callbacks of any writes which have been sent
+
+        Only blocks if the queue is full.
+
+        Args:
+            box_file (BoxObject): File to write the metadata of
+            drive_file (Drive.File): File the metadata comes from
+            kind (str, optional): APPLY or UPDATE
+            callback (callable, optional): Called with (written, error) once the write has been sent
+        """
+        self.deliver()
+        with self._condition:
+            if self._closed:
+                raise ValueError('The write-behind queue is closed')
+            self.submitted += 1
+            waiting = self._pending.get(box_file.id)
+            if waiting is not None:
+                self.coalesced += 1
+                if kind == UPDATE:
+                    waiting.kind = UPDATE
+                    waiting.drive_file = drive_file
+                waiting.callbacks.append((callback, kind == APPLY))
+                return
+            while len(self._pending) >= self._max_pending:
+                self._condition.wait()
+            write = _Write(box_file, drive_file, kind)
+            write.callbacks.append((callback, False))
+            self._pending[box_file.id] = write
+            self._condition.notify_all()
+
+    def deliver(self):
+        """ Run the callbacks of the writes sent so far, in the order the writes were submitted """
+        while True:
+            with self._condition:
+                if not self._done:
+                    return
+                write = self._done.popleft()
+            for callback, dropped in write.callbacks:
+                if callback:
+                    if write.error is not None:
+                        callback(False, write.error)
+                    else:
+                        callback(write.written and not dropped, None)
+
+    def flush(self):
+        """ Wait for every write submitted so far to be sent, and run their callbacks """
+        with self._condition:
+            while self._pending or self._in_flight:
+                self._condition.wait()
+        self.deliver()
+
+    def close(self):
+        """ Flush the queue and stop its threads """
+        self.flush()
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+        self._pool.shutdown()
+        if self._logger:
+            self._logger.info('Wrote metadata in %s batches: %s writes submitted, %s coalesced, %s written, '
+                              '%s failed', self.batches, self.submitted, self.coalesced, self.written, self.failed)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                batch = [self._pending.popitem(last=False)[1]
+                         for _ in range(min(self._batch_size, len(self._pending)))]
+                self._in_flight = len(batch)
+                # Room has been made for blocked submitters
+                self._condition.notify_all()
+
+            concurrent.futures.wait([self._pool.submit(self._send, write) for write in batch])
+
+            with self._condition:
+                self.batches += 1
+                self._done.extend(batch)
+                self._in_flight = 0
+                self._condition.notify_all()
+
+    def _send(self, write):
+        if self._budget:
+            self._budget.acquire()
+        try:
+            if write.kind == UPDATE:
+                self._box.update_metadata(write.box_file, write.drive_file)
+                write.written = True
+            else:
+                write.written = self._box.apply_metadata(write.box_file, write.drive_file)
+        except Exception as err:  # Handed to the callbacks, and the other writes carry on
+            write.error = err
+            if self._logger:
+                self._logger.error('Failed to write metadata for %s: %s', write.box_file.path, err)
+        with self._condition:
+            if write.error is not None:
+                self.failed += 1
+            elif write.written:
+                self.written += 1